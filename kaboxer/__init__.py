@@ -1,6 +1,8 @@
 #! /usr/bin/python3
 
 import argparse
+import concurrent.futures
+import contextvars
 import glob
 import grp
 import json
@@ -11,12 +13,15 @@ import pathlib
 import re
 import shlex
 import shutil
+import socket
 import stat
 import subprocess
 import sys
 import tarfile
 import tempfile
 import termios
+import threading
+import time
 import urllib.parse
 from http import HTTPStatus
 
@@ -106,11 +111,147 @@ def parse_version(version_string):
     return packaging.version.parse(version_string)
 
 
+def format_size(size):
+    """Format a size in bytes as a human-readable string"""
+    for unit in ["B", "kB", "MB", "GB"]:
+        if abs(size) < 1000:
+            break
+        size /= 1000
+    else:
+        unit = "TB"
+    if unit == "B":
+        return "%d %s" % (size, unit)
+    return "%.1f %s" % (size, unit)
+
+
+def parse_size(size):
+    """Parse a size such as 512m or 2g into bytes
+
+    As with docker, the units are powers of 1024.
+    """
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([bkmgt]?)b?", str(size).strip().lower())
+    if not match:
+        raise ValueError("Invalid size: %s" % (size,))
+    return int(float(match.group(1)) * 1024 ** "bkmgt".index(match.group(2) or "b"))
+
+
+def get_source_date_epoch():
+    """Timestamp to use for reproducible builds
+
+    Honors the SOURCE_DATE_EPOCH environment variable, as specified at
+    <https://reproducible-builds.org/specs/source-date-epoch/>, and falls
+    back to the Unix epoch.
+    """
+    try:
+        return int(os.environ["SOURCE_DATE_EPOCH"])
+    except (KeyError, ValueError):
+        return 0
+
+
+def write_injection_tarball(fileobj, files, mtime=None):
+    """Write a tarball of files to be injected into an image
+
+    'files' is a list of (host path, path in image) tuples. If 'mtime' is
+    set, the tarball is normalized so that it only depends on the content
+    of the files: members are sorted, and timestamps, ownership and
+    permissions are set to fixed values.
+    """
+    if mtime is not None:
+        files = sorted(files, key=lambda x: x[1])
+    tf = tarfile.open(fileobj=fileobj, mode="w")
+    dirs = set()
+    for outfile, infile in files:
+        p = pathlib.Path(os.path.dirname(infile))
+        parents = list(reversed(p.parents))
+        if mtime is not None:
+            # Directory timestamps are modified when files are added, so
+            # they must be part of the tarball, the root excepted.
+            parents = parents[1:] + [p]
+        for parent in parents:
+            if str(parent) in dirs:
+                continue
+            dirs.add(str(parent))
+            ti = tarfile.TarInfo(name=str(parent))
+            ti.type = tarfile.DIRTYPE
+            if mtime is not None:
+                ti.mode = 0o755
+                ti.mtime = mtime
+                ti.uname = ti.gname = "root"
+            tf.addfile(ti)
+        ti = tarfile.TarInfo(name=infile)
+        ti.size = os.stat(outfile).st_size
+        if mtime is not None:
+            ti.mode = 0o644
+            ti.mtime = mtime
+            ti.uname = ti.gname = "root"
+        with open(outfile, mode="rb") as f:
+            tf.addfile(ti, fileobj=f)
+    tf.close()
+
+
+def get_image_config_changes(config):
+    """Dockerfile instructions that restore an image configuration
+
+    When an image is flattened (exported then imported), its configuration
+    is lost. This function returns the list of Dockerfile instructions that
+    must be given as 'changes' to the import to get it back.
+    """
+    changes = []
+    for env in config.get("Env") or []:
+        key, _, value = env.partition("=")
+        changes.append("ENV %s=%s" % (key, json.dumps(value)))
+    for label, value in sorted((config.get("Labels") or {}).items()):
+        changes.append("LABEL %s=%s" % (json.dumps(label), json.dumps(value)))
+    for port in sorted(config.get("ExposedPorts") or {}):
+        changes.append("EXPOSE %s" % port)
+    volumes = sorted(config.get("Volumes") or {})
+    if volumes:
+        changes.append("VOLUME %s" % json.dumps(volumes))
+    if config.get("WorkingDir"):
+        changes.append("WORKDIR %s" % config["WorkingDir"])
+    if config.get("User"):
+        changes.append("USER %s" % config["User"])
+    if config.get("StopSignal"):
+        changes.append("STOPSIGNAL %s" % config["StopSignal"])
+    if config.get("Entrypoint"):
+        changes.append("ENTRYPOINT %s" % json.dumps(config["Entrypoint"]))
+    if config.get("Cmd"):
+        changes.append("CMD %s" % json.dumps(config["Cmd"]))
+    return changes
+
+
 # Main class
 
 
+# The streaming Docker API call running in this thread, if any
+docker_streams = threading.local()
+docker_streams_lock = threading.Lock()
+
+
+def record_docker_response(response, **kwargs):
+    """requests hook handing the responses of streaming calls to stop()"""
+    stream = getattr(docker_streams, "current", None)
+    if stream is not None:
+        kbx, responses = stream
+        responses.append(response)
+        kbx.add_response(response)
+    return response
+
+
+def abort_docker_response(response):
+    """Shut the connection of a streaming Docker response down
+
+    Unlike closing it, this wakes a thread blocked reading it up, and
+    Docker stops the build or push when the client goes away.
+    """
+    try:
+        response.raw._fp.fp.raw._sock.shutdown(socket.SHUT_RDWR)
+    except (AttributeError, OSError):
+        response.close()
+
+
 class Kaboxer:
-    def __init__(self):
+    def __init__(self, docker_conn=None):
         self.parser = argparse.ArgumentParser(prog="kaboxer")
         self.parser.add_argument(
             "-v", "--verbose", action="count", default=0, help="increase verbosity"
@@ -210,10 +351,51 @@ class Kaboxer:
             action="store_true",
             help="push container image to registry after build",
         )
-        parser_build.add_argument("--version", help="app version")
+        parser_build_version = parser_build.add_mutually_exclusive_group()
+        parser_build_version.add_argument("--version", help="app version")
+        parser_build_version.add_argument(
+            "--versions",
+            type=lambda x: [v.strip() for v in x.split(",") if v.strip()],
+            help="comma-separated list of app versions to build concurrently",
+        )
         parser_build.add_argument(
             "--ignore-version", action="store_true", help="ignore version checks"
         )
+        parser_build.add_argument(
+            "--cache-import",
+            metavar="DIR",
+            help="reuse the build cache exported to this directory",
+        )
+        parser_build.add_argument(
+            "--cache-export",
+            metavar="DIR",
+            help="export the build cache to this directory",
+        )
+        parser_build.add_argument(
+            "--reproducible",
+            action="store_true",
+            help="normalize the metadata layers (honors SOURCE_DATE_EPOCH)",
+        )
+        parser_build.add_argument(
+            "--squash",
+            nargs="?",
+            const="kaboxer",
+            choices=["kaboxer", "all"],
+            help="squash the layers added by kaboxer, or the whole image",
+        )
+        parser_build.add_argument(
+            "--memory",
+            type=parse_size,
+            help="memory limit of the build containers (e.g. 2g)",
+        )
+        parser_build.add_argument(
+            "--cpu-shares", type=int, help="CPU shares of the build containers"
+        )
+        parser_build.add_argument(
+            "--cpuset-cpus",
+            metavar="CPUS",
+            help="CPUs the build containers can use (e.g. 0-3)",
+        )
         parser_build.add_argument("app", nargs="?")
         parser_build.add_argument("path", nargs="?", default=os.getcwd())
         parser_build.set_defaults(func=self.cmd_build)
@@ -270,6 +452,18 @@ class Kaboxer:
         self.backend = DockerBackend()
         self.registry = ContainerRegistry()
 
+        if docker_conn is not None:
+            self._docker_conn = docker_conn
+        self.argv = sys.argv
+        self.build_id = os.environ.get("KABOXER_BUILD_ID")
+        # Set when used as a library, by build_app() or push_app()
+        self.in_process = False
+        self.stopping = threading.Event()
+        self.responses_lock = threading.Lock()
+        self.responses = set()
+        self.built = []
+        self.pushed = []
+
     def setup_logging(self):
         loglevels = {
             0: "ERROR",
@@ -337,6 +531,93 @@ class Kaboxer:
             logger.error(msg)
             sys.exit(1)
 
+    def build_app(self, app, path, options=()):
+        """Build app in path in-process, as kaboxer build would
+
+        options are command-line options of kaboxer build. Returns a list
+        with a dict per image built: app, version, image_id and profile.
+        """
+        self.argv = ["kaboxer", "build"] + list(options) + [app, path]
+        self.args = self.parser.parse_args(self.argv[1:])
+        self.in_process = True
+        self.built = []
+        self.cmd_build()
+        return self.built
+
+    def push_app(self, app, path, version=None):
+        """Push the image of app in-process, returns the tags pushed"""
+        self.argv = ["kaboxer", "push", app, path]
+        if version:
+            self.argv += ["--version", version]
+        self.args = self.parser.parse_args(self.argv[1:])
+        self.in_process = True
+        self.pushed = []
+        self.cmd_push()
+        return self.pushed
+
+    def report(self, message):
+        """Show a report about a build
+
+        In-process, it's logged instead, so that under kbxbuilder it goes
+        to the log of the app rather than to the shared stdout.
+        """
+        if self.in_process:
+            logger.info(message)
+        else:
+            print(message)
+
+    def stop(self):
+        """Stop a build or push running in another thread
+
+        The running Docker builds and pushes are aborted right away, even
+        if they don't output anything.
+        """
+        self.stopping.set()
+        with self.responses_lock:
+            responses = list(self.responses)
+        for response in responses:
+            abort_docker_response(response)
+
+    def add_response(self, response):
+        with self.responses_lock:
+            self.responses.add(response)
+        if self.stopping.is_set():
+            abort_docker_response(response)
+
+    def docker_stream(self, call, *args, **kwargs):
+        """Iterate over the output of a streaming Docker API call
+
+        Stops with check_stopped() once stop() is called: stop() aborts
+        the HTTP response, which a requests hook records.
+        """
+        api = self.docker_conn.api
+        with docker_streams_lock:
+            if record_docker_response not in api.hooks["response"]:
+                api.hooks["response"].append(record_docker_response)
+        responses = []
+        docker_streams.current = (self, responses)
+        try:
+            chunks = call(*args, **kwargs)
+        finally:
+            docker_streams.current = None
+        try:
+            for chunk in chunks:
+                self.check_stopped()
+                yield chunk
+        except Exception:
+            # Reading an aborted response fails
+            self.check_stopped()
+            raise
+        finally:
+            with self.responses_lock:
+                self.responses.difference_update(responses)
+        self.check_stopped()
+
+    def check_stopped(self):
+        if self.stopping.is_set():
+            logger.error("Stopping as requested")
+            sys.exit(1)
+
     def show_exception_in_debug_mode(self):
         if self.args.verbose >= 2:
             logger.exception("The following exception was caught")
@@ -771,16 +1052,87 @@ class Kaboxer:
         parsed_configs = self.find_configs_for_build_cmds()
         for config in parsed_configs:
             if not self.args.skip_image_build:
-                image, saved_version = self.build_image(config)
-                if self.args.save:
-                    tarball = os.path.join(self.args.path, config.app_id + ".tar")
-                    self.save_image_to_file(image, tarball)
-                if self.args.push:
-                    self.push_image(config, [saved_version])
+                versions = self.get_versions_to_build(config)
+                if len(versions) > 1:
+                    if self.args.save:
+                        logger.error("Can't save images when building several versions")
+                        sys.exit(1)
+                    saved_versions = self.build_image_versions(config, versions)
+                    if self.args.push:
+                        self.push_image(config, saved_versions)
+                else:
+                    image, saved_version = self.build_image(config, versions[0])
+                    if self.args.save:
+                        tarball = os.path.join(self.args.path, config.app_id + ".tar")
+                        self.save_image_to_file(image, tarball)
+                    if self.args.push:
+                        self.push_image(config, [saved_version])
             self.build_cli_helpers(config)
             self.build_desktop_files(config)
 
-    def build_image(self, parsed_config):
+    def get_versions_to_build(self, parsed_config):
+        """Upstream versions to build, None meaning "unspecified"
+
+        Versions come from the command line if given, otherwise from the
+        build:versions list in kaboxer.yaml.
+        """
+        if self.args.versions:
+            return self.args.versions
+        if self.args.version:
+            return [self.args.version]
+        versions = parsed_config.get("build:versions")
+        if versions:
+            return [str(v) for v in versions]
+        return [None]
+
+    def build_image_versions(self, parsed_config, versions):
+        """Build several upstream versions of an app concurrently
+
+        Builds share the layers of the base image. Each version gets its
+        own version checks and tags, and 'latest' (if not already there)
+        goes to the highest version.
+
+        Returns: the list of versions built.
+        """
+        app = parsed_config.app_id
+        logger.info("Building versions %s of %s", ", ".join(versions), app)
+        max_workers = min(len(versions), os.cpu_count() or 1)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as ex:
+            # Each build runs in a copy of the caller's context, so that
+            # context variables (such as the app of kbxbuilder logs) follow
+            futures = {
+                v: ex.submit(
+                    contextvars.copy_context().run,
+                    self.build_image,
+                    parsed_config,
+                    v,
+                    tag_latest=False,
+                )
+                for v in versions
+            }
+        built = {}
+        failed = []
+        for version, future in futures.items():
+            try:
+                built[version] = future.result()
+            except (Exception, SystemExit):
+                # build_image() logs the error before exiting
+                logger.debug("Build of version %s failed", version, exc_info=1)
+                failed.append(version)
+        if failed:
+            logger.error("Failed to build %s version(s) %s", app, ", ".join(failed))
+            sys.exit(1)
+        tagname = "kaboxer/%s:latest" % (app,)
+        if not self.find_image(tagname):
+            saved_versions = [saved_version for _, saved_version in built.values()]
+            maxversion = max(saved_versions, key=parse_version)
+            for image, saved_version in built.values():
+                if saved_version == maxversion:
+                    image.tag(tagname)
+                    break
+        return [saved_version for _, saved_version in built.values()]
+
+    def build_image(self, parsed_config, version=None, tag_latest=True):
         path = self.args.path
         app = parsed_config.app_id
         logger.info("Building container image for %s", app)
@@ -789,28 +1141,43 @@ class Kaboxer:
         except KeyError:
             df = os.path.join(path, "Dockerfile")
         try:
-            buildargs = parsed_config["build"]["docker"]["parameters"]
+            # Copy, as concurrent builds get different parameters
+            buildargs = dict(parsed_config["build"]["docker"]["parameters"])
         except KeyError:
             buildargs = {}
-        if self.args.version:
+        if version:
             if not self.args.ignore_version:
                 try:
-                    self.do_version_checks(self.args.version, parsed_config)
+                    self.do_version_checks(version, parsed_config)
                 except Exception as e:
                     message = str(e)
                     logger.error(message)
                     sys.exit(1)
-            buildargs["KBX_APP_VERSION"] = self.args.version
+            buildargs["KBX_APP_VERSION"] = version
+        reproducible = self.args.reproducible or parsed_config.get(
+            "build:docker:reproducible", False
+        )
+        mtime = None
+        if reproducible:
+            mtime = get_source_date_epoch()
+            buildargs.setdefault("SOURCE_DATE_EPOCH", str(mtime))
+        cache_from = []
+        if self.args.cache_import:
+            cache_from = self.import_build_cache(self.args.cache_import, app)
+        profiler = BuildProfiler()
         try:
-            (image, _) = self.docker_conn.images.build(
+            image = self.docker_build(
+                profiler,
                 path=path,
                 dockerfile=df,
                 rm=True,
                 forcerm=True,
-                nocache=True,
+                nocache=not cache_from,
+                cache_from=cache_from or None,
                 pull=True,
                 quiet=False,
                 buildargs=buildargs,
+                container_limits=self.get_build_container_limits(),
             )
         except docker.errors.BuildError as exc:
             logger.error("Failed to build image, see below for the build logs:")
@@ -823,10 +1190,18 @@ class Kaboxer:
             logger.error(" ".join(log_lines))
             logger.error("--------")
             sys.exit(1)
-        with tempfile.NamedTemporaryFile(mode="w+t") as tmp:
+        if self.args.cache_export:
+            self.export_build_cache(self.args.cache_export, app, image)
+        self.check_stopped()
+        profiler.start("metadata injection")
+        squash = self.args.squash or parsed_config.get("build:docker:squash")
+        if squash is True:
+            squash = "kaboxer"
+        with tempfile.TemporaryDirectory(prefix="kaboxer-meta") as td:
+            version_file = os.path.join(td, "version")
             try:
-                self.extract_file_from_image(image, "/kaboxer/version", tmp.name)
-                saved_version = open(tmp.name).readline().strip()
+                self.extract_file_from_image(image, "/kaboxer/version", version_file)
+                saved_version = open(version_file).readline().strip()
                 if not self.args.ignore_version:
                     try:
                         self.do_version_checks(saved_version, parsed_config)
@@ -836,48 +1211,237 @@ class Kaboxer:
                         logger.error(message)
                         sys.exit(1)
             except Exception:
-                if self.args.version:
-                    saved_version = self.args.version
-                    tmp.write(self.args.version)
+                if version:
+                    saved_version = version
+                    with open(version_file, "w") as f:
+                        f.write(version)
                 else:
                     logger.error("Unable to determine version (use --version?)")
                     self.docker_conn.images.remove(image=image.id)
                     sys.exit(1)
-            tmp.flush()
-            image = self.inject_file_into_image(image, tmp.name, "/kaboxer/version")
-        with tempfile.NamedTemporaryFile(mode="w+t") as tmp:
-            tmp.write(str(parsed_config["packaging"]["revision"]) + "\n")
-            tmp.flush()
-            image = self.inject_file_into_image(
-                image, tmp.name, "/kaboxer/packaging-revision"
-            )
-        with tempfile.NamedTemporaryFile(mode="w+t") as tmp:
-            tmp.write(yaml.dump(sys.argv))
-            tmp.flush()
-            image = self.inject_file_into_image(
-                image, tmp.name, "/kaboxer/kaboxer-build-cmd"
-            )
-        image = self.inject_file_into_image(image, df, "/kaboxer/Dockerfile")
-        with tempfile.NamedTemporaryFile(mode="w+t") as tmp:
-            savedbuildargs = {
-                "rm": True,
-                "forcerm": True,
-                "path": path,
-                "dockerfile": df,
-                "buildargs": buildargs,
-            }
-            tmp.write(yaml.dump(savedbuildargs))
-            tmp.flush()
-            image = self.inject_file_into_image(
-                image, tmp.name, "/kaboxer/docker-build-parameters"
+            meta_files = [(version_file, "/kaboxer/version")]
+            revision_file = os.path.join(td, "packaging-revision")
+            with open(revision_file, "w") as f:
+                f.write(str(parsed_config["packaging"]["revision"]) + "\n")
+            meta_files.append((revision_file, "/kaboxer/packaging-revision"))
+            build_cmd = self.argv
+            if reproducible:
+                # No absolute paths, they depend on the build machine
+                build_cmd = [os.path.basename(self.argv[0])] + [
+                    os.path.relpath(a, path) if os.path.isabs(a) else a
+                    for a in self.argv[1:]
+                ]
+            build_cmd_file = os.path.join(td, "kaboxer-build-cmd")
+            with open(build_cmd_file, "w") as f:
+                f.write(yaml.dump(build_cmd))
+            meta_files.append((build_cmd_file, "/kaboxer/kaboxer-build-cmd"))
+            meta_files.append((df, "/kaboxer/Dockerfile"))
+            build_params_file = os.path.join(td, "docker-build-parameters")
+            with open(build_params_file, "w") as f:
+                savedbuildargs = {
+                    "rm": True,
+                    "forcerm": True,
+                    "path": path,
+                    "dockerfile": df,
+                    "buildargs": buildargs,
+                }
+                if reproducible:
+                    savedbuildargs["path"] = "."
+                    savedbuildargs["dockerfile"] = os.path.relpath(df, path)
+                f.write(yaml.dump(savedbuildargs))
+            meta_files.append((build_params_file, "/kaboxer/docker-build-parameters"))
+            if not squash:
+                for outfile, infile in meta_files:
+                    image = self.inject_file_into_image(
+                        image, outfile, infile, mtime=mtime
+                    )
+                meta_files = []
+
+            def add_profile():
+                """Stop the profiler, returns the profile to inject"""
+                profiler.stop()
+                # Timings differ from one build to another, they can't be
+                # part of a reproducible image.
+                if reproducible:
+                    return []
+                profile_file = os.path.join(td, "build-profile.json")
+                with open(profile_file, "w") as f:
+                    json.dump(profiler.get_profile(), f, indent=2)
+                meta_files.append((profile_file, "/kaboxer/build-profile.json"))
+                return meta_files[-1:]
+
+            if not squash:
+                profile_files = add_profile()
+                if profile_files:
+                    image = self.inject_files_into_image(
+                        image, profile_files, mtime=mtime
+                    )
+            else:
+                # One single layer for all the metadata files; the profile
+                # is added last, so that it times copying the others
+                before = describe_image(image)
+                image = self.inject_files_into_image(
+                    image, list(meta_files), mtime=mtime, late_files=add_profile
+                )
+                if squash == "kaboxer":
+                    after = describe_image(image)
+                    self.report(
+                        "Squashed %d metadata layers into one for %s: "
+                        "%d layers, %s -> %d layers, %s"
+                        % (
+                            len(meta_files),
+                            app,
+                            before[0],
+                            format_size(before[1]),
+                            after[0],
+                            format_size(after[1]),
+                        )
+                    )
+            profile = profiler.get_profile()
+        # In-process, the caller gets the profile with the build result
+        if not self.in_process:
+            print("Build profile for %s:" % app)
+            print(format_build_profile(profile))
+        if squash == "all":
+            unsquashed = image
+            image = self.squash_image(unsquashed)
+            before = describe_image(unsquashed)
+            after = describe_image(image)
+            self.report(
+                "Squashed image for %s: %d layers, %s -> %d layers, %s"
+                % (
+                    app,
+                    before[0],
+                    format_size(before[1]),
+                    after[0],
+                    format_size(after[1]),
+                )
             )
+            try:
+                self.docker_conn.images.remove(image=unsquashed.id)
+            except docker.errors.APIError:
+                logger.debug("Could not remove unsquashed image", exc_info=1)
         tagname = "kaboxer/%s:%s" % (app, str(saved_version))
         image.tag(tagname)
         tagname = "kaboxer/%s:latest" % (app,)
-        if not self.find_image(tagname):
+        if tag_latest and not self.find_image(tagname):
             image.tag(tagname)
+        self.built.append(
+            {
+                "app": app,
+                "version": str(saved_version),
+                "image_id": image.id,
+                "profile": profile,
+            }
+        )
         return image, saved_version
 
+    def get_build_cache_tag(self, app):
+        return "kaboxer-cache/%s:latest" % app
+
+    def import_build_cache(self, cache_dir, app):
+        """Load the build cache of an app from a directory
+
+        The cache is an image saved with 'docker save'. It's not loaded
+        again if it's already present in the local docker daemon.
+
+        Returns: the list of images to use as cache sources.
+        """
+        tarball = os.path.join(cache_dir, app + ".tar")
+        if not os.path.isfile(tarball):
+            logger.info("No build cache for %s in %s", app, cache_dir)
+            return []
+        try:
+            with tarfile.open(tarball) as tf:
+                manifest = json.loads(tf.extractfile("manifest.json").read())
+            image_id = get_image_id_from_manifest(manifest)
+        except (tarfile.TarError, KeyError, IndexError, ValueError):
+            logger.warning("Invalid build cache %s, ignoring", tarball, exc_info=1)
+            return []
+        tag = self.get_build_cache_tag(app)
+        try:
+            image = self.docker_conn.images.get(image_id)
+            logger.info("Build cache for %s already loaded", app)
+        except docker.errors.ImageNotFound:
+            logger.info("Loading build cache for %s from %s", app, tarball)
+            with open(tarball, "rb") as f:
+                image = self.docker_conn.images.load(f)[0]
+        image.tag(tag)
+        return [tag]
+
+    def export_build_cache(self, cache_dir, app, image):
+        """Save an image, with its history, as the build cache of an app
+
+        The file is replaced atomically, so that the cache directory can
+        be synchronized or shared between build nodes at any time.
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        tarball = os.path.join(cache_dir, app + ".tar")
+        tag = self.get_build_cache_tag(app)
+        image.tag(tag)
+        logger.info("Exporting build cache for %s to %s", app, tarball)
+        with tempfile.NamedTemporaryFile(
+            dir=cache_dir, prefix="." + app, suffix=".tar", delete=False
+        ) as f:
+            try:
+                for chunk in self.docker_conn.api.get_image(tag):
+                    f.write(chunk)
+            except Exception:
+                os.unlink(f.name)
+                raise
+        os.replace(f.name, tarball)
+
+    def get_build_container_limits(self):
+        """Resource limits of the containers running the Dockerfile steps"""
+        limits = {}
+        if self.args.memory:
+            limits["memory"] = self.args.memory
+            # Forbid the use of swap on top of the memory limit
+            limits["memswap"] = self.args.memory
+        if self.args.cpu_shares:
+            limits["cpushares"] = self.args.cpu_shares
+        if self.args.cpuset_cpus:
+            limits["cpusetcpus"] = self.args.cpuset_cpus
+        return limits or None
+
+    def get_temp_container_labels(self):
+        """Labels of the temporary containers created during a build
+
+        kbxbuilder sets a build ID (KABOXER_BUILD_ID in the environment)
+        so that it can find and remove the containers left behind by a
+        build it had to stop.
+        """
+        if self.build_id:
+            return {"kaboxer.build-id": self.build_id}
+        return {}
+
+    def docker_build(self, profiler, **kwargs):
+        """Build an image, recording timings from the build output
+
+        This is the same as docker.models.images.ImageCollection.build(),
+        except that the build output is fed to the profiler as it arrives.
+        """
+        build_log = []
+        image_id = None
+        for chunk in self.docker_stream(
+            self.docker_conn.api.build, decode=True, **kwargs
+        ):
+            profiler.feed(chunk)
+            build_log.append(chunk)
+            if "error" in chunk:
+                raise docker.errors.BuildError(chunk["error"], build_log)
+            if "stream" in chunk:
+                match = re.search(
+                    r"(^Successfully built |sha256:)([0-9a-f]+)$", chunk["stream"]
+                )
+                if match:
+                    image_id = match.group(2)
+        profiler.stop()
+        if not image_id:
+            last_event = build_log[-1] if build_log else "Unknown"
+            raise docker.errors.BuildError(last_event, build_log)
+        return self.docker_conn.images.get(image_id)
+
     def build_cli_helpers(self, parsed_config):
         app = parsed_config.app_id
         if "cli-helpers" not in parsed_config.get("install", {}):
@@ -901,8 +1465,9 @@ class Kaboxer:
         for config in parsed_configs:
             self.push_image(config)
 
-    def push_image(self, parsed_config, versions=[]):
+    def push_image(self, parsed_config, versions=None):
         app = parsed_config.app_id
+        versions = list(versions or [])
         logger.info("Pushing %s", app)
 
         # Get the image names
@@ -946,7 +1511,8 @@ class Kaboxer:
             saved_version = self.extract_version_from_image(local_image)
             remote_tagname = "%s:%s" % (remotename, saved_version)
             local_image.tag(remote_tagname)
-            self.docker_conn.images.push(remote_tagname)
+            self.docker_push(remote_tagname)
+            self.pushed.append(remote_tagname)
 
         # Update remote latest tag if needed
         local_tagname = "%s:latest" % localname
@@ -967,7 +1533,21 @@ class Kaboxer:
 
         if must_update:
             local_image.tag(remote_tagname)
-            self.docker_conn.images.push(remote_tagname)
+            self.docker_push(remote_tagname)
+            self.pushed.append(remote_tagname)
+
+    def docker_push(self, name):
+        """Push an image, as docker.models.images.ImageCollection.push()
+
+        Exits if the registry reports an error in the push output.
+        """
+        self.check_stopped()
+        for chunk in self.docker_stream(
+            self.docker_conn.api.push, name, stream=True, decode=True
+        ):
+            if "error" in chunk:
+                logger.error("Failed to push %s: %s", name, chunk["error"])
+                sys.exit(1)
 
     def make_run_command(self, app_id, component):
         return f"kaboxer run --component {component} {app_id}"
@@ -1213,7 +1793,9 @@ Categories={categories}
     def extract_file_from_image(self, image, infile, outfile):
         temp_container = None
         try:
-            temp_container = self.docker_conn.containers.create(image)
+            temp_container = self.docker_conn.containers.create(
+                image, labels=self.get_temp_container_labels()
+            )
             (bits, stat) = temp_container.get_archive(infile)
             with tempfile.TemporaryFile() as temptar:
                 for chunk in bits:
@@ -1252,32 +1834,57 @@ Categories={categories}
             v = str(open(tmp.name).read())
             return v
 
-    def inject_file_into_image(self, image, outfile, infile):
-        temp_container = self.docker_conn.containers.create(image)
-        with tempfile.TemporaryFile() as temptar:
-            tf = tarfile.open(fileobj=temptar, mode="w")
-            (dirname, filename) = os.path.split(infile)
-            p = pathlib.Path(dirname)
-            for parent in reversed(p.parents):
-                ti = tarfile.TarInfo(name=str(parent))
-                ti.type = tarfile.DIRTYPE
-                tf.addfile(ti)
-            ti = tarfile.TarInfo(name=infile)
-            ti.size = os.stat(outfile).st_size
-            tf.addfile(ti, fileobj=open(outfile, mode="rb"))
-            tf.close()
-            temptar.seek(0)
-            buf = b""
-            while True:
-                b = temptar.read()
-                if not b:
-                    break
-                buf += b
-            temp_container.put_archive("/", buf)
+    def inject_file_into_image(self, image, outfile, infile, mtime=None):
+        return self.inject_files_into_image(image, [(outfile, infile)], mtime=mtime)
+
+    def inject_files_into_image(self, image, files, mtime=None, late_files=None):
+        """Inject host files into an image, as a single new layer
+
+        'files' is a list of (host path, path in image) tuples. See
+        write_injection_tarball() regarding 'mtime'. 'late_files', if
+        given, is called once 'files' are copied, and returns more files
+        to add to the same layer.
+        """
+        temp_container = self.docker_conn.containers.create(
+            image, labels=self.get_temp_container_labels()
+        )
+        self.put_files_into_container(temp_container, files, mtime)
+        if late_files is not None:
+            self.put_files_into_container(temp_container, late_files(), mtime)
         image = temp_container.commit()
         temp_container.remove()
         return image
 
+    def put_files_into_container(self, container, files, mtime=None):
+        if not files:
+            return
+        with tempfile.TemporaryFile() as temptar:
+            write_injection_tarball(temptar, files, mtime=mtime)
+            temptar.seek(0)
+            container.put_archive("/", temptar.read())
+
+    def squash_image(self, image):
+        """Flatten an image into a single layer
+
+        The image filesystem is exported then imported back, and the image
+        configuration (environment, entrypoint, etc.) is restored.
+        """
+        logger.info("Squashing image %s", image.short_id)
+        changes = get_image_config_changes(image.attrs["Config"])
+        temp_container = self.docker_conn.containers.create(
+            image, labels=self.get_temp_container_labels()
+        )
+        try:
+            with tempfile.TemporaryFile() as temptar:
+                for chunk in temp_container.export():
+                    temptar.write(chunk)
+                temptar.seek(0)
+                result = self.docker_conn.api.import_image(src=temptar, changes=changes)
+        finally:
+            temp_container.remove()
+        image_id = json.loads(result.strip().splitlines()[-1])["status"]
+        return self.docker_conn.images.get(image_id)
+
     def cmd_save(self):
         images = self.docker_conn.images.list()
         for image in images:
@@ -1357,9 +1964,23 @@ Categories={categories}
             )
 
     def docker_pull(self, full_image_name, stop_on_error=False):
+        """Pull an image, as docker.models.images.ImageCollection.pull()
+
+        The pull goes through docker_stream(), so that stop() aborts it.
+        """
         logger.info("Pulling %s image from registry", full_image_name)
+        repository, tag = docker.utils.parse_repository_tag(full_image_name)
         try:
-            image = self.docker_conn.images.pull(full_image_name)
+            for chunk in self.docker_stream(
+                self.docker_conn.api.pull,
+                repository,
+                tag=tag or "latest",
+                stream=True,
+                decode=True,
+            ):
+                if "error" in chunk:
+                    raise docker.errors.APIError(chunk["error"])
+            image = self.docker_conn.images.get(full_image_name)
             return image
         except docker.errors.APIError:
             logger.exception("Could not pull %s, wrong URL?", full_image_name)
@@ -1887,6 +2508,101 @@ Categories={categories}
             sys.exit(1)
 
 
+def get_image_id_from_manifest(manifest):
+    """Get the image id from the manifest.json of a 'docker save' tarball
+
+    The config blob is '<id>.json' in the legacy format, and
+    'blobs/sha256/<id>' in the OCI layout.
+    """
+    config = os.path.basename(manifest[0]["Config"])
+    if config.endswith(".json"):
+        config = config[: -len(".json")]
+    return "sha256:" + config
+
+
+def format_build_profile(profile):
+    """Format a build profile as a table, most expensive stages first"""
+    rows = [
+        (step["name"] + (" (cached)" if step["cached"] else ""), step["duration"])
+        for step in profile["steps"]
+    ]
+    if profile.get("pull"):
+        rows.append(("(base image pull, part of the FROM step)", profile["pull"]))
+    rows.sort(key=lambda x: x[1], reverse=True)
+    total = profile["total"] or 1
+    table = [
+        (name, "%.1fs" % duration, "%d%%" % (100 * duration / total))
+        for name, duration in rows
+    ]
+    table.append(("Total", "%.1fs" % profile["total"], ""))
+    return tabulate.tabulate(
+        table, headers=["Stage", "Duration", "Share"], disable_numparse=True
+    )
+
+
+class BuildProfiler:
+    """Record the wall-time of the stages of an image build
+
+    Stages are started explicitly with start(), or implicitly when the
+    Docker build output announces a new Dockerfile step. Pulling the base
+    image happens during the FROM step; it's accounted separately as well.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.steps = []
+        self.current = None
+        self.pull_start = None
+        self.pull_end = None
+
+    def start(self, name):
+        now = self.clock()
+        self.stop(now)
+        self.current = {"name": name, "start": now, "cached": False}
+
+    def stop(self, now=None):
+        if self.current is None:
+            return
+        if now is None:
+            now = self.clock()
+        duration = round(now - self.current["start"], 3)
+        self.steps.append(
+            {
+                "name": self.current["name"],
+                "duration": duration,
+                "cached": self.current["cached"],
+            }
+        )
+        self.current = None
+
+    def feed(self, event):
+        """Feed an event from the Docker build output"""
+        if "stream" in event:
+            m = re.match(r"Step \d+/\d+ : .*", event["stream"].strip())
+            if m:
+                self.start(m.group(0))
+            elif "Using cache" in event["stream"] and self.current is not None:
+                self.current["cached"] = True
+        elif "status" in event and self.current is not None:
+            now = self.clock()
+            if self.pull_start is None:
+                self.pull_start = now
+            self.pull_end = now
+
+    def get_profile(self):
+        pull = 0
+        if self.pull_start is not None:
+            pull = round(self.pull_end - self.pull_start, 3)
+        total = round(sum(s["duration"] for s in self.steps), 3)
+        return {"steps": list(self.steps), "pull": pull, "total": total}
+
+
+def describe_image(image):
+    """Return the number of layers and the size of an image"""
+    layers = image.attrs.get("RootFS", {}).get("Layers", [])
+    return len(layers), image.attrs.get("Size", 0)
+
+
 class KaboxerAppConfig:
     def __init__(self, config=None, filename=None):
         if config is not None:
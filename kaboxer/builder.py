@@ -1,24 +1,1255 @@
 #! /usr/bin/python3
 
 import argparse
-import email
+import concurrent.futures
+import contextlib
+import contextvars
+import datetime
+import email.message
+import glob
+import gzip
+import hashlib
+import heapq
+import hmac
+import http.server
+import json
 import logging
 import os
+import queue
 import re
+import shutil
+import signal
 import smtplib
+import socket
+import socketserver
+import sqlite3
+import statistics
 import subprocess
 import sys
+import tempfile
+import threading
 import time
+import urllib.parse
+import uuid
+
+import docker
 
 import git
 
 import jinja2
 
+import tabulate
+
 import yaml
 
+import kaboxer
+
 logger = logging.getLogger("kbxbuilder")
 
 
+def find_cycle(graph):
+    """Return a list of nodes forming a cycle in graph, or None
+
+    graph maps each node to the list of nodes it depends on; nodes that
+    don't appear as keys are ignored.
+    """
+    visited = set()
+
+    def visit(node, path):
+        if node in path:
+            return path[path.index(node) :] + [node]
+        if node in visited or node not in graph:
+            return None
+        visited.add(node)
+        for dep in graph[node]:
+            cycle = visit(dep, path + [node])
+            if cycle:
+                return cycle
+        return None
+
+    for node in graph:
+        cycle = visit(node, [])
+        if cycle:
+            return cycle
+    return None
+
+
+def get_remote_revid(git_url, ref):
+    """Return the revid that ref points to in a remote repository
+
+    This only runs "git ls-remote", which is much cheaper than a fetch.
+    Returns None if the reference can't be resolved that way (it may be
+    an abbreviated revid, or the remote may be unreachable).
+    """
+    if re.fullmatch("[0-9a-f]{40}", ref):
+        return ref
+    try:
+        output = git.cmd.Git().ls_remote(git_url, ref, ref + "^{}")
+    except git.exc.GitCommandError:
+        return None
+    refs = {}
+    for line in output.splitlines():
+        revid, name = line.split("\t", 1)
+        refs[name] = revid
+    # Annotated tags are peeled to the commit they point to
+    for name in ("refs/heads/" + ref, "refs/tags/" + ref + "^{}", "refs/tags/" + ref):
+        if name in refs:
+            return refs[name]
+    return refs.get(ref)
+
+
+def toposort(graph):
+    """Return the nodes of an acyclic graph, dependencies first
+
+    graph maps each node to the list of nodes it depends on.
+    """
+    order = []
+    visited = set()
+
+    def visit(node):
+        if node in visited or node not in graph:
+            return
+        visited.add(node)
+        for dep in graph[node]:
+            visit(dep)
+        order.append(node)
+
+    for node in graph:
+        visit(node)
+    return order
+
+
+def get_template_references(ast, name):
+    """Return the keys looked up in variable name by a parsed template
+
+    config['a']['b'] and config.a.b both give ("a", "b"). A lookup with a
+    non-constant key only counts up to that key, and a bare use of the
+    variable gives ().
+    """
+    lookups = list(
+        ast.find_all((jinja2.nodes.Getitem, jinja2.nodes.Getattr, jinja2.nodes.Name))
+    )
+    inner = {id(node.node) for node in lookups if hasattr(node, "node")}
+    refs = set()
+    for node in lookups:
+        if id(node) in inner:
+            continue
+        path = []
+        while isinstance(node, (jinja2.nodes.Getitem, jinja2.nodes.Getattr)):
+            if isinstance(node, jinja2.nodes.Getattr):
+                path.insert(0, node.attr)
+            elif isinstance(node.arg, jinja2.nodes.Const):
+                path.insert(0, node.arg.value)
+            else:
+                path = []
+            node = node.node
+        if isinstance(node, jinja2.nodes.Name) and node.name == name:
+            refs.add(tuple(path))
+    return refs
+
+
+def kill_process_group(proc, grace=10):
+    """Kill a process started in a new session, and all its children
+
+    The processes get SIGTERM first, then SIGKILL after grace seconds.
+    """
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    try:
+        proc.wait(timeout=grace)
+    except subprocess.TimeoutExpired:
+        pass
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    proc.wait()
+
+
+def is_watched(path, watched_paths):
+    """Whether path is one of watched_paths or inside one of them"""
+    for watched in watched_paths:
+        watched = watched.rstrip("/")
+        if watched in ("", ".") or path == watched or path.startswith(watched + "/"):
+            return True
+    return False
+
+
+def get_base_images(dockerfile, buildargs=None):
+    """Return the images a Dockerfile builds FROM
+
+    Build args declared before the first FROM are substituted, with
+    their values from buildargs or their defaults. Build stages, scratch
+    and images depending on an undefined build arg are left out.
+    """
+    buildargs = buildargs or {}
+    args = {}
+    stages = set()
+    images = []
+    seen_from = False
+
+    def substitute(match):
+        name = match.group(1) or match.group(2)
+        if args.get(name) is None:
+            raise KeyError(name)
+        return args[name]
+
+    for line in re.sub(r"\\\n", " ", dockerfile).splitlines():
+        words = line.split()
+        if not words or words[0].startswith("#"):
+            continue
+        instruction = words[0].upper()
+        if instruction == "ARG" and not seen_from:
+            for word in words[1:]:
+                name, equal, default = word.partition("=")
+                if name in buildargs:
+                    args[name] = str(buildargs[name])
+                elif equal:
+                    args[name] = default.strip("\"'")
+                else:
+                    args[name] = None
+        elif instruction == "FROM":
+            seen_from = True
+            words = [word for word in words[1:] if not word.startswith("--")]
+            if not words:
+                continue
+            try:
+                image = re.sub(r"\$(?:\{(\w+)\}|(\w+))", substitute, words[0])
+            except KeyError:
+                image = None
+            if image and image.lower() not in stages | {"scratch"}:
+                if image not in images:
+                    images.append(image)
+            if len(words) >= 3 and words[1].upper() == "AS":
+                stages.add(words[2].lower())
+    return images
+
+
+class BuildHistory:
+    """History of the builds, stored in a SQLite database
+
+    Each build is one row, indexed by app and time, so that recording a
+    build or looking up the last success or failure of an app doesn't
+    depend on the size of the history.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS builds (
+            id INTEGER PRIMARY KEY,
+            app TEXT NOT NULL,
+            time REAL NOT NULL,
+            tag TEXT,
+            revid TEXT,
+            status TEXT NOT NULL,
+            data TEXT NOT NULL DEFAULT '{}'
+        );
+        CREATE INDEX IF NOT EXISTS builds_app_time ON builds (app, time);
+        CREATE INDEX IF NOT EXISTS builds_app_status_time
+            ON builds (app, status, time);
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            action TEXT NOT NULL,
+            force INTEGER NOT NULL,
+            start_time REAL NOT NULL,
+            end_time REAL
+        );
+        CREATE TABLE IF NOT EXISTS run_apps (
+            run INTEGER NOT NULL REFERENCES runs (id),
+            app TEXT NOT NULL,
+            state TEXT NOT NULL,
+            revid TEXT,
+            outcome TEXT,
+            PRIMARY KEY (run, app)
+        );
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.executescript(self.SCHEMA)
+
+    def add(self, app, tag, revid, status, t=None, **data):
+        if t is None:
+            t = time.time()
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO builds (app, time, tag, revid, status, data)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (app, t, tag, revid, status, json.dumps(data)),
+            )
+
+    def to_item(self, row):
+        if row is None:
+            return None
+        item = json.loads(row["data"])
+        for key in ("time", "tag", "revid", "status"):
+            item[key] = row[key]
+        return item
+
+    def last(self, app, statuses):
+        """Return the last build of app with one of the given statuses"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT * FROM builds WHERE app = ? AND status IN (%s)"
+                " ORDER BY time DESC LIMIT 1" % (",".join("?" * len(statuses)),),
+                [app] + list(statuses),
+            ).fetchone()
+        return self.to_item(row)
+
+    def last_success(self, app):
+        return self.last(app, ["success"])
+
+    def last_failure(self, app):
+        # Skipped builds are recorded too, but they aren't failures
+        with self.lock:
+            row = self.db.execute(
+                "SELECT * FROM builds WHERE app = ?"
+                " AND status NOT IN ('success', 'skipped')"
+                " ORDER BY time DESC LIMIT 1",
+                (app,),
+            ).fetchone()
+        return self.to_item(row)
+
+    def get_builds(self, app, limit=None, since=None):
+        """Return the builds of an app, most recent first"""
+        query = "SELECT * FROM builds WHERE app = ?"
+        params = [app]
+        if since is not None:
+            query += " AND time >= ?"
+            params.append(since)
+        query += " ORDER BY time DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self.lock:
+            rows = self.db.execute(query, params).fetchall()
+        return [self.to_item(row) for row in rows]
+
+    def merge(self, app, builds):
+        """Add the builds of app that aren't in the history yet
+
+        builds are items as returned by get_builds(), for instance the
+        builds reported by a worker. Returns the number of added builds.
+        """
+        count = 0
+        with self.lock, self.db:
+            for item in builds:
+                item = dict(item)
+                t = item.pop("time")
+                if self.db.execute(
+                    "SELECT 1 FROM builds WHERE app = ? AND time = ?", (app, t)
+                ).fetchone():
+                    continue
+                row = [app, t] + [item.pop(k, None) for k in ("tag", "revid")]
+                row += [item.pop("status"), json.dumps(item)]
+                self.db.execute(
+                    "INSERT INTO builds (app, time, tag, revid, status, data)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    row,
+                )
+                count += 1
+        return count
+
+    def start_run(self, action, force, apps):
+        """Record the plan of a run, returns its ID
+
+        Runs left unfinished are superseded by the new one, and can no
+        longer be resumed.
+        """
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE runs SET end_time = ? WHERE end_time IS NULL", (time.time(),)
+            )
+            run = self.db.execute(
+                "INSERT INTO runs (action, force, start_time) VALUES (?, ?, ?)",
+                (action, force, time.time()),
+            ).lastrowid
+            self.db.executemany(
+                "INSERT INTO run_apps (run, app, state) VALUES (?, ?, 'pending')",
+                [(run, app) for app in apps],
+            )
+        return run
+
+    def set_run_app_state(self, run, app, state, revid=None, outcome=None):
+        """Record the progress of an app in a run
+
+        The state goes from "pending" to "checked out" (at revid) to "done".
+        """
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE run_apps SET state = ?, revid = COALESCE(?, revid),"
+                " outcome = ? WHERE run = ? AND app = ?",
+                (state, revid, outcome, run, app),
+            )
+
+    def finish_run(self, run):
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE runs SET end_time = ? WHERE id = ?", (time.time(), run)
+            )
+
+    def get_unfinished_run(self):
+        """Return the last run if it didn't finish, or None"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT * FROM runs ORDER BY id DESC LIMIT 1"
+            ).fetchone()
+        return dict(row) if row and row["end_time"] is None else None
+
+    def get_run_apps(self, run):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT app, state, revid, outcome FROM run_apps WHERE run = ?",
+                (run,),
+            ).fetchall()
+        return {row["app"]: dict(row) for row in rows}
+
+    def get_failure_streak(self, app):
+        """Return the number of failed builds since the last success"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT COUNT(*) FROM builds WHERE app = ?"
+                " AND status NOT IN ('success', 'skipped')"
+                " AND time > COALESCE((SELECT MAX(time) FROM builds"
+                " WHERE app = ? AND status = 'success'), 0)",
+                (app, app),
+            ).fetchone()
+        return row[0]
+
+    def import_yaml(self, path):
+        """Import the builds recorded in a status.yaml file"""
+        with open(path) as f:
+            status = yaml.safe_load(f) or {}
+        count = 0
+        with self.lock, self.db:
+            for app, entries in status.items():
+                for t, item in entries.items():
+                    # Skip the last_success/last_failure summaries
+                    if not isinstance(t, (int, float)):
+                        continue
+                    item = dict(item)
+                    row = [app, t] + [item.pop(k, None) for k in ("tag", "revid")]
+                    row += [item.pop("status", None) or "failure", json.dumps(item)]
+                    self.db.execute(
+                        "INSERT INTO builds (app, time, tag, revid, status, data)"
+                        " VALUES (?, ?, ?, ?, ?, ?)",
+                        row,
+                    )
+                    count += 1
+        return count
+
+
+class SharedJobQueue:
+    """Queue of builds shared by a coordinator and its workers
+
+    The queue is a SQLite database, which can live on a network file
+    system. A worker claims a job with a lease, which it renews while
+    the build runs; when a lease expires, the worker is deemed dead and
+    the job is handed out again, up to max_attempts times.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            app TEXT NOT NULL,
+            force INTEGER NOT NULL,
+            history TEXT NOT NULL DEFAULT '[]',
+            state TEXT NOT NULL DEFAULT 'pending',
+            worker TEXT,
+            lease_expires REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            cancelled INTEGER NOT NULL DEFAULT 0,
+            outcome TEXT,
+            duration REAL,
+            builds TEXT NOT NULL DEFAULT '[]',
+            log TEXT NOT NULL DEFAULT '',
+            queued_time REAL NOT NULL,
+            end_time REAL
+        );
+        CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);
+    """
+
+    def __init__(self, path, clock=time.time):
+        self.clock = clock
+        self.lock = threading.Lock()
+        # No WAL, it needs shared memory between the hosts
+        self.db = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.db.row_factory = sqlite3.Row
+        with self.lock:
+            self.db.executescript(self.SCHEMA)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def to_job(self, row):
+        if row is None:
+            return None
+        job = dict(row)
+        for key in ("history", "builds"):
+            job[key] = json.loads(job[key])
+        return job
+
+    def put(self, app, force, history=()):
+        """Queue a build of app, returns the ID of the job
+
+        history is the list of the last builds of the app, which the
+        worker needs to decide whether the build is needed.
+        """
+        with self.transaction():
+            return self.db.execute(
+                "INSERT INTO jobs (app, force, history, queued_time)"
+                " VALUES (?, ?, ?, ?)",
+                (app, force, json.dumps(list(history)), self.clock()),
+            ).lastrowid
+
+    def get(self, job_id):
+        with self.lock:
+            row = self.db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+            return self.to_job(row.fetchone())
+
+    def expire_leases(self, max_attempts):
+        """Hand out again the jobs of workers whose lease expired"""
+        with self.transaction():
+            self._expire_leases(max_attempts)
+
+    def _expire_leases(self, max_attempts):
+        now = self.clock()
+        expired = "state = 'claimed' AND lease_expires < ?"
+        self.db.execute(
+            "UPDATE jobs SET state = 'done', outcome = 'cancelled', end_time = ?"
+            " WHERE %s AND cancelled" % (expired,),
+            (now, now),
+        )
+        self.db.execute(
+            "UPDATE jobs SET state = 'done', outcome = 'error', end_time = ?,"
+            " log = 'The lease of worker ' || worker || ' expired\n'"
+            " WHERE %s AND attempts >= ?" % (expired,),
+            (now, now, max_attempts),
+        )
+        self.db.execute(
+            "UPDATE jobs SET state = 'pending', worker = NULL WHERE %s" % (expired,),
+            (now,),
+        )
+
+    def claim(self, worker, lease_time, max_attempts):
+        """Claim the oldest pending job for worker, returns it or None"""
+        with self.transaction():
+            self._expire_leases(max_attempts)
+            row = self.db.execute(
+                "SELECT id FROM jobs WHERE state = 'pending' ORDER BY id LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            self.db.execute(
+                "UPDATE jobs SET state = 'claimed', worker = ?, lease_expires = ?,"
+                " attempts = attempts + 1 WHERE id = ?",
+                (worker, self.clock() + lease_time, row["id"]),
+            )
+            row = self.db.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],))
+            return self.to_job(row.fetchone())
+
+    def renew(self, job_id, worker, lease_time):
+        """Extend the lease of worker on a job
+
+        Returns "claimed", "cancelled" if the job should be cancelled, or
+        "lost" if the job was handed out to another worker.
+        """
+        with self.transaction():
+            updated = self.db.execute(
+                "UPDATE jobs SET lease_expires = ?"
+                " WHERE id = ? AND worker = ? AND state = 'claimed'",
+                (self.clock() + lease_time, job_id, worker),
+            ).rowcount
+            if not updated:
+                return "lost"
+            row = self.db.execute(
+                "SELECT cancelled FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            return "cancelled" if row["cancelled"] else "claimed"
+
+    def release(self, job_id, worker):
+        """Put back a job that worker gives up, without counting an attempt"""
+        with self.transaction():
+            self.db.execute(
+                "UPDATE jobs SET state = 'pending', worker = NULL,"
+                " attempts = attempts - 1"
+                " WHERE id = ? AND worker = ? AND state = 'claimed'",
+                (job_id, worker),
+            )
+
+    def finish(self, job_id, worker, outcome, duration, builds=(), log=""):
+        """Report the result of a job, returns False if the lease was lost"""
+        with self.transaction():
+            return bool(
+                self.db.execute(
+                    "UPDATE jobs SET state = 'done', outcome = ?, duration = ?,"
+                    " builds = ?, log = ?, end_time = ?"
+                    " WHERE id = ? AND worker = ? AND state = 'claimed'",
+                    (
+                        outcome,
+                        duration,
+                        json.dumps(list(builds)),
+                        log,
+                        self.clock(),
+                        job_id,
+                        worker,
+                    ),
+                ).rowcount
+            )
+
+    def cancel(self, job_id):
+        """Cancel a job; a running job is cancelled by its worker"""
+        with self.transaction():
+            self.db.execute(
+                "UPDATE jobs SET state = 'done', outcome = 'cancelled', end_time = ?"
+                " WHERE id = ? AND state = 'pending'",
+                (self.clock(), job_id),
+            )
+            self.db.execute(
+                "UPDATE jobs SET cancelled = 1 WHERE id = ? AND state = 'claimed'",
+                (job_id,),
+            )
+
+
+def format_duration(seconds):
+    """Format a duration in seconds as H:MM:SS"""
+    return str(datetime.timedelta(seconds=round(seconds)))
+
+
+def write_file_atomically(path, content):
+    """Write a file so that readers never see it partially written"""
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        os.chmod(tmpname, 0o644)
+        os.replace(tmpname, path)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+
+def escape_label_value(value):
+    """Escape a label value for the Prometheus text format"""
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return value.replace("\n", "\\n")
+
+
+class BuildMetrics:
+    """Durations and outcomes of the builds of a run
+
+    For each app, this records the time spent waiting for a worker, the
+    duration of each stage of the build (fetch, checkout, build,
+    smoke_test, push, hooks), the outcome and the number of consecutive failed builds.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.apps = {}
+        self.outcomes = {}
+        self.skips = {}
+
+    def start(self, app, queue_wait=0.0):
+        with self.lock:
+            self.apps[app] = {"queue_wait": queue_wait, "stages": {}}
+
+    @contextlib.contextmanager
+    def stage(self, app, name):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            with self.lock:
+                stages = self.apps.setdefault(app, {"stages": {}})["stages"]
+                stages[name] = stages.get(name, 0) + self.clock() - start
+
+    def wait(self, app, name, duration):
+        """Record the time app waited for a slot in a stage of its build"""
+        with self.lock:
+            waits = self.apps.setdefault(app, {"stages": {}}).setdefault(
+                "stage_waits", {}
+            )
+            waits[name] = waits.get(name, 0) + duration
+
+    def skip(self, app, reason):
+        with self.lock:
+            self.apps.setdefault(app, {"stages": {}})["skip_reason"] = reason
+            self.skips[reason] = self.skips.get(reason, 0) + 1
+
+    def finish(self, app, outcome, duration, failure_streak=0):
+        with self.lock:
+            entry = self.apps.setdefault(app, {"stages": {}})
+            entry["outcome"] = outcome
+            entry["duration"] = duration
+            entry["failure_streak"] = failure_streak
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def to_json(self):
+        with self.lock:
+            return json.dumps(
+                {
+                    "start_time": self.start_time,
+                    "time": time.time(),
+                    "apps": self.apps,
+                    "outcomes": self.outcomes,
+                    "skips": self.skips,
+                },
+                indent=2,
+                sort_keys=True,
+            )
+
+    def to_prometheus(self):
+        def labels(**kwargs):
+            return ",".join(
+                '%s="%s"' % (key, escape_label_value(value))
+                for key, value in sorted(kwargs.items())
+            )
+
+        metrics = {
+            "build_duration_seconds": (
+                "Duration of the last build of the app",
+                [],
+            ),
+            "stage_duration_seconds": (
+                "Duration of each stage of the last build of the app",
+                [],
+            ),
+            "queue_wait_seconds": (
+                "Time the last build of the app waited for a worker",
+                [],
+            ),
+            "stage_wait_seconds": (
+                "Time the last build of the app waited for each stage",
+                [],
+            ),
+            "failure_streak": (
+                "Number of consecutive failed builds of the app",
+                [],
+            ),
+            "last_outcome": ("Outcome of the last build of the app", []),
+            "builds": ("Number of builds in this run, by outcome", []),
+            "skips": ("Number of builds skipped in this run, by reason", []),
+        }
+        with self.lock:
+            for app, entry in sorted(self.apps.items()):
+                if "duration" in entry:
+                    metrics["build_duration_seconds"][1].append(
+                        (labels(app=app), entry["duration"])
+                    )
+                for stage, duration in sorted(entry["stages"].items()):
+                    metrics["stage_duration_seconds"][1].append(
+                        (labels(app=app, stage=stage), duration)
+                    )
+                if "queue_wait" in entry:
+                    metrics["queue_wait_seconds"][1].append(
+                        (labels(app=app), entry["queue_wait"])
+                    )
+                for stage, duration in sorted(entry.get("stage_waits", {}).items()):
+                    metrics["stage_wait_seconds"][1].append(
+                        (labels(app=app, stage=stage), duration)
+                    )
+                if "outcome" in entry:
+                    metrics["failure_streak"][1].append(
+                        (labels(app=app), entry["failure_streak"])
+                    )
+                    metrics["last_outcome"][1].append(
+                        (labels(app=app, outcome=entry["outcome"]), 1)
+                    )
+            for outcome, count in sorted(self.outcomes.items()):
+                metrics["builds"][1].append((labels(outcome=outcome), count))
+            for reason, count in sorted(self.skips.items()):
+                metrics["skips"][1].append((labels(reason=reason), count))
+        lines = []
+        for name, (description, samples) in metrics.items():
+            lines.append("# HELP kbxbuilder_%s %s" % (name, description))
+            lines.append("# TYPE kbxbuilder_%s gauge" % (name,))
+            for sample_labels, value in samples:
+                lines.append("kbxbuilder_%s{%s} %s" % (name, sample_labels, value))
+        lines.append("# HELP kbxbuilder_last_run_timestamp_seconds End of the run")
+        lines.append("# TYPE kbxbuilder_last_run_timestamp_seconds gauge")
+        lines.append("kbxbuilder_last_run_timestamp_seconds %f" % (time.time(),))
+        return "\n".join(lines) + "\n"
+
+
+def read_log_excerpt(path, offset=0, max_size=65536):
+    """Return what was written to a log file after offset
+
+    Only the last max_size bytes are kept.
+    """
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            start = max(offset, end - max_size)
+            f.seek(start)
+            data = f.read()
+    except OSError:
+        return ""
+    text = data.decode("utf-8", errors="replace")
+    if start > offset:
+        text = "[... %d bytes skipped ...]\n" % (start - offset,) + text
+    return text
+
+
+current_app = contextvars.ContextVar("current_app", default=None)
+
+
+def get_tree_size(path):
+    """Return the disk usage of the files under path, in bytes"""
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+
+def compress_file(path):
+    """Compress a file with gzip, replacing it with path.gz"""
+    with open(path, "rb") as src, gzip.open(path + ".gz", "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(path)
+    return path + ".gz"
+
+
+ROTATED_LOG_RE = re.compile(r"(.*)\.\d{8}T\d{6}\.gz")
+
+
+class AppLogRouter(logging.Handler):
+    """Logging handler writing each record to the log file of its app
+
+    The app of a record is its "app" attribute, or else the app set in
+    current_app for the context that logged it; other records are
+    ignored. Records and raw output are queued and written by a single
+    background thread, the queue being bounded so that a slow disk
+    throttles the producers instead of filling the memory.
+    """
+
+    def __init__(self, logdir, maxsize=1024):
+        super().__init__()
+        self.logdir = logdir
+        self.queue = queue.Queue(maxsize)
+        self.files = {}
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+    def get_path(self, app):
+        return os.path.join(self.logdir, app + ".log")
+
+    def emit(self, record):
+        app = getattr(record, "app", None) or current_app.get()
+        if app is None:
+            return
+        try:
+            self.queue.put((app, (self.format(record) + "\n").encode()))
+        except Exception:
+            self.handleError(record)
+
+    def write(self, app, data):
+        """Queue raw bytes to be written to the log of app"""
+        self.queue.put((app, data))
+
+    def close_app(self, app):
+        """Close the log file of app once what was queued is written"""
+        self.queue.put((app, None))
+
+    def rotate(self, app, dest):
+        """Move the log of app to dest once what was queued is written
+
+        Returns once it's done; what's logged afterwards goes to a new file.
+        """
+        self.queue.put((app, dest))
+        self.flush()
+
+    def flush(self):
+        """Wait until what was queued so far is written"""
+        if not self.thread.is_alive():
+            return
+        done = threading.Event()
+        self.queue.put((None, done))
+        done.wait()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put((None, None))
+            self.thread.join()
+        super().close()
+
+    def writer(self):
+        while True:
+            app, data = self.queue.get()
+            if app is None:
+                for f in self.files.values():
+                    f.flush()
+                if data is None:
+                    break
+                data.set()
+                continue
+            try:
+                if data is None or isinstance(data, str):
+                    f = self.files.pop(app, None)
+                    if f:
+                        f.close()
+                    if data is not None:
+                        os.replace(self.get_path(app), data)
+                    continue
+                if app not in self.files:
+                    os.makedirs(self.logdir, exist_ok=True)
+                    self.files[app] = open(self.get_path(app), "ab")
+                self.files[app].write(data)
+                if self.queue.empty():
+                    for f in self.files.values():
+                        f.flush()
+            except OSError as e:
+                sys.stderr.write(
+                    "kbxbuilder: failed to write the log of %s: %s\n"
+                    % (app, e.strerror)
+                )
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+
+class Notifier:
+    """Mails to send about builds
+
+    Mails are queued during a run and sent at the end over a single SMTP
+    connection. The mails of send_mail actions with "digest: True" are
+    combined into one mail per recipient.
+    """
+
+    def __init__(self, host="localhost"):
+        self.host = host
+        self.lock = threading.Lock()
+        self.pending = []
+
+    def add(self, app, outcome, action, subject, log):
+        with self.lock:
+            self.pending.append(
+                {
+                    "app": app,
+                    "outcome": outcome,
+                    "action": action,
+                    "subject": subject,
+                    "log": log,
+                }
+            )
+
+    def get_messages(self, notifications):
+        messages = []
+        digests = {}
+        for n in notifications:
+            if n["action"].get("digest"):
+                key = (n["action"]["from"], n["action"]["to"])
+                digests.setdefault(key, []).append(n)
+                continue
+            msg = email.message.EmailMessage()
+            msg["Subject"] = n["subject"]
+            msg["From"] = n["action"]["from"]
+            msg["To"] = n["action"]["to"]
+            msg.set_content("Build of %s: %s\n" % (n["app"], n["outcome"]))
+            msg.add_attachment(n["log"], filename=n["app"] + ".log")
+            messages.append(msg)
+        for (sender, recipient), group in digests.items():
+            failed = [n for n in group if n["outcome"] != "success"]
+            msg = email.message.EmailMessage()
+            msg["Subject"] = "kbxbuilder: %d builds, %d failed" % (
+                len(group),
+                len(failed),
+            )
+            msg["From"] = sender
+            msg["To"] = recipient
+            msg.set_content(
+                "".join("Build of %s: %s\n" % (n["app"], n["outcome"]) for n in group)
+            )
+            for n in group:
+                msg.add_attachment(n["log"], filename=n["app"] + ".log")
+            messages.append(msg)
+        return messages
+
+    def flush(self):
+        """Send the queued mails"""
+        with self.lock:
+            notifications, self.pending = self.pending, []
+        if not notifications:
+            return
+        messages = self.get_messages(notifications)
+        try:
+            with smtplib.SMTP(self.host) as smtp:
+                for msg in messages:
+                    smtp.send_message(msg)
+        except (OSError, smtplib.SMTPException):
+            logger.exception("Failed to send %d mails", len(messages))
+
+
+class BuildScheduler:
+    """Decide in which order a set of apps is built
+
+    An app becomes ready once all the apps it depends on are finished;
+    ready apps are handed out by decreasing priority. Apps depending on
+    an app whose build failed are not built, their outcome is "blocked".
+    """
+
+    FAILED = ("failure", "timeout", "cancelled", "error", "blocked")
+
+    def __init__(self, deps, priorities=None, outcomes=None):
+        cycle = find_cycle(deps)
+        if cycle:
+            raise ValueError("Dependency loop between apps: " + " -> ".join(cycle))
+        self.deps = deps
+        self.priorities = priorities or {}
+        # Apps already built, for instance by an interrupted run
+        self.outcomes = dict(outcomes or {})
+        self.pending = [app for app in deps if app not in self.outcomes]
+        self.running = set()
+        self.ready_since = {}
+
+    def get_ready(self):
+        """Return the apps that can be built now, highest priority first"""
+        ready = []
+        changed = True
+        while changed:
+            changed = False
+            for app in list(self.pending):
+                deps = [d for d in self.deps[app] if d in self.deps]
+                if any(self.outcomes.get(d) in self.FAILED for d in deps):
+                    self.pending.remove(app)
+                    self.outcomes[app] = "blocked"
+                    changed = True
+        for app in self.pending:
+            deps = [d for d in self.deps[app] if d in self.deps]
+            if all(d in self.outcomes for d in deps):
+                ready.append(app)
+                self.ready_since.setdefault(app, time.monotonic())
+        return sorted(ready, key=lambda a: self.priorities.get(a, ()), reverse=True)
+
+    def start(self, app):
+        self.pending.remove(app)
+        self.running.add(app)
+
+    def finish(self, app, outcome):
+        self.running.discard(app)
+        self.outcomes[app] = outcome
+
+    def has_rebuilt_dependency(self, app):
+        """True if one of the apps that app depends on was just rebuilt"""
+        return any(self.outcomes.get(d) == "success" for d in self.deps[app])
+
+    def is_finished(self):
+        return not self.pending and not self.running
+
+
+def estimate_wall_time(deps, durations, jobs, priorities=None):
+    """Estimate the wall time of building apps with jobs parallel builds
+
+    durations maps the apps that are rebuilt to their expected duration;
+    the other apps of deps are considered as done right away. The
+    builds are scheduled as build_apps() would.
+    """
+    scheduler = BuildScheduler(
+        deps,
+        priorities,
+        {app: "not needed" for app in deps if app not in durations},
+    )
+    now = 0.0
+    running = []
+    while not scheduler.is_finished():
+        for app in scheduler.get_ready()[: jobs - len(running)]:
+            scheduler.start(app)
+            heapq.heappush(running, (now + durations[app], app))
+        if not running:
+            break
+        now, app = heapq.heappop(running)
+        scheduler.finish(app, "success")
+    return now
+
+
+def normalize_git_url(url):
+    url = url.rstrip("/")
+    if url.endswith(".git"):
+        url = url[: -len(".git")]
+    return url
+
+
+def parse_push_event(payload):
+    """Return the repository URLs and the branch or tag of a push event
+
+    Both GitLab and GitHub webhook payloads are understood.
+    """
+    urls = set()
+    for section in ("project", "repository"):
+        for key in ("git_http_url", "git_ssh_url", "clone_url", "ssh_url", "url"):
+            value = (payload.get(section) or {}).get(key)
+            if isinstance(value, str):
+                urls.add(normalize_git_url(value))
+    ref = payload.get("ref") or ""
+    for prefix in ("refs/heads/", "refs/tags/"):
+        if ref.startswith(prefix):
+            ref = ref[len(prefix) :]
+    return urls, ref
+
+
+class JobQueue:
+    """Queue of builds for "kbxbuilder serve"
+
+    An app is queued at most once: queuing it again while it's waiting
+    only merges the force flags. An app isn't handed out while it's
+    already being built, or while one of its dependencies is queued or
+    being built.
+    """
+
+    def __init__(self, deps=None):
+        self.deps = deps or {}
+        self.cond = threading.Condition()
+        self.queue = []
+        self.running = set()
+
+    def put(self, app, force=False):
+        """Queue a build of app, returns False if one was already queued"""
+        with self.cond:
+            for i, (queued, queued_force, queued_at) in enumerate(self.queue):
+                if queued == app:
+                    self.queue[i] = (app, queued_force or force, queued_at)
+                    return False
+            self.queue.append((app, force, time.monotonic()))
+            self.cond.notify_all()
+            return True
+
+    def get(self):
+        """Wait for a build to perform
+
+        Returns the app, the force flag and how long it has been queued.
+        """
+        with self.cond:
+            while True:
+                busy = self.running | {app for app, _, _ in self.queue}
+                for i, (app, force, queued_at) in enumerate(self.queue):
+                    if app in self.running:
+                        continue
+                    if any(dep in busy for dep in self.deps.get(app, [])):
+                        continue
+                    del self.queue[i]
+                    self.running.add(app)
+                    return app, force, time.monotonic() - queued_at
+                self.cond.wait()
+
+    def remove(self, app):
+        """Remove app from the queue, returns False if it wasn't queued"""
+        with self.cond:
+            for i, (queued, _, _) in enumerate(self.queue):
+                if queued == app:
+                    del self.queue[i]
+                    self.cond.notify_all()
+                    return True
+            return False
+
+    def done(self, app):
+        with self.cond:
+            self.running.discard(app)
+            self.cond.notify_all()
+
+    def get_dependents(self, app):
+        return [other for other, deps in self.deps.items() if app in deps]
+
+    def snapshot(self):
+        with self.cond:
+            return {
+                "queued": [app for app, _, _ in self.queue],
+                "running": sorted(self.running),
+            }
+
+
+class KbxbuilderRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Handle the requests sent to "kbxbuilder serve"
+
+    GET /status returns the queue and the last builds of each app,
+    POST /build/APP queues a build of APP (forced with ?force=1),
+    POST /cancel/APP removes APP from the queue and cancels its running
+    build, and POST /webhook queues the apps affected by a GitLab or
+    GitHub push.
+    """
+
+    def send_json(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/status":
+            self.send_json(404, {"error": "Not found"})
+            return
+        self.send_json(200, self.server.builder.get_server_status())
+
+    def do_POST(self):
+        builder = self.server.builder
+        if builder.args.token:
+            token = self.headers.get("X-Kbxbuilder-Token") or self.headers.get(
+                "X-Gitlab-Token", ""
+            )
+            if not hmac.compare_digest(token, builder.args.token):
+                self.send_json(403, {"error": "Invalid token"})
+                return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        url = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        if url.path.startswith("/build/"):
+            app = url.path[len("/build/") :]
+            if app not in builder.apps:
+                self.send_json(404, {"error": "Unknown app %s" % (app,)})
+                return
+            force = params.get("force", ["0"])[0] in ("1", "true", "yes")
+            queued = builder.queue.put(app, force)
+            self.send_json(202, {"app": app, "queued": queued})
+        elif url.path.startswith("/cancel/"):
+            app = url.path[len("/cancel/") :]
+            dequeued = builder.queue.remove(app)
+            cancelled = builder.cancel(app)
+            self.send_json(
+                200, {"app": app, "dequeued": dequeued, "cancelled": cancelled}
+            )
+        elif url.path == "/webhook":
+            try:
+                payload = json.loads(body)
+            except ValueError:
+                self.send_json(400, {"error": "Invalid JSON payload"})
+                return
+            apps = builder.find_pushed_apps(payload)
+            for app in apps:
+                builder.queue.put(app)
+            self.send_json(202, {"apps": apps})
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def log_message(self, fmt, *args):
+        logger.debug("%s", fmt % args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
 class Kbxbuilder:
     def __init__(self):
         self.parser = argparse.ArgumentParser()
@@ -32,18 +1263,112 @@ class Kbxbuilder:
         parser_build_one.set_defaults(func=self.cmd_build_one)
 
         parser_build_all = subparsers.add_parser("build-all", help="build all apps")
+        parser_build_all.add_argument(
+            "-j", "--jobs", type=int, default=1, help="number of apps built in parallel"
+        )
+        parser_build_all.add_argument(
+            "--distributed",
+            action="store_true",
+            help="build the apps on workers, through the shared queue",
+        )
         parser_build_all.set_defaults(func=self.cmd_build_all)
 
         parser_build_as_needed = subparsers.add_parser(
             "build-as-needed", help="build apps as needed"
         )
+        parser_build_as_needed.add_argument(
+            "-j", "--jobs", type=int, default=1, help="number of apps built in parallel"
+        )
+        parser_build_as_needed.add_argument(
+            "--distributed",
+            action="store_true",
+            help="build the apps on workers, through the shared queue",
+        )
         parser_build_as_needed.set_defaults(func=self.cmd_build_as_needed)
 
+        parser_resume = subparsers.add_parser(
+            "resume", help="resume the last interrupted build-all/build-as-needed"
+        )
+        parser_resume.add_argument(
+            "-j", "--jobs", type=int, default=1, help="number of apps built in parallel"
+        )
+        parser_resume.add_argument(
+            "--distributed",
+            action="store_true",
+            help="build the apps on workers, through the shared queue",
+        )
+        parser_resume.set_defaults(func=self.cmd_resume)
+
+        parser_serve = subparsers.add_parser(
+            "serve", help="build apps on request, from webhooks or triggers"
+        )
+        parser_serve.add_argument(
+            "-j", "--jobs", type=int, default=1, help="number of apps built in parallel"
+        )
+        listen_group = parser_serve.add_mutually_exclusive_group()
+        listen_group.add_argument(
+            "--listen",
+            default="127.0.0.1:8765",
+            metavar="HOST:PORT",
+            help="address to listen on (default: %(default)s)",
+        )
+        listen_group.add_argument(
+            "--socket", metavar="PATH", help="listen on a unix socket instead"
+        )
+        parser_serve.add_argument(
+            "--token", help="secret expected in the X-Kbxbuilder-Token header"
+        )
+        parser_serve.set_defaults(func=self.cmd_serve)
+
+        parser_plan = subparsers.add_parser(
+            "plan", help="show what build-as-needed would build, and for how long"
+        )
+        parser_plan.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=1,
+            help="number of apps built in parallel, for the estimate",
+        )
+        parser_plan.add_argument(
+            "--all", action="store_true", help="plan for build-all instead"
+        )
+        parser_plan.set_defaults(func=self.cmd_plan)
+
+        parser_worker = subparsers.add_parser(
+            "worker", help="build apps taken from the shared queue"
+        )
+        parser_worker.add_argument(
+            "-j", "--jobs", type=int, default=1, help="number of apps built in parallel"
+        )
+        parser_worker.add_argument(
+            "--name", help="name of the worker (default: HOSTNAME:PID)"
+        )
+        parser_worker.set_defaults(func=self.cmd_worker)
+
         ch = logging.StreamHandler()
         logger.setLevel(logging.INFO)
         logger.addHandler(ch)
 
-        self.subloggers = {}
+        self.processes = {}
+        self.processes_lock = threading.Lock()
+        self.args = None
+        self.running = set()
+        self.builds = {}
+        self.containers = {}
+        self.cancelled = set()
+        self.docker_client = None
+        self.docker_client_lock = threading.Lock()
+        self.shared_queue = None
+        self.remote_jobs = {}
+        self.claimed_jobs = {}
+        self.mirrors_lock = threading.Lock()
+        self.mirror_locks = {}
+        self.fetched_mirrors = set()
+        self.registry_digests = {}
+        self.jinja_env = jinja2.Environment()
+        self.templates = {}
+        self.metrics = BuildMetrics()
 
         self.config_paths = [
             ".",
@@ -64,46 +1389,50 @@ class Kbxbuilder:
                 logger.error("Failed when loading config file")
                 raise
 
-        def walk(node, replace_needed=False):
-            for key, item in node.items():
-                if isinstance(item, dict):
-                    replace_needed = walk(item, replace_needed)
-                else:
-                    if re.search("{{", item):
-                        replace_needed = True
-                        t = jinja2.Template(item)
-                        node[key] = t.render(config=self.config)
-            return replace_needed
-
-        i = 10
-        while i > 0:
-            i -= 1
-            if not walk(self.config["builder"]):
-                break
+        self.render_config()
 
         if "on_success" not in self.config:
             self.config["on_success"] = []
         if "on_failure" not in self.config:
             self.config["on_failure"] = []
 
-        if i == 0:
-            logger.error("Dependency loop in config file")
-            sys.exit(1)
-
         os.makedirs(os.path.dirname(self.config["builder"]["logfile"]), exist_ok=True)
         logfile = self.config["builder"]["logfile"]
         ch = logging.FileHandler(logfile)
         ch.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
         ch.setLevel(logging.INFO)
         logger.addHandler(ch)
+        self.logfile_handler = ch
+        self.log_router = AppLogRouter(self.config["builder"]["buildlogsdir"])
+        self.log_router.setFormatter(
+            logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+        )
+        logger.addHandler(self.log_router)
+        # Builds run in-process, what kaboxer logs goes to the app log
+        kaboxer.logger.setLevel(logging.INFO)
+        kaboxer.logger.addHandler(self.log_router)
 
         os.makedirs(self.config["builder"]["datadir"], exist_ok=True)
-        self.statusfile = os.path.join(self.config["builder"]["datadir"], "status.yaml")
-        try:
-            logger.debug("Loading status file %s", f)
-            self.status = yaml.safe_load(open(self.statusfile))
-        except Exception:
-            self.status = {}
+        dbfile = os.path.join(self.config["builder"]["datadir"], "status.db")
+        statusfile = os.path.join(self.config["builder"]["datadir"], "status.yaml")
+        needs_import = not os.path.exists(dbfile) and os.path.exists(statusfile)
+        self.history = BuildHistory(dbfile)
+        if needs_import:
+            count = self.history.import_yaml(statusfile)
+            os.rename(statusfile, statusfile + ".imported")
+            logger.info("Imported %d builds from status file %s", count, statusfile)
+
+        self.notifier = Notifier(self.config["builder"].get("smtp_host", "localhost"))
+        self.stage_slots = {}
+        for stage in ("fetch", "build", "push"):
+            jobs = self.config["builder"].get(stage + "_jobs")
+            if jobs:
+                self.stage_slots[stage] = threading.BoundedSemaphore(int(jobs))
+        self.smoke_test_slots = threading.BoundedSemaphore(
+            int(self.config["builder"].get("smoke_test_jobs", 2))
+        )
+        self.retention = self.get_retention_policy()
+        self.retention_lock = threading.Lock()
 
         for p in self.config_paths:
             f = os.path.join(p, "kbxbuilder.apps.yaml")
@@ -115,49 +1444,576 @@ class Kbxbuilder:
             except Exception:
                 pass
 
-    def add_status(self, app, tag, revid, status):
-        if app not in self.status:
-            self.status[app] = {}
-        t = time.time()
-        item = {
-            "tag": tag,
-            "revid": revid,
-            "status": status,
-        }
-        self.status[app][t] = item
-        if status:
-            self.status[app]["last_success"] = item.copy()
-        else:
-            self.status[app]["last_failure"] = item.copy()
-        logger.debug("Saving status file")
-        with open(self.statusfile, "w") as f:
-            f.write(yaml.dump(self.status))
+    def add_status(
+        self,
+        app,
+        tag,
+        revid,
+        status,
+        duration=None,
+        reason=None,
+        base_images=None,
+        images=None,
+        smoke_tests=None,
+    ):
+        data = {}
+        if duration is not None:
+            data["duration"] = duration
+        if reason is not None:
+            data["reason"] = reason
+        if base_images:
+            data["base_images"] = base_images
+        if images:
+            data["images"] = images
+        if smoke_tests:
+            data["smoke_tests"] = smoke_tests
+        self.history.add(app, tag, revid, status, **data)
+
+    def render(self, source, **kwargs):
+        """Render a template from the config, compiling it only once"""
+        if source not in self.templates:
+            self.templates[source] = self.jinja_env.from_string(source)
+        return self.templates[source].render(**kwargs)
+
+    def render_config(self):
+        """Render the templates in the builder section of the config
+
+        Each template is rendered once, after the values it refers to.
+        """
+        templates = {}
+
+        def collect(node, path):
+            for key, item in node.items():
+                if isinstance(item, dict):
+                    collect(item, path + (key,))
+                elif isinstance(item, str) and "{{" in item:
+                    templates[path + (key,)] = item
+
+        collect(self.config["builder"], ("builder",))
+        deps = {}
+        for path, source in templates.items():
+            try:
+                refs = get_template_references(self.jinja_env.parse(source), "config")
+            except jinja2.TemplateSyntaxError as e:
+                logger.error(
+                    "Invalid template for %s in config file: %s",
+                    ":".join(map(str, path)),
+                    e.message,
+                )
+                sys.exit(1)
+            deps[path] = [
+                other
+                for other in templates
+                if any(other[: len(r)] == r or r[: len(other)] == other for r in refs)
+            ]
+        cycle = find_cycle(deps)
+        if cycle:
+            logger.error(
+                "Dependency loop in config file: %s",
+                " -> ".join(":".join(map(str, path)) for path in cycle),
+            )
+            sys.exit(1)
+        for path in toposort(deps):
+            node = self.config
+            for key in path[:-1]:
+                node = node[key]
+            node[path[-1]] = self.render(templates[path], config=self.config)
 
     def go(self):
         self.args = self.parser.parse_args()
         self.args.func()
 
-    def build_one(self, app, force=True):
-        os.makedirs(self.config["builder"]["buildlogsdir"], exist_ok=True)
-        if app not in self.subloggers:
-            logfile = os.path.join(self.config["builder"]["buildlogsdir"], app + ".log")
-            self.subloggers[app] = logging.FileHandler(logfile)
-            self.subloggers[app].setFormatter(
-                logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-            )
+    def get_mirror(self, url, log):
+        """Return a bare mirror of a Git repository and the lock guarding it
+
+        Apps sharing a git_url share the mirror, which is fetched at most
+        once per run; their checkouts are worktrees of that mirror.
+        """
+        mirrordir = self.get_mirror_dir(url)
+        with self.mirrors_lock:
+            lock = self.mirror_locks.setdefault(url, threading.Lock())
+        with lock:
+            options = {}
+            if self.config["builder"].get("clone_depth"):
+                options["depth"] = int(self.config["builder"]["clone_depth"])
+            if os.path.isdir(mirrordir):
+                mirror = git.Repo(mirrordir)
+                if url not in self.fetched_mirrors:
+                    log.debug("Fetching %s", url)
+                    mirror.remotes["origin"].fetch(prune=True, **options)
+            else:
+                log.debug("Creating mirror of %s in %s", url, mirrordir)
+                if self.config["builder"].get("clone_filter"):
+                    options["filter"] = self.config["builder"]["clone_filter"]
+                mirror = git.Repo.clone_from(url, mirrordir, mirror=True, **options)
+            self.fetched_mirrors.add(url)
+        return mirror, lock
 
-            def flt(x):
+    @contextlib.contextmanager
+    def pipeline_stage(self, app, stage):
+        """Run a stage of the build of app, once there's a slot for it
+
+        The fetch, build and push stages can each be limited to a number
+        of apps at a time (fetch_jobs, build_jobs and push_jobs), so that
+        while some apps are built, others are fetched or pushed.
+        """
+        slots = self.stage_slots.get(stage)
+        if slots is not None:
+            start = time.monotonic()
+            slots.acquire()
+            self.metrics.wait(app, stage, time.monotonic() - start)
+        try:
+            with self.metrics.stage(app, stage):
+                yield
+        finally:
+            if slots is not None:
+                slots.release()
+
+    def get_mirror_dir(self, url):
+        return os.path.join(
+            self.config["builder"]["workdir"],
+            "mirrors",
+            hashlib.sha256(url.encode()).hexdigest()[:16] + ".git",
+        )
+
+    def checkout_app(self, app, branch, log):
+        """Check out branch of an app in a worktree of the shared mirror"""
+        checkoutdir = os.path.join(self.config["builder"]["workdir"], app)
+        with self.pipeline_stage(app, "fetch"):
+            mirror, lock = self.get_mirror(self.apps[app]["git_url"], log)
+        with self.metrics.stage(app, "checkout"), lock:
+            revid = mirror.git.rev_parse(branch + "^{commit}")
+            if os.path.isdir(checkoutdir):
                 try:
-                    return x.app == app
-                except Exception:
-                    return False
+                    common_dir = os.path.realpath(git.Repo(checkoutdir).common_dir)
+                except git.exc.GitError:
+                    common_dir = None
+                if common_dir != os.path.realpath(mirror.git_dir):
+                    # Full clone made by an older kbxbuilder, or the
+                    # git_url of the app has changed
+                    log.info("Replacing %s with a worktree", checkoutdir)
+                    shutil.rmtree(checkoutdir)
+            mirror.git.worktree("prune")
+            if not os.path.isdir(checkoutdir):
+                mirror.git.worktree(
+                    "add", "--detach", os.path.abspath(checkoutdir), revid
+                )
+            repo = git.Repo(checkoutdir)
+            repo.git.checkout("--detach", revid)
+        return repo
+
+    def get_watched_paths(self, app, appdir):
+        """Return the paths whose changes require a rebuild of app
+
+        The paths are relative to the root of the repository. None means
+        any change in the repository does.
+        """
+        if "subdir" not in self.apps[app]:
+            return None
+        checkoutdir = os.path.abspath(
+            os.path.join(self.config["builder"]["workdir"], app)
+        )
+        paths = [os.path.normpath(self.apps[app]["subdir"])]
+        paths += self.apps[app].get("watch_paths", [])
+        app_config = self.get_app_config(app, appdir)
+        if app_config is not None:
+            # The Dockerfile may live outside of the build context
+            dockerfile = self.get_dockerfile(app_config, appdir)
+            paths.append(os.path.relpath(dockerfile, checkoutdir))
+        return paths
+
+    def get_app_config(self, app, appdir):
+        """Return the kaboxer.yaml of app in appdir, or None"""
+        for name in (app + ".kaboxer.yaml", "kaboxer.yaml"):
+            try:
+                with open(os.path.join(appdir, name)) as f:
+                    return yaml.safe_load(f)
+            except OSError:
+                continue
+        return None
 
-            self.subloggers[app].addFilter(flt)
-            logger.addHandler(self.subloggers[app])
+    def get_dockerfile(self, app_config, appdir):
+        try:
+            dockerfile = app_config["build"]["docker"]["file"]
+        except (KeyError, TypeError):
+            dockerfile = "Dockerfile"
+        return os.path.normpath(os.path.join(appdir, dockerfile))
+
+    def get_registry_digest(self, image, log):
+        """Return the digest of the manifest of image in its registry
+
+        The image isn't pulled. Digests are looked up once per run; in
+        serve and worker modes, other threads clear the cache when they
+        start a build, so it's only read once here.
+        """
+        try:
+            return self.registry_digests[image]
+        except KeyError:
+            pass
+        try:
+            digest = self.get_docker_client().images.get_registry_data(image).id
+        except docker.errors.DockerException:
+            log.warning("Failed to look up the digest of %s", image)
+            digest = None
+        self.registry_digests[image] = digest
+        return digest
+
+    def get_base_image_digests(self, app, appdir, log):
+        """Return the digests of the base images of app, by image name"""
+        app_config = self.get_app_config(app, appdir)
+        if app_config is None:
+            return {}
+        try:
+            with open(self.get_dockerfile(app_config, appdir)) as f:
+                dockerfile = f.read()
+        except OSError:
+            return {}
+        try:
+            buildargs = app_config["build"]["docker"]["parameters"]
+        except (KeyError, TypeError):
+            buildargs = {}
+        digests = {}
+        for image in get_base_images(dockerfile, buildargs):
+            # An image pinned by digest never changes
+            if "@" in image:
+                continue
+            digest = self.get_registry_digest(image, log)
+            if digest is not None:
+                digests[image] = digest
+        return digests
+
+    def get_base_image_change(self, app, log):
+        """Return a base image updated since the last successful build of app
+
+        Returns None if none of the base images recorded with that build
+        has a new digest in its registry.
+        """
+        last_success = self.history.last_success(app)
+        base_images = last_success.get("base_images", {}) if last_success else {}
+        for image, digest in sorted(base_images.items()):
+            current = self.get_registry_digest(image, log)
+            if current is not None and current != digest:
+                return image
+        return None
+
+    def get_rebuild_reason(
+        self, app, branch, repo, revid, appdir, log, base_change=None
+    ):
+        """Return why app needs to be rebuilt at revid, or None if it doesn't
+
+        Apps whose base image base_change was updated are always rebuilt.
+        Apps living in a subdir are only rebuilt when a file under their
+        watched paths changed since the last successful build; otherwise,
+        the skipped revision is recorded in the history.
+        """
+        if base_change is not None:
+            return "base image %s was updated" % (base_change,)
+        last = self.history.last(app, ["success", "skipped"])
+        if last and last["revid"] == revid:
+            log.info("Build of %s not needed", app)
+            self.metrics.skip(app, "revision already built")
+            return None
+        last_success = self.history.last_success(app)
+        if not last_success:
+            return "first build"
+        watched_paths = self.get_watched_paths(app, appdir)
+        if watched_paths is None:
+            return "new revision"
+        try:
+            changed = repo.git.diff(
+                "--name-only", last_success["revid"], revid
+            ).splitlines()
+        except git.exc.GitCommandError:
+            return "new revision, last built revision not found"
+        changed = [path for path in changed if is_watched(path, watched_paths)]
+        if changed:
+            return "%d watched files changed since %s" % (
+                len(changed),
+                last_success["revid"][:12],
+            )
+        reason = "no watched file changed since %s" % (last_success["revid"][:12],)
+        log.info("Build of %s not needed, %s", app, reason)
+        self.add_status(app, branch, revid, "skipped", reason=reason)
+        self.metrics.skip(app, "no watched file changed")
+        return None
+
+    def get_app_setting(self, app, key, default=None):
+        """Return a setting of an app, or its default in the builder section"""
+        if key in self.apps[app]:
+            return self.apps[app][key]
+        return self.config["builder"].get(key, default)
+
+    def get_build_options(self, app):
+        """Return the kaboxer build options for app"""
+        options = []
+        for key, option in (
+            ("memory", "--memory"),
+            ("cpu_shares", "--cpu-shares"),
+            ("cpuset_cpus", "--cpuset-cpus"),
+        ):
+            value = self.get_app_setting(app, key)
+            if value is not None:
+                options += [option, str(value)]
+        return options
+
+    def get_docker_client(self):
+        """Return the Docker client shared by all the builds"""
+        with self.docker_client_lock:
+            if self.docker_client is None:
+                # One connection per concurrent build, at least
+                jobs = getattr(self.args, "jobs", 1)
+                self.docker_client = docker.from_env(max_pool_size=max(jobs, 10))
+            return self.docker_client
+
+    def run_kaboxer(self, app, action, appdir, log):
+        """Build or push app with kaboxer, in-process
+
+        action is "build" or "push". Like run_command(), the build is
+        stopped if it runs longer than the timeout setting of the app, or
+        if it is cancelled; the running Docker build or push is aborted
+        right away, even if it doesn't output anything. Returns the result
+        of Kaboxer.build_app() or push_app() (or None if it failed), and
+        "timeout", "cancelled" or None.
+        """
+        kbx = kaboxer.Kaboxer(docker_conn=self.get_docker_client())
+        kbx.build_id = uuid.uuid4().hex
+        timed_out = threading.Event()
+        timeout = self.get_app_setting(app, "timeout")
+        timer = None
+        if timeout:
+
+            def stop():
+                log.error("kaboxer %s timed out after %s seconds", action, timeout)
+                timed_out.set()
+                kbx.stop()
+
+            timer = threading.Timer(float(timeout), stop)
+            timer.start()
+        with self.processes_lock:
+            self.builds[app] = kbx
+        result = None
+        stopped = None
+        try:
+            if action == "build":
+                result = kbx.build_app(app, appdir, self.get_build_options(app))
+            else:
+                result = kbx.push_app(app, appdir)
+        except (Exception, SystemExit):
+            # kaboxer logs its errors before exiting
+            log.debug("kaboxer %s of %s failed", action, app, exc_info=True)
+        finally:
+            if timer is not None:
+                timer.cancel()
+            with self.processes_lock:
+                self.builds.pop(app, None)
+                if app in self.cancelled:
+                    self.cancelled.discard(app)
+                    stopped = "cancelled"
+        if timed_out.is_set():
+            stopped = "timeout"
+        if stopped:
+            result = None
+            self.remove_build_containers(kbx.build_id, log)
+        return result, stopped
+
+    def run_command(self, app, cmd, cwd, log):
+        """Run a command for app
+
+        The command runs in its own process group, which is killed if it
+        runs longer than the timeout setting of the app, or if the build
+        is cancelled. Returns the exit code, and "timeout", "cancelled" or
+        None depending on whether the command was killed.
+        """
+        build_id = uuid.uuid4().hex
+        env = dict(os.environ, KABOXER_BUILD_ID=build_id)
+        timeout = self.get_app_setting(app, "timeout")
+        proc = subprocess.Popen(
+            cmd,
+            cwd=cwd,
+            shell=True,
+            env=env,
+            start_new_session=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        reader = threading.Thread(
+            target=self.copy_output, args=(app, proc.stdout), daemon=True
+        )
+        reader.start()
+        with self.processes_lock:
+            self.processes[app] = proc
+        stopped = None
+        try:
+            proc.wait(timeout=float(timeout) if timeout else None)
+        except subprocess.TimeoutExpired:
+            log.error("%s timed out after %s seconds, killing it", cmd, timeout)
+            kill_process_group(proc)
+            stopped = "timeout"
+        finally:
+            with self.processes_lock:
+                self.processes.pop(app, None)
+                if app in self.cancelled:
+                    self.cancelled.discard(app)
+                    stopped = "cancelled"
+        reader.join()
+        if stopped:
+            self.remove_build_containers(build_id, log)
+        return proc.returncode, stopped
+
+    def copy_output(self, app, pipe):
+        """Copy the output of a command to the log of app, chunk by chunk"""
+        with pipe:
+            for chunk in iter(lambda: pipe.read1(16384), b""):
+                self.log_router.write(app, chunk)
+
+    def cancel(self, app):
+        """Cancel the running build of app, returns False if there is none"""
+        with self.processes_lock:
+            job_id = self.remote_jobs.get(app)
+            kbx = self.builds.get(app)
+            proc = self.processes.get(app)
+            container = self.containers.get(app)
+            if job_id is None and kbx is None and proc is None and container is None:
+                return False
+            if job_id is None:
+                self.cancelled.add(app)
+        logger.info("Cancelling the build of %s", app)
+        if job_id is not None:
+            # The worker running the build cancels it
+            self.shared_queue.cancel(job_id)
+        if kbx is not None:
+            kbx.stop()
+        if proc is not None:
+            kill_process_group(proc)
+        if container is not None:
+            self.kill_container(container)
+        return True
+
+    def kill_container(self, container):
+        try:
+            container.kill()
+        except docker.errors.DockerException:
+            # It may have exited in the meantime
+            pass
+
+    def run_smoke_test(self, app, image, log):
+        """Run the smoke test of app in a container of a built image
+
+        At most smoke_test_jobs smoke tests run at a time, whatever the
+        number of builds. Returns the result to record in the history.
+        """
+        settings = self.apps[app]["smoke_test"]
+        expected = int(settings.get("exit_code", 0))
+        timeout = float(settings.get("timeout", 300))
+        result = {"version": image["version"], "exit_code": None}
+        timed_out = threading.Event()
+        with self.smoke_test_slots:
+            log.info("Running smoke test of %s %s", app, image["version"])
+            start = time.monotonic()
+            container = None
+            timer = None
+            try:
+                container = self.get_docker_client().containers.run(
+                    image["image_id"], settings["command"], detach=True
+                )
+                with self.processes_lock:
+                    self.containers[app] = container
+
+                def stop():
+                    log.error(
+                        "Smoke test of %s timed out after %s seconds", app, timeout
+                    )
+                    timed_out.set()
+                    self.kill_container(container)
+
+                timer = threading.Timer(timeout, stop)
+                timer.start()
+                result["exit_code"] = container.wait()["StatusCode"]
+                self.log_router.write(app, container.logs())
+            except docker.errors.DockerException:
+                log.exception("Failed to run the smoke test of %s", app)
+            finally:
+                if timer is not None:
+                    timer.cancel()
+                if container is not None:
+                    with self.processes_lock:
+                        self.containers.pop(app, None)
+                    try:
+                        container.remove(force=True)
+                    except docker.errors.DockerException:
+                        log.warning("Failed to remove container %s", container.id)
+            result["duration"] = time.monotonic() - start
+        with self.processes_lock:
+            cancelled = app in self.cancelled
+            self.cancelled.discard(app)
+        if cancelled:
+            result["outcome"] = "cancelled"
+        elif timed_out.is_set():
+            result["outcome"] = "timeout"
+        elif result["exit_code"] == expected:
+            result["outcome"] = "success"
+        else:
+            result["outcome"] = "failure"
+            log.error(
+                "Smoke test of %s %s failed, exit code %s instead of %d",
+                app,
+                image["version"],
+                result["exit_code"],
+                expected,
+            )
+        return result
+
+    def remove_build_containers(self, build_id, log):
+        """Remove the temporary containers left behind by a killed build"""
+        try:
+            client = self.get_docker_client()
+            for container in client.containers.list(
+                all=True, filters={"label": "kaboxer.build-id=" + build_id}
+            ):
+                log.info("Removing container %s left by the build", container.short_id)
+                container.remove(force=True)
+        except docker.errors.DockerException:
+            log.exception("Failed to remove the containers left by the build")
+
+    def run_actions(self, app, outcome, actions, appdir, log, log_offset=0):
+        """Run the execute_command and send_mail actions after a build"""
+        logfile = self.log_router.get_path(app)
+        for i in actions:
+            if i["action"] == "execute_command":
+                cmd = self.render(i["command"], config=self.config, app=app)
+                log.debug("Running command: %s", cmd)
+                if self.run_command(app, cmd, appdir, log)[0] != 0:
+                    log.error("Error when running %s", cmd)
+            if i["action"] == "send_mail":
+                self.log_router.flush()
+                excerpt = read_log_excerpt(
+                    logfile,
+                    log_offset,
+                    self.config["builder"].get("mail_log_size", 65536),
+                )
+                subject = self.render(i["subject"], app=app)
+                self.notifier.add(app, outcome, i, subject, excerpt)
+
+    def build_one(self, app, force=True, run=None, checked_out=None):
+        """Build an app, returns "success", "failure" or "not needed"
+
+        The build can also end with "timeout" or "cancelled".
+
+        Within a run, the checked out revid is recorded; if checked_out is
+        already checked out, the fetch and checkout are skipped.
+        """
+        # Only the part of the app log about this build is sent by mail
+        self.log_router.flush()
+        try:
+            log_offset = os.path.getsize(self.log_router.get_path(app))
+        except OSError:
+            log_offset = 0
+        # Records logged through this adapter go to the app log as well
+        log = logging.LoggerAdapter(logger, {"app": app})
         try:
             buildmode = self.apps[app]["buildmode"]
         except KeyError:
-            logger.error("Cannot find how to build %s", app)
+            log.error("Cannot find how to build %s", app)
             sys.exit(1)
 
         os.makedirs(self.config["builder"]["workdir"], exist_ok=True)
@@ -166,113 +2022,846 @@ class Kbxbuilder:
             branch = self.apps[app]["branch"]
         except KeyError:
             branch = "master"
-        logger.debug("Checking out Git repository at %s", checkoutdir)
-        if os.path.isdir(checkoutdir):
+        base_change = None
+        if not force:
+            with self.pipeline_stage(app, "fetch"):
+                base_change = self.get_base_image_change(app, log)
+        repo = None
+        if checked_out and os.path.isdir(checkoutdir):
             repo = git.Repo(checkoutdir)
-            origin = repo.remotes["origin"]
-            if origin.url != self.apps[app]["git_url"]:
-                logger.debug("Switching remote URL")
-                git.remote.Remote.remove(repo, "origin")
-                git.remote.Remote.add(repo, "origin", self.apps[app]["git_url"])
-                origin = repo.remotes["origin"]
+            if repo.head.commit.hexsha == checked_out:
+                log.info("Resuming %s, already checked out at %s", app, checked_out)
             else:
-                logger.debug("Remote already on the correct URL")
-            origin.fetch(prune=True)
-        else:
-            repo = git.Repo.clone_from(self.apps[app]["git_url"], checkoutdir)
-        try:
-            repo.git.checkout("remotes/origin/" + branch)
-        except Exception:
-            repo.git.checkout(branch)
-
+                repo = None
+        if repo is None:
+            if not force:
+                last = self.history.last(app, ["success", "skipped"])
+                last_revid = last["revid"] if last else None
+                with self.pipeline_stage(app, "fetch"):
+                    remote_revid = get_remote_revid(self.apps[app]["git_url"], branch)
+                if (
+                    remote_revid is not None
+                    and remote_revid == last_revid
+                    and base_change is None
+                ):
+                    log.info("Build of %s not needed", app)
+                    self.metrics.skip(app, "remote unchanged")
+                    return "not needed"
+            log.debug("Checking out Git repository at %s", checkoutdir)
+            repo = self.checkout_app(app, branch, log)
         revid = repo.head.commit.hexsha
-
-        if not force:
-            try:
-                if self.status[app]["last_success"]["revid"] == revid:
-                    logger.info("Build of %s not needed", app)
-                    return
-            except KeyError:
-                pass
+        if run is not None:
+            self.history.set_run_app_state(run, app, "checked out", revid)
 
         if "subdir" in self.apps[app]:
             appdir = os.path.join(checkoutdir, self.apps[app]["subdir"])
         else:
             appdir = checkoutdir
         appdir = os.path.abspath(appdir)
-        logger.info("Building app %s at revid %s", app, revid)
+
+        reason = "forced"
+        if not force:
+            reason = self.get_rebuild_reason(
+                app, branch, repo, revid, appdir, log, base_change
+            )
+            if reason is None:
+                return "not needed"
+        log.info("Building app %s at revid %s (%s)", app, revid, reason)
         if buildmode == "kaboxer":
-            cmd = "kaboxer build %s" % (app,)
-            logger.debug("Building kaboxer image: %s", cmd)
-            if subprocess.run(cmd, cwd=appdir, shell=True).returncode == 0:
-                self.add_status(app, branch, revid, "success")
+            with self.pipeline_stage(app, "fetch"):
+                base_images = self.get_base_image_digests(app, appdir, log)
+            log.debug("Building kaboxer image of %s", app)
+            start = time.monotonic()
+            with self.pipeline_stage(app, "build"):
+                built, stopped = self.run_kaboxer(app, "build", appdir, log)
+            duration = time.monotonic() - start
+            smoke_tests = []
+            if built is not None:
+                for image in built:
+                    log.info(
+                        "Built image %s of %s %s, build profile:\n%s",
+                        image["image_id"],
+                        app,
+                        image["version"],
+                        kaboxer.format_build_profile(image["profile"]),
+                    )
+                images = [
+                    {"version": image["version"], "image_id": image["image_id"]}
+                    for image in built
+                ]
+                if "smoke_test" in self.apps[app]:
+                    with self.metrics.stage(app, "smoke_test"):
+                        for image in built:
+                            smoke_tests.append(self.run_smoke_test(app, image, log))
+                            if smoke_tests[-1]["outcome"] != "success":
+                                break
+                if smoke_tests and smoke_tests[-1]["outcome"] != "success":
+                    # The images are not pushed
+                    built = None
+                    stopped = smoke_tests[-1]["outcome"]
+            if built is not None:
+                self.add_status(
+                    app,
+                    branch,
+                    revid,
+                    "success",
+                    duration,
+                    reason,
+                    base_images,
+                    images,
+                    smoke_tests,
+                )
                 if self.apps[app]["push"]:
                     for i in self.config["on_success"]:
                         if i["action"] == "push_to_registry":
-                            cmd = "kaboxer push %s" % (app,)
-                            logger.debug("Pushing to registry: %s", cmd)
-                            if (
-                                subprocess.run(cmd, cwd=appdir, shell=True).returncode
-                                != 0
-                            ):
-                                logger.error("Error when running %s", cmd)
-                for i in self.config["on_success"]:
-                    if i["action"] == "execute_command":
-                        t = jinja2.Template(i["command"])
-                        cmd = t.render(config=self.config, app=app)
-                        logger.debug("Running command: %s", cmd)
-                        if subprocess.run(cmd, cwd=appdir, shell=True).returncode != 0:
-                            logger.error("Error when running %s", cmd)
-                    if i["action"] == "send_mail":
-                        s = smtplib.SMTP("localhost")
-                        with open(logfile) as f:
-                            msg = email.mime.text.MIMEText(f.read(), _charset="utf-8")
-                        msg["Subject"] = jinja2.Template(i["subject"]).render(app=app)
-                        msg["From"] = i["from"]
-                        msg["To"] = i["to"]
-                        s.sendmail(msg["From"], [msg["To"]], msg.as_string())
+                            log.debug("Pushing %s to the registry", app)
+                            with self.pipeline_stage(app, "push"):
+                                pushed, _ = self.run_kaboxer(app, "push", appdir, log)
+                            if pushed is None:
+                                log.error("Error when pushing %s", app)
+                            else:
+                                log.info("Pushed %s", ", ".join(pushed))
+                with self.metrics.stage(app, "hooks"):
+                    self.run_actions(
+                        app,
+                        "success",
+                        self.config["on_success"],
+                        appdir,
+                        log,
+                        log_offset,
+                    )
+                return "success"
             else:
-                self.add_status(app, branch, revid, "failure")
-                logger.error("Error when running %s", cmd)
-                for i in self.config["on_failure"]:
-                    if i["action"] == "execute_command":
-                        t = jinja2.Template(i["command"])
-                        cmd = t.render(config=self.config, app=app)
-                        logger.debug("Running command: %s", cmd)
-                        if subprocess.run(cmd, cwd=appdir, shell=True).returncode != 0:
-                            logger.error("Error when running %s", cmd)
-                    if i["action"] == "send_mail":
-                        s = smtplib.SMTP("localhost")
-                        with open(logfile) as f:
-                            msg = email.mime.text.MIMEText(f.read(), _charset="utf-8")
-                        msg["Subject"] = jinja2.Template(i["subject"]).render(app=app)
-                        msg["From"] = i["from"]
-                        msg["To"] = i["to"]
-                        s.sendmail(msg["From"], [msg["To"]], msg.as_string())
+                status = stopped or "failure"
+                self.add_status(
+                    app,
+                    branch,
+                    revid,
+                    status,
+                    duration,
+                    reason,
+                    smoke_tests=smoke_tests,
+                )
+                log.error("Error when building %s", app)
+                with self.metrics.stage(app, "hooks"):
+                    self.run_actions(
+                        app,
+                        status,
+                        self.config["on_failure"],
+                        appdir,
+                        log,
+                        log_offset,
+                    )
+                return status
+        log.error("Unsupported build mode %s for %s", buildmode, app)
+        return "error"
 
     def cmd_build_one(self):
         logger.info("Building %s", self.args.app)
-        self.build_one(self.args.app, force=True)
+        self.timed_build_one(self.args.app, force=True)
+        self.write_metrics()
+        self.notifier.flush()
+        self.apply_retention()
         logger.info("Built %s", self.args.app)
 
+    def timed_build_one(self, app, force, queue_wait=0.0, run=None, checked_out=None):
+        """Build an app, returns its outcome and the duration of the build
+
+        Whatever is logged during the build also goes to the app log.
+        """
+        self.metrics.start(app, queue_wait)
+        start = time.monotonic()
+        token = current_app.set(app)
+        with self.processes_lock:
+            self.running.add(app)
+        try:
+            outcome = self.build_one(app, force, run, checked_out)
+        except (Exception, SystemExit):
+            logger.exception("Unexpected error when building %s", app)
+            outcome = "error"
+        finally:
+            current_app.reset(token)
+            self.log_router.close_app(app)
+            with self.processes_lock:
+                self.running.discard(app)
+        duration = time.monotonic() - start
+        self.metrics.finish(
+            app, outcome, duration, self.history.get_failure_streak(app)
+        )
+        return outcome, duration
+
+    def write_metrics(self):
+        """Export the metrics as JSON, and for Prometheus if configured"""
+        try:
+            write_file_atomically(
+                os.path.join(self.config["builder"]["datadir"], "metrics.json"),
+                self.metrics.to_json(),
+            )
+            if self.config["builder"].get("metrics_file"):
+                write_file_atomically(
+                    self.config["builder"]["metrics_file"],
+                    self.metrics.to_prometheus(),
+                )
+        except OSError as e:
+            logger.error("Failed to write metrics: %s", e.strerror)
+
+    def get_retention_policy(self):
+        """Parse the retention section of the builder config
+
+        Returns None if there's no such section, nothing is cleaned then.
+        """
+        settings = self.config["builder"].get("retention")
+        if settings is None:
+            return None
+        try:
+            policy = {
+                "max_age": float(settings.get("max_age", 0)) * 86400,
+                "prune_images": bool(settings.get("prune_images", True)),
+            }
+            for key in ("max_log_size", "max_app_bytes", "disk_budget"):
+                policy[key] = kaboxer.parse_size(settings.get(key, 0))
+        except (AttributeError, TypeError, ValueError):
+            logger.error("Invalid retention section in config file")
+            sys.exit(1)
+        return policy
+
+    def get_rotated_logs(self):
+        """Return the rotated logs, oldest first, as (path, base, size, mtime)"""
+        logs = []
+        paths = glob.glob(os.path.join(self.config["builder"]["buildlogsdir"], "*.gz"))
+        paths += glob.glob(self.config["builder"]["logfile"] + ".*.gz")
+        for path in paths:
+            match = ROTATED_LOG_RE.fullmatch(path)
+            if not match:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            logs.append((path, match.group(1), st.st_size, st.st_mtime))
+        return sorted(logs, key=lambda log: log[3])
+
+    def rotate_logs(self, busy):
+        """Rotate and compress the logs that grew over max_log_size"""
+        max_size = self.retention["max_log_size"]
+        if not max_size:
+            return
+        suffix = time.strftime(".%Y%m%dT%H%M%S")
+        logdir = self.config["builder"]["buildlogsdir"]
+        for path in glob.glob(os.path.join(logdir, "*.log")):
+            app = os.path.basename(path)[: -len(".log")]
+            if app in busy or os.path.getsize(path) <= max_size:
+                continue
+            self.log_router.rotate(app, path + suffix)
+            if os.path.exists(path + suffix):
+                compress_file(path + suffix)
+        path = self.config["builder"]["logfile"]
+        if os.path.exists(path) and os.path.getsize(path) > max_size:
+            handler = self.logfile_handler
+            with handler.lock:
+                if handler.stream:
+                    handler.stream.close()
+                    handler.stream = None
+                os.replace(path, path + suffix)
+            compress_file(path + suffix)
+
+    def expire_logs(self):
+        """Remove the rotated logs over max_age or over max_app_bytes"""
+        max_age = self.retention["max_age"]
+        max_bytes = self.retention["max_app_bytes"]
+        kept = {}
+        for path, base, size, mtime in reversed(self.get_rotated_logs()):
+            kept[base] = kept.get(base, 0) + size
+            if (max_age and mtime < time.time() - max_age) or (
+                max_bytes and kept[base] > max_bytes
+            ):
+                logger.info("Removing old log %s", path)
+                os.remove(path)
+
+    def remove_checkout(self, app, reason):
+        """Remove the checkout of app, unless it's being built"""
+        checkoutdir = os.path.join(self.config["builder"]["workdir"], app)
+        with self.processes_lock:
+            if app in self.running:
+                return False
+            logger.info("Removing checkout of %s (%s)", app, reason)
+            shutil.rmtree(checkoutdir, ignore_errors=True)
+        return True
+
+    def prune_checkouts(self):
+        """Remove the checkouts and mirrors of apps no longer configured"""
+        workdir = self.config["builder"]["workdir"]
+        if not os.path.isdir(workdir):
+            return
+        for name in os.listdir(workdir):
+            if name in self.apps or name == "mirrors":
+                continue
+            if os.path.exists(os.path.join(workdir, name, ".git")):
+                self.remove_checkout(name, "app removed from the apps file")
+        mirrors = os.path.join(workdir, "mirrors")
+        if not os.path.isdir(mirrors):
+            return
+        used = {self.get_mirror_dir(self.apps[app]["git_url"]) for app in self.apps}
+        for name in os.listdir(mirrors):
+            mirrordir = os.path.join(mirrors, name)
+            if mirrordir not in used:
+                logger.info("Removing unused mirror %s", mirrordir)
+                shutil.rmtree(mirrordir, ignore_errors=True)
+
+    def prune_images(self):
+        """Remove the dangling images, such as those left by failed builds"""
+        try:
+            result = self.get_docker_client().images.prune(
+                filters={"dangling": True, "until": "10m"}
+            )
+        except docker.errors.DockerException:
+            logger.exception("Failed to prune dangling images")
+            return
+        deleted = result.get("ImagesDeleted") or []
+        if deleted:
+            logger.info(
+                "Pruned %d dangling images, %s reclaimed",
+                len(deleted),
+                kaboxer.format_size(result.get("SpaceReclaimed", 0)),
+            )
+
+    def get_disk_usage(self):
+        total = get_tree_size(self.config["builder"]["workdir"])
+        total += get_tree_size(self.config["builder"]["buildlogsdir"])
+        for path in glob.glob(self.config["builder"]["logfile"] + "*"):
+            total += (
+                get_tree_size(path) if os.path.isdir(path) else os.path.getsize(path)
+            )
+        return total
+
+    def enforce_disk_budget(self):
+        """Free space until the builder fits in disk_budget
+
+        The oldest rotated logs go first, then the checkouts of the apps
+        built least recently; they are cloned again when needed.
+        """
+        budget = self.retention["disk_budget"]
+        usage = self.get_disk_usage()
+        logs = self.get_rotated_logs()
+        while usage > budget and logs:
+            path, base, size, mtime = logs.pop(0)
+            logger.info("Removing old log %s to fit in the disk budget", path)
+            os.remove(path)
+            usage -= size
+        if usage > budget:
+            workdir = self.config["builder"]["workdir"]
+            apps = [
+                app for app in self.apps if os.path.isdir(os.path.join(workdir, app))
+            ]
+            for app in sorted(apps, key=self.get_last_build_time):
+                if usage <= budget:
+                    break
+                size = get_tree_size(os.path.join(workdir, app))
+                if self.remove_checkout(app, "over the disk budget"):
+                    usage -= size
+        if usage > budget:
+            logger.warning(
+                "Disk usage is %s, over the budget of %s",
+                kaboxer.format_size(usage),
+                kaboxer.format_size(budget),
+            )
+
+    def get_last_build_time(self, app):
+        last = self.history.last(
+            app, ("success", "failure", "timeout", "cancelled", "skipped")
+        )
+        return last["time"] if last else 0
+
+    def apply_retention(self):
+        """Clean what the retention policy says, at the end of a run
+
+        Only the logs and checkouts of apps that aren't being built are
+        touched, so that it can run while other builds go on.
+        """
+        if not self.retention or not self.retention_lock.acquire(blocking=False):
+            return
+        with self.processes_lock:
+            busy = set(self.running)
+        try:
+            self.rotate_logs(busy)
+            self.expire_logs()
+            self.prune_checkouts()
+            if self.retention["prune_images"] and not busy:
+                self.prune_images()
+            if self.retention["disk_budget"]:
+                self.enforce_disk_budget()
+        except OSError as e:
+            logger.error("Failed to apply the retention policy: %s", e.strerror)
+        finally:
+            self.retention_lock.release()
+
+    def get_dependencies(self, app):
+        deps = self.apps[app].get("depends_on", [])
+        if isinstance(deps, str):
+            deps = [deps]
+        for dep in deps:
+            if dep not in self.apps:
+                logger.warning("%s depends on unknown app %s, ignoring", app, dep)
+        return [dep for dep in deps if dep in self.apps]
+
+    def get_priority(self, app):
+        """Sort key for apps that are ready to be built
+
+        The apps that took longest to build last time go first, then the
+        ones with the most commits in the last 30 days.
+        """
+        last_success = self.history.last_success(app)
+        duration = last_success.get("duration", 0) if last_success else 0
+        activity = 0
+        checkoutdir = os.path.join(self.config["builder"]["workdir"], app)
+        if os.path.isdir(checkoutdir):
+            try:
+                repo = git.Repo(checkoutdir)
+                activity = int(repo.git.rev_list("--count", "--since=30.days", "HEAD"))
+            except Exception:
+                pass
+        return (duration, activity)
+
+    def build_apps(self, apps, force, run=None):
+        """Build several apps, using a pool of self.args.jobs workers
+
+        With --distributed, the pool only submits the builds to the
+        shared queue and waits for the workers to report their outcome.
+
+        Apps are built after the apps they depend on, and are rebuilt
+        whenever one of those was rebuilt. The progress is recorded in
+        the history, so that an interrupted run can be resumed; pass the
+        ID of that run to do so.
+        """
+        deps = {app: self.get_dependencies(app) for app in apps}
+        cycle = find_cycle(deps)
+        if cycle:
+            logger.error("Dependency loop between apps: %s", " -> ".join(cycle))
+            sys.exit(1)
+        if run is None:
+            run = self.history.start_run(self.args.action, force, apps)
+            progress = {}
+        else:
+            progress = self.history.get_run_apps(run)
+        logger.info("Starting run %d", run)
+        outcomes = {
+            app: p["outcome"] for app, p in progress.items() if p["state"] == "done"
+        }
+        scheduler = BuildScheduler(
+            deps, {app: self.get_priority(app) for app in apps}, outcomes
+        )
+        jobs = max(self.args.jobs, 1)
+        build = self.timed_build_one
+        if getattr(self.args, "distributed", False):
+            self.open_shared_queue()
+            build = self.remote_build_one
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {}
+            while not scheduler.is_finished():
+                for app in scheduler.get_ready()[: jobs - len(futures)]:
+                    scheduler.start(app)
+                    app_force = force or scheduler.has_rebuilt_dependency(app)
+                    if app_force and not force:
+                        logger.info("Rebuilding %s as a dependency was rebuilt", app)
+                    queue_wait = time.monotonic() - scheduler.ready_since[app]
+                    # Skip the fetch if the interrupted run got that far
+                    checked_out = progress.get(app, {}).get("revid")
+                    future = executor.submit(
+                        build,
+                        app,
+                        app_force,
+                        queue_wait,
+                        run,
+                        checked_out,
+                    )
+                    futures[future] = app
+                if not futures:
+                    break
+                try:
+                    done, _ = concurrent.futures.wait(
+                        futures, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                except KeyboardInterrupt:
+                    # Builds run in their own process groups, they don't
+                    # get the signal
+                    for app in futures.values():
+                        self.cancel(app)
+                    raise
+                for future in done:
+                    app = futures.pop(future)
+                    results[app] = future.result()
+                    scheduler.finish(app, results[app][0])
+                    self.history.set_run_app_state(
+                        run, app, "done", outcome=results[app][0]
+                    )
+        for app, outcome in scheduler.outcomes.items():
+            if outcome == "blocked" and app not in outcomes:
+                logger.error("Not building %s, a dependency failed to build", app)
+                results[app] = (outcome, 0.0)
+                self.metrics.finish(app, outcome, 0.0)
+                self.history.set_run_app_state(run, app, "done", outcome=outcome)
+        self.history.finish_run(run)
+        self.log_summary(apps, results)
+        self.write_metrics()
+        self.notifier.flush()
+        self.apply_retention()
+        return results
+
+    def open_shared_queue(self):
+        try:
+            path = self.config["builder"]["queue_db"]
+        except KeyError:
+            logger.error("No queue_db in the builder section of the config")
+            sys.exit(1)
+        self.shared_queue = SharedJobQueue(path)
+
+    def get_queue_setting(self, key):
+        defaults = {"lease_time": 60, "max_attempts": 3, "poll_interval": 5}
+        return float(self.config["builder"].get(key, defaults[key]))
+
+    def remote_build_one(self, app, force, queue_wait=0.0, run=None, checked_out=None):
+        """Build an app on a worker, returns its outcome and the duration
+
+        The last builds of the app are sent with the job, so that the
+        worker decides whether the build is needed as this host would;
+        the builds and the log reported by the worker are added to the
+        history and to the log of the app.
+        """
+        self.metrics.start(app, queue_wait)
+        history = [
+            build
+            for build in (
+                self.history.last(app, ["success", "skipped"]),
+                self.history.last_success(app),
+            )
+            if build
+        ]
+        job_id = self.shared_queue.put(app, force, history)
+        with self.processes_lock:
+            self.remote_jobs[app] = job_id
+        try:
+            while True:
+                self.shared_queue.expire_leases(self.get_queue_setting("max_attempts"))
+                job = self.shared_queue.get(job_id)
+                if job["state"] == "done":
+                    break
+                time.sleep(self.get_queue_setting("poll_interval"))
+        finally:
+            with self.processes_lock:
+                self.remote_jobs.pop(app, None)
+        self.history.merge(app, job["builds"])
+        self.log_router.write(app, job["log"].encode())
+        outcome, duration = job["outcome"], job["duration"] or 0.0
+        logger.info("Build of %s on %s: %s", app, job["worker"], outcome)
+        self.metrics.finish(
+            app, outcome, duration, self.history.get_failure_streak(app)
+        )
+        return outcome, duration
+
+    def run_job(self, job, worker):
+        """Build the app of a job taken from the shared queue, and report"""
+        app = job["app"]
+        if app not in self.apps:
+            logger.error("Job %d is about unknown app %s", job["id"], app)
+            self.shared_queue.finish(job["id"], worker, "error", 0.0)
+            return
+        self.history.merge(app, job["history"])
+        # Mirrors are fetched once per run, here a run is a single build
+        self.fetched_mirrors.discard(self.apps[app]["git_url"])
+        self.registry_digests.clear()
+        self.log_router.flush()
+        try:
+            log_offset = os.path.getsize(self.log_router.get_path(app))
+        except OSError:
+            log_offset = 0
+        start = time.time()
+        with self.processes_lock:
+            self.claimed_jobs[job["id"]] = app
+        try:
+            outcome, duration = self.timed_build_one(app, bool(job["force"]))
+        finally:
+            with self.processes_lock:
+                self.claimed_jobs.pop(job["id"], None)
+        self.write_metrics()
+        self.notifier.flush()
+        self.log_router.flush()
+        log = read_log_excerpt(
+            self.log_router.get_path(app),
+            log_offset,
+            self.config["builder"].get("mail_log_size", 65536),
+        )
+        builds = self.history.get_builds(app, since=start)
+        if not self.shared_queue.finish(
+            job["id"], worker, outcome, duration, builds, log
+        ):
+            logger.warning("Lost the lease on the build of %s, not reporting it", app)
+        logger.info("Build of %s: %s (%.1fs)", app, outcome, duration)
+        self.apply_retention()
+
+    def renew_leases(self, worker):
+        """Renew the leases on the running jobs, and cancel them if asked"""
+        lease_time = self.get_queue_setting("lease_time")
+        while True:
+            time.sleep(lease_time / 3)
+            with self.processes_lock:
+                jobs = dict(self.claimed_jobs)
+            for job_id, app in jobs.items():
+                state = self.shared_queue.renew(job_id, worker, lease_time)
+                if state == "lost":
+                    logger.warning("Lost the lease on the build of %s", app)
+                if state != "claimed":
+                    self.cancel(app)
+
+    def worker_loop(self, worker):
+        while True:
+            try:
+                job = self.shared_queue.claim(
+                    worker,
+                    self.get_queue_setting("lease_time"),
+                    self.get_queue_setting("max_attempts"),
+                )
+                if job is not None:
+                    self.run_job(job, worker)
+                    continue
+            except Exception:
+                # The lease of a job we failed to report expires, so that
+                # it gets retried
+                logger.exception("Unexpected error in worker %s", worker)
+            time.sleep(self.get_queue_setting("poll_interval"))
+
+    def cmd_worker(self):
+        self.open_shared_queue()
+        worker = self.args.name or "%s:%d" % (socket.gethostname(), os.getpid())
+        threading.Thread(target=self.renew_leases, args=(worker,), daemon=True).start()
+        threads = [
+            threading.Thread(target=self.worker_loop, args=(worker,), daemon=True)
+            for i in range(max(self.args.jobs, 1))
+        ]
+        for thread in threads:
+            thread.start()
+        logger.info("Worker %s waiting for jobs", worker)
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            # Hand the running jobs to other workers
+            with self.processes_lock:
+                jobs = dict(self.claimed_jobs)
+            for job_id, app in jobs.items():
+                self.shared_queue.release(job_id, worker)
+                self.cancel(app)
+
+    def log_summary(self, apps, results):
+        table = [
+            (app, results[app][0], "%.1fs" % results[app][1])
+            for app in apps
+            if app in results
+        ]
+        logger.info(
+            "Build summary:\n%s",
+            tabulate.tabulate(table, headers=["App", "Outcome", "Duration"]),
+        )
+
     def cmd_build_all(self):
         logger.info("Building all apps")
-        for app in self.apps:
-            logger.info("Building %s", app)
-            self.build_one(app, force=True)
-            logger.info("Built %s", app)
+        self.build_apps(list(self.apps), force=True)
         logger.info("Built all apps")
 
     def cmd_build_as_needed(self):
         logger.info("Building apps as needed")
-        for app in self.apps:
-            self.build_one(app, force=False)
+        self.build_apps(list(self.apps), force=False)
         logger.info("Built all needed apps")
 
+    def get_planned_rebuild(self, app):
+        """Return why build-as-needed would rebuild app, or None
+
+        Only remote checks are done: the revid of the branch is looked
+        up with git ls-remote and the base images in their registry,
+        nothing is fetched. Apps in a subdir may still be skipped when
+        built, if none of their watched files changed.
+        """
+        base_change = self.get_base_image_change(app, logger)
+        if base_change is not None:
+            return "base image %s was updated" % (base_change,)
+        branch = self.apps[app].get("branch", "master")
+        remote_revid = get_remote_revid(self.apps[app]["git_url"], branch)
+        if remote_revid is None:
+            return "remote revision unknown"
+        last = self.history.last(app, ["success", "skipped"])
+        if last and last["revid"] == remote_revid:
+            return None
+        if not self.history.last_success(app):
+            return "first build"
+        reason = "new revision %s" % (remote_revid[:12],)
+        if "subdir" in self.apps[app]:
+            reason += ", if watched files changed"
+        return reason
+
+    def estimate_duration(self, app, samples=5):
+        """Estimate the duration of a build of app from the last ones
+
+        Returns None if app was never built successfully.
+        """
+        durations = [
+            build["duration"]
+            for build in self.history.get_builds(app)
+            if build["status"] == "success" and build.get("duration") is not None
+        ][:samples]
+        if not durations:
+            return None
+        return statistics.median(durations)
+
+    def cmd_plan(self):
+        apps = list(self.apps)
+        deps = {app: self.get_dependencies(app) for app in apps}
+        cycle = find_cycle(deps)
+        if cycle:
+            logger.error("Dependency loop between apps: %s", " -> ".join(cycle))
+            sys.exit(1)
+        if self.args.all:
+            reasons = {app: "forced" for app in apps}
+        else:
+            # Remote checks are mostly waiting for the network
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+                reasons = dict(zip(apps, executor.map(self.get_planned_rebuild, apps)))
+            for app in toposort(deps):
+                rebuilt = [dep for dep in deps[app] if reasons[dep]]
+                if reasons[app] is None and rebuilt:
+                    reasons[app] = "dependency %s rebuilt" % (rebuilt[0],)
+        estimates = {app: self.estimate_duration(app) for app in apps if reasons[app]}
+        known = [d for d in estimates.values() if d is not None]
+        # Apps never built are assumed to be as long as the others
+        default = statistics.median(known) if known else 0.0
+        durations = {app: default if d is None else d for app, d in estimates.items()}
+        table = [
+            (
+                app,
+                reasons[app],
+                (
+                    "unknown"
+                    if estimates[app] is None
+                    else format_duration(estimates[app])
+                ),
+            )
+            for app in toposort(deps)
+            if reasons[app]
+        ]
+        print(tabulate.tabulate(table, headers=["App", "Reason", "Estimate"]))
+        wall_time = estimate_wall_time(
+            deps,
+            durations,
+            max(self.args.jobs, 1),
+            {app: self.get_priority(app) for app in apps},
+        )
+        print(
+            "\n%d of %d apps to build, %s of builds, %s with %d jobs"
+            % (
+                len(durations),
+                len(apps),
+                format_duration(sum(durations.values())),
+                format_duration(wall_time),
+                max(self.args.jobs, 1),
+            )
+        )
+
+    def cmd_resume(self):
+        run = self.history.get_unfinished_run()
+        if run is None:
+            logger.info("No unfinished run to resume")
+            return
+        apps = []
+        for app in self.history.get_run_apps(run["id"]):
+            if app in self.apps:
+                apps.append(app)
+            else:
+                logger.warning("%s is no longer in the apps file, skipping it", app)
+        logger.info("Resuming run %d (%s)", run["id"], run["action"])
+        self.build_apps(apps, force=bool(run["force"]), run=run["id"])
+        logger.info("Resumed run %d", run["id"])
+
+    def find_pushed_apps(self, payload):
+        """Return the apps built from the repository and branch of a push"""
+        urls, ref = parse_push_event(payload)
+        return [
+            app
+            for app in self.apps
+            if normalize_git_url(self.apps[app]["git_url"]) in urls
+            and self.apps[app].get("branch", "master") == ref
+        ]
+
+    def get_server_status(self):
+        status = self.queue.snapshot()
+        status["apps"] = {
+            app: {
+                "last_success": self.history.last_success(app),
+                "last_failure": self.history.last_failure(app),
+            }
+            for app in self.apps
+        }
+        return status
+
+    def serve_worker(self):
+        while True:
+            app, force, queue_wait = self.queue.get()
+            try:
+                # Mirrors are fetched once per run, here a run is a single build
+                self.fetched_mirrors.discard(self.apps[app]["git_url"])
+                self.registry_digests.clear()
+                outcome, duration = self.timed_build_one(app, force, queue_wait)
+                self.write_metrics()
+                self.notifier.flush()
+                logger.info("Build of %s: %s (%.1fs)", app, outcome, duration)
+                if outcome == "success":
+                    for dependent in self.queue.get_dependents(app):
+                        self.queue.put(dependent, force=True)
+            except Exception:
+                logger.exception("Unexpected error when serving the build of %s", app)
+            finally:
+                self.queue.done(app)
+            try:
+                self.apply_retention()
+            except Exception:
+                logger.exception("Failed to apply the retention policy")
+
+    def cmd_serve(self):
+        deps = {app: self.get_dependencies(app) for app in self.apps}
+        cycle = find_cycle(deps)
+        if cycle:
+            logger.error("Dependency loop between apps: %s", " -> ".join(cycle))
+            sys.exit(1)
+        self.queue = JobQueue(deps)
+        if self.args.socket:
+            if os.path.exists(self.args.socket):
+                os.remove(self.args.socket)
+            server = UnixHTTPServer(self.args.socket, KbxbuilderRequestHandler)
+            address = self.args.socket
+        else:
+            host, _, port = self.args.listen.rpartition(":")
+            server = http.server.ThreadingHTTPServer(
+                (host, int(port)), KbxbuilderRequestHandler
+            )
+            address = self.args.listen
+        server.builder = self
+        for i in range(max(self.args.jobs, 1)):
+            threading.Thread(target=self.serve_worker, daemon=True).start()
+        logger.info("Listening on %s", address)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
 
 def main():
+    # Stop running builds on SIGTERM as on Ctrl-C, see build_apps()
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
     kbxbuilder = Kbxbuilder()
-    kbxbuilder.go()
+    try:
+        kbxbuilder.go()
+    finally:
+        kbxbuilder.log_router.close()
 
 
 if __name__ == "__main__":
@@ -305,6 +305,68 @@ class TestKaboxerLocally(TestKaboxerCommon):
             "Image saved for app2 (as %s)" % (self.tarpath2,),
         )
 
+    def test_build_squash(self):
+        self.run_command_check_stdout_matches(
+            "kaboxer build --squash",
+            "Squashed [0-9]+ metadata layers into one for %s" % self.app_name,
+        )
+        self.assertTrue(self.is_image_present(), "No Docker image present after build")
+        self.run_command_check_stdout_matches(
+            "kaboxer get-meta-file %s version" % self.app_name, "1.0"
+        )
+        self.remove_images()
+        self.run_command_check_stdout_matches(
+            "kaboxer build --squash=all", "Squashed image for %s" % self.app_name
+        )
+        self.assertTrue(self.is_image_present(), "No Docker image present after build")
+        self.run_command_check_stdout_matches(
+            "docker image inspect --format '{{len .RootFS.Layers}}' %s:latest"
+            % self.image_name,
+            "^1$",
+        )
+        self.run_command_check_stdout_matches(
+            "kaboxer run %s" % self.app_name, "Hi there"
+        )
+
+    def test_build_reproducible(self):
+        cmd = "SOURCE_DATE_EPOCH=1684454400 kaboxer build --reproducible --squash"
+        inspect = "docker image inspect --format '{{index .RootFS.Layers %d}}' %s"
+        layers = []
+        for _ in range(2):
+            self.run_and_check_command(cmd)
+            o = self.run_command(
+                "docker image inspect --format "
+                "'{{len .RootFS.Layers}}' %s:latest" % self.image_name
+            )
+            n_layers = int(o.stdout.strip())
+            o = self.run_command(inspect % (n_layers - 1, self.image_name + ":latest"))
+            layers.append(o.stdout.strip())
+            self.remove_images()
+        self.assertEqual(layers[0], layers[1], "Metadata layers differ")
+
+    def test_build_cache_export_import(self):
+        cachedir = os.path.join(self.fixdir, "cache")
+        self.run_and_check_command("kaboxer build --cache-export %s" % cachedir)
+        cachefile = os.path.join(cachedir, "%s.tar" % self.app_name)
+        self.assertTrue(os.path.isfile(cachefile), "No build cache exported")
+        self.remove_images()
+        self.run_command("docker image rm kaboxer-cache/%s" % self.app_name)
+        self.run_command_check_stdout_matches(
+            "kaboxer build --cache-import %s" % cachedir, r"\(cached\)"
+        )
+        self.assertTrue(self.is_image_present(), "No Docker image present after build")
+        self.run_command("docker image rm kaboxer-cache/%s" % self.app_name)
+
+    def test_build_several_versions(self):
+        self.run_and_check_command("kaboxer build --versions 1.0,1.1")
+        self.assertTrue(self.is_image_present("1.0"), "No image for version 1.0")
+        self.assertTrue(self.is_image_present("1.1"), "No image for version 1.1")
+        self.run_command_check_stdout_matches(
+            "kaboxer get-meta-file %s version" % self.app_name, "1.1"
+        )
+        self.run_and_check_command_fails("kaboxer build --versions 1.0,2.0")
+        self.assertFalse(self.is_image_present("2.0"), "Image for version 2.0")
+
     def test_build_then_separate_save(self):
         self.build()
         self.run_and_check_command("kaboxer save %s %s" % (self.app_name, self.tarfile))
@@ -744,6 +806,10 @@ class TestKaboxerLocally(TestKaboxerCommon):
             "kaboxer get-meta-file %s Dockerfile" % self.app_name,
             "FROM debian:stable-slim",
         )
+        self.run_command_check_stdout_matches(
+            "kaboxer get-meta-file %s build-profile.json" % self.app_name,
+            "Step 1/.* : FROM debian:stable-slim",
+        )
         self.run_command("docker image rm %s:latest" % self.image_name)
         self.run_and_check_command("kaboxer build --version 1.1")
         self.assertTrue(self.is_image_present(), "No Docker image present after build")
@@ -1117,6 +1183,11 @@ class TestKbxbuilder(TestKaboxerWithRegistryCommon):
         )
         self.run_command_check_stdout_matches("kaboxer run kbx-demo", "Hello World")
 
+    def test_build_all_parallel(self):
+        self.run_command_check_stderr_matches(
+            "kbxbuilder build-all --jobs 2", r"kbx-demo\s+success"
+        )
+
     def test_build_as_needed(self):
         self.run_command_check_stdout_matches(
             "kbxbuilder build-as-needed", "BUILD OF KBX-DEMO SUCCEEDED"
@@ -1,21 +1,56 @@
 #!/usr/bin/python3
 
+import gzip
+import io
 import json
+import logging
 import os
 import shutil
+import sqlite3
+import tarfile
 import tempfile
+import threading
+import time
 import unittest
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import docker
+
+import git
+
+import jinja2
 
 import responses
 
-from kaboxer import ContainerRegistry, DockerBackend, Kaboxer, KaboxerAppConfig
+import yaml
+
+from kaboxer import BuildProfiler, ContainerRegistry, DockerBackend, Kaboxer
+from kaboxer import KaboxerAppConfig
 from kaboxer import (
+    format_build_profile,
+    format_size,
     get_all_cli_helper_filenames,
     get_all_desktop_file_filenames,
     get_icon_name,
+    get_image_config_changes,
+    get_image_id_from_manifest,
     get_possible_gitlab_project_paths,
+    get_source_date_epoch,
+    parse_size,
     parse_version,
+    write_injection_tarball,
 )
+from kaboxer.builder import AppLogRouter, BuildHistory, BuildMetrics
+from kaboxer.builder import BuildScheduler, JobQueue, SharedJobQueue
+from kaboxer.builder import Kbxbuilder, Notifier, current_app, read_log_excerpt
+from kaboxer.builder import KbxbuilderRequestHandler
+from kaboxer.builder import estimate_wall_time, find_cycle, get_base_images
+from kaboxer.builder import get_remote_revid
+from kaboxer.builder import get_template_references
+from kaboxer.builder import is_watched, parse_push_event, toposort
 
 
 class TestKaboxerApplication(unittest.TestCase):
@@ -53,6 +88,1356 @@ class TestKaboxerApplication(unittest.TestCase):
         args = self.obj.parser.parse_args(args=["-vv", "build"])
         self.assertEqual(args.verbose, 2)
 
+    def test_build_squash_option(self):
+        args = self.obj.parser.parse_args(args=["build"])
+        self.assertIsNone(args.squash)
+
+        args = self.obj.parser.parse_args(args=["build", "--squash"])
+        self.assertEqual(args.squash, "kaboxer")
+
+        args = self.obj.parser.parse_args(args=["build", "--squash=all"])
+        self.assertEqual(args.squash, "all")
+
+    def test_build_resource_options(self):
+        self.obj.args = self.obj.parser.parse_args(args=["build"])
+        self.assertIsNone(self.obj.get_build_container_limits())
+        self.obj.args = self.obj.parser.parse_args(
+            args=["build", "--memory", "1.5g", "--cpu-shares", "512"]
+        )
+        self.assertEqual(
+            self.obj.get_build_container_limits(),
+            {"memory": 1536 * 1024**2, "memswap": 1536 * 1024**2, "cpushares": 512},
+        )
+
+    def test_build_versions_option(self):
+        config = KaboxerAppConfig(
+            config={"application": {"id": "foo"}, "build": {"versions": [1.0, "1.1"]}}
+        )
+        self.obj.args = self.obj.parser.parse_args(args=["build"])
+        self.assertEqual(self.obj.get_versions_to_build(config), ["1.0", "1.1"])
+
+        self.obj.args = self.obj.parser.parse_args(args=["build", "--version", "2"])
+        self.assertEqual(self.obj.get_versions_to_build(config), ["2"])
+
+        args = ["build", "--versions", "1.2, 1.3,"]
+        self.obj.args = self.obj.parser.parse_args(args=args)
+        self.assertEqual(self.obj.get_versions_to_build(config), ["1.2", "1.3"])
+
+        config = KaboxerAppConfig(config={"application": {"id": "foo"}})
+        self.obj.args = self.obj.parser.parse_args(args=["build"])
+        self.assertEqual(self.obj.get_versions_to_build(config), [None])
+
+    def test_report(self):
+        with mock.patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            self.obj.report("Squashed image")
+        self.assertEqual(stdout.getvalue(), "Squashed image\n")
+        # Under kbxbuilder, reports go to the log of the app
+        self.obj.in_process = True
+        with mock.patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            with self.assertLogs("kaboxer", level="INFO") as logs:
+                self.obj.report("Squashed image")
+        self.assertEqual(stdout.getvalue(), "")
+        self.assertEqual(logs.output, ["INFO:kaboxer:Squashed image"])
+
+    def test_push_app_twice(self):
+        # kbxbuilder pushes several apps with the same Kaboxer instance
+        tdname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tdname)
+        images = []
+        for app, version in (("foo", "1.0"), ("bar", "2.0")):
+            config = {
+                "application": {"id": app},
+                "container": {"origin": {"registry": {"url": "registry.test"}}},
+            }
+            with open(os.path.join(tdname, app + ".kaboxer.yaml"), "w") as f:
+                f.write(yaml.dump(config))
+            images.append(mock.Mock(tags=["kaboxer/%s:%s" % (app, version)]))
+        docker_conn = mock.Mock()
+        docker_conn.images.list.return_value = images
+        docker_conn.api.hooks = {"response": []}
+        docker_conn.api.push.return_value = iter([])
+        docker_conn.api.pull.return_value = iter([])
+        kbx = Kaboxer(docker_conn=docker_conn)
+        with mock.patch.object(
+            kbx,
+            "extract_version_from_image",
+            side_effect=lambda image: parse_version(image.tags[0].split(":")[1]),
+        ):
+            with self.assertLogs("kaboxer", level="INFO"):
+                self.assertEqual(
+                    kbx.push_app("foo", tdname), ["registry.test/foo:1.0"]
+                )
+                self.assertEqual(
+                    kbx.push_app("bar", tdname), ["registry.test/bar:2.0"]
+                )
+
+    def test_inject_late_files(self):
+        tdname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tdname)
+        for name in ("version", "build-profile.json"):
+            with open(os.path.join(tdname, name), "w") as f:
+                f.write("{}\n")
+        kbx = Kaboxer(docker_conn=mock.Mock())
+        container = kbx.docker_conn.containers.create.return_value
+
+        def late_files():
+            # The first files are copied before the late ones are written
+            self.assertEqual(container.put_archive.call_count, 1)
+            return [(os.path.join(tdname, "build-profile.json"), "/kaboxer/p.json")]
+
+        image = kbx.inject_files_into_image(
+            mock.Mock(),
+            [(os.path.join(tdname, "version"), "/kaboxer/version")],
+            late_files=late_files,
+        )
+        self.assertEqual(container.put_archive.call_count, 2)
+        container.commit.assert_called_once_with()
+        self.assertEqual(image, container.commit.return_value)
+
+    def test_push_error(self):
+        docker_conn = mock.Mock()
+        docker_conn.api.hooks = {"response": []}
+        docker_conn.api.push.return_value = iter(
+            [{"status": "Preparing"}, {"error": "denied: requested access"}]
+        )
+        kbx = Kaboxer(docker_conn=docker_conn)
+        with self.assertLogs("kaboxer", level="ERROR") as logs:
+            with self.assertRaises(SystemExit):
+                kbx.docker_push("registry.test/foo:1.0")
+        self.assertIn(
+            "Failed to push registry.test/foo:1.0: denied: requested access",
+            logs.output[0],
+        )
+
+    def test_stop_silent_build(self):
+        # A build step that hangs without any output is aborted as well
+        release = threading.Event()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                self.wfile.flush()
+                release.wait(30)
+
+            def log_message(self, fmt, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.addCleanup(release.set)
+        tdname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tdname)
+        with open(os.path.join(tdname, "Dockerfile"), "w") as f:
+            f.write("FROM kali\n")
+        api = docker.APIClient(
+            base_url="http://127.0.0.1:%d" % server.server_port, version="1.41"
+        )
+        self.addCleanup(api.close)
+        kbx = Kaboxer(docker_conn=mock.Mock(api=api))
+        timer = threading.Timer(0.2, kbx.stop)
+        timer.start()
+        start = time.monotonic()
+        with self.assertLogs("kaboxer", level="ERROR") as logs:
+            with self.assertRaises(SystemExit):
+                kbx.docker_build(BuildProfiler(), path=tdname)
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertIn("Stopping as requested", "\n".join(logs.output))
+        self.assertEqual(kbx.responses, set())
+
+        # So is a stalled pull of the image to push
+        kbx = Kaboxer(docker_conn=mock.Mock(api=api))
+        timer = threading.Timer(0.2, kbx.stop)
+        timer.start()
+        start = time.monotonic()
+        with self.assertLogs("kaboxer", level="ERROR"):
+            with self.assertRaises(SystemExit):
+                kbx.docker_pull("registry.test/foo:latest")
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertEqual(kbx.responses, set())
+
+
+class TestKbxbuilderCommon(unittest.TestCase):
+    config = {
+        "builder": {
+            "basedir": ".",
+            "workdir": "{{ config['builder']['basedir'] }}/work",
+            "datadir": "{{ config['builder']['basedir'] }}/data",
+            "buildlogsdir": "{{ config['builder']['basedir'] }}/build-logs",
+            "logfile": "{{ config['builder']['datadir'] }}/kbx-builder.log",
+        },
+    }
+    apps = {
+        "foo": {"buildmode": "kaboxer", "push": False, "git_url": "/dev/null"},
+        "bar": {"buildmode": "kaboxer", "push": False, "git_url": "/dev/null"},
+    }
+
+    def setUp(self):
+        self.tdname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tdname)
+        self.write_yaml("kbxbuilder.config.yaml", self.config)
+        self.write_yaml("kbxbuilder.apps.yaml", self.apps)
+        cwd = os.getcwd()
+        os.chdir(self.tdname)
+        self.addCleanup(os.chdir, cwd)
+        for name in ("kbxbuilder", "kaboxer"):
+            logger = logging.getLogger(name)
+            self.addCleanup(setattr, logger, "handlers", list(logger.handlers))
+            self.addCleanup(logger.setLevel, logger.level)
+        self.obj = self.get_builder()
+
+    def write_yaml(self, filename, data):
+        with open(os.path.join(self.tdname, filename), "w") as f:
+            f.write(yaml.dump(data))
+
+    def get_builder(self, args=None):
+        with self.assertLogs("kbxbuilder", level="INFO"):
+            obj = Kbxbuilder()
+        if args is not None:
+            obj.args = obj.parser.parse_args(args=args)
+        return obj
+
+
+class TestKbxbuilder(TestKbxbuilderCommon):
+    def test_command_line_parser(self):
+        args = self.obj.parser.parse_args(args=["build-all"])
+        self.assertEqual(args.jobs, 1)
+        args = self.obj.parser.parse_args(args=["build-as-needed", "-j", "4"])
+        self.assertEqual(args.jobs, 4)
+
+    def test_parallel_builds(self):
+        self.obj.args = self.obj.parser.parse_args(args=["build-all", "--jobs", "2"])
+        barrier = threading.Barrier(2, timeout=5)
+
+        def build_one(app, force, *args):
+            # Both builds must be running at the same time
+            barrier.wait()
+            if app == "bar":
+                raise RuntimeError("boom")
+            return "success"
+
+        with mock.patch.object(self.obj, "build_one", side_effect=build_one):
+            with self.assertLogs("kbxbuilder", level="INFO") as logs:
+                results = self.obj.build_apps(["foo", "bar"], force=True)
+        self.assertEqual(results["foo"][0], "success")
+        self.assertEqual(results["bar"][0], "error")
+        self.assertRegex("\n".join(logs.output), r"foo\s+success")
+        with open("data/metrics.json") as f:
+            metrics = json.load(f)
+        self.assertEqual(metrics["outcomes"], {"success": 1, "error": 1})
+
+    def test_pipeline_stages(self):
+        self.obj.args = self.obj.parser.parse_args(args=["build-all", "--jobs", "2"])
+        self.obj.stage_slots["build"] = threading.BoundedSemaphore(1)
+        barrier = threading.Barrier(2, timeout=5)
+        lock = threading.Lock()
+        building = []
+        concurrency = []
+
+        def build_one(app, force, *args):
+            # Fetches aren't limited, builds are one at a time
+            with self.obj.pipeline_stage(app, "fetch"):
+                barrier.wait()
+            with self.obj.pipeline_stage(app, "build"):
+                with lock:
+                    building.append(app)
+                    concurrency.append(len(building))
+                time.sleep(0.1)
+                with lock:
+                    building.remove(app)
+            return "success"
+
+        with mock.patch.object(self.obj, "build_one", side_effect=build_one):
+            with self.assertLogs("kbxbuilder", level="INFO"):
+                self.obj.build_apps(["foo", "bar"], force=True)
+        self.assertEqual(concurrency, [1, 1])
+        waits = [
+            self.obj.metrics.apps[app].get("stage_waits", {}).get("build", 0)
+            for app in ("foo", "bar")
+        ]
+        self.assertGreater(max(waits), 0.05)
+        self.assertIn(
+            'kbxbuilder_stage_wait_seconds{app="foo",stage="build"}',
+            self.obj.metrics.to_prometheus(),
+        )
+
+    def test_dependencies(self):
+        self.obj.apps["foo"]["depends_on"] = "bar"
+        self.obj.args = self.obj.parser.parse_args(args=["build-as-needed", "-j", "2"])
+        calls = []
+
+        def build_one(app, force, *args):
+            calls.append((app, force))
+            return "success"
+
+        with mock.patch.object(self.obj, "build_one", side_effect=build_one):
+            with self.assertLogs("kbxbuilder", level="INFO") as logs:
+                self.obj.build_apps(["foo", "bar"], force=False)
+        # foo is built after bar, and forced since bar was rebuilt
+        self.assertEqual(calls, [("bar", False), ("foo", True)])
+        self.assertIn("Rebuilding foo", "\n".join(logs.output))
+
+    def test_dependency_loop(self):
+        self.obj.apps["foo"]["depends_on"] = ["bar"]
+        self.obj.apps["bar"]["depends_on"] = ["foo"]
+        self.obj.args = self.obj.parser.parse_args(args=["build-all"])
+        with self.assertLogs("kbxbuilder", level="ERROR"):
+            with self.assertRaises(SystemExit):
+                self.obj.build_apps(["foo", "bar"], force=True)
+
+    def make_git_repo(self):
+        repo = git.Repo.init(os.path.join(self.tdname, "upstream"))
+        with repo.config_writer() as config:
+            config.set_value("user", "name", "Kaboxer")
+            config.set_value("user", "email", "kaboxer@example.com")
+        commit = repo.index.commit("Initial commit")
+        repo.create_tag("v1", message="Version 1")
+        return repo, commit.hexsha
+
+    def test_get_remote_revid(self):
+        repo, revid = self.make_git_repo()
+        branch = repo.active_branch.name
+        self.assertEqual(get_remote_revid(repo.working_dir, branch), revid)
+        self.assertEqual(get_remote_revid(repo.working_dir, "v1"), revid)
+        self.assertEqual(get_remote_revid(repo.working_dir, revid), revid)
+        self.assertIsNone(get_remote_revid(repo.working_dir, "unknown"))
+
+    def test_build_not_needed_without_fetch(self):
+        repo, revid = self.make_git_repo()
+        self.obj.apps["foo"]["git_url"] = repo.working_dir
+        self.obj.apps["foo"]["branch"] = repo.active_branch.name
+        self.obj.history.add("foo", "master", revid, "success")
+        with mock.patch("git.Repo.clone_from") as clone_from:
+            with self.assertLogs("kbxbuilder", level="INFO") as logs:
+                self.assertEqual(self.obj.build_one("foo", force=False), "not needed")
+        clone_from.assert_not_called()
+        self.assertIn("Build of foo not needed", "\n".join(logs.output))
+
+    def test_shared_mirror(self):
+        repo, revid = self.make_git_repo()
+        for app in ("foo", "bar"):
+            self.obj.apps[app]["git_url"] = repo.working_dir
+            self.obj.apps[app]["branch"] = repo.active_branch.name
+        # An old full clone is replaced by a worktree
+        git.Repo.clone_from(repo.working_dir, "work/bar")
+        with mock.patch.object(self.obj, "run_kaboxer", return_value=([], None)):
+            with self.assertLogs("kbxbuilder", level="INFO"):
+                self.obj.build_one("foo")
+                self.obj.build_one("bar")
+        self.assertEqual(len(os.listdir("work/mirrors")), 1)
+        for app in ("foo", "bar"):
+            checkoutdir = os.path.join("work", app)
+            self.assertTrue(os.path.isfile(os.path.join(checkoutdir, ".git")))
+            self.assertEqual(git.Repo(checkoutdir).head.commit.hexsha, revid)
+        self.assertEqual(self.obj.history.last_success("bar")["revid"], revid)
+
+    def test_config_templates(self):
+        config = {"builder": dict(self.config["builder"])}
+        # Each value refers to the next one
+        for i in range(20):
+            config["builder"]["dir%d" % i] = "{{ config.builder.dir%d }}/%d" % (
+                i + 1,
+                i,
+            )
+        config["builder"]["dir20"] = "/srv"
+        self.write_yaml("kbxbuilder.config.yaml", config)
+        obj = self.get_builder()
+        self.assertEqual(obj.config["builder"]["dir18"], "/srv/19/18")
+        self.assertEqual(obj.config["builder"]["logfile"], "./data/kbx-builder.log")
+
+    def test_config_template_loop(self):
+        config = {"builder": dict(self.config["builder"])}
+        config["builder"]["basedir"] = "{{ config['builder']['logfile'] }}"
+        self.write_yaml("kbxbuilder.config.yaml", config)
+        with self.assertLogs("kbxbuilder", level="ERROR") as logs:
+            with self.assertRaises(SystemExit):
+                Kbxbuilder()
+        self.assertIn(
+            "builder:basedir -> builder:logfile -> builder:datadir -> builder:basedir",
+            "\n".join(logs.output),
+        )
+
+    def commit_file(self, repo, path, content):
+        filename = os.path.join(repo.working_dir, path)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "w") as f:
+            f.write(content)
+        repo.index.add([path])
+        return repo.index.commit("Update %s" % (path,)).hexsha
+
+    def test_path_filtered_rebuild(self):
+        repo, _ = self.make_git_repo()
+        kaboxer_yaml = yaml.dump({"build": {"docker": {"file": "../docker/foo"}}})
+        self.commit_file(repo, "foo/kaboxer.yaml", kaboxer_yaml)
+        revid = self.commit_file(repo, "docker/foo", "FROM debian")
+        self.obj.apps["foo"].update(
+            git_url=repo.working_dir,
+            branch=repo.active_branch.name,
+            subdir="foo",
+            watch_paths=["shared/"],
+        )
+        self.obj.history.add("foo", "master", revid, "success")
+
+        def build_one():
+            # Each build is a new run, where mirrors are fetched again
+            self.obj.fetched_mirrors.clear()
+            with mock.patch.object(self.obj, "run_kaboxer", return_value=([], None)):
+                with self.assertLogs("kbxbuilder", level="INFO") as logs:
+                    outcome = self.obj.build_one("foo", force=False)
+            return outcome, "\n".join(logs.output)
+
+        revid = self.commit_file(repo, "README", "Unrelated change")
+        outcome, output = build_one()
+        self.assertEqual(outcome, "not needed")
+        self.assertIn("no watched file changed", output)
+        skipped = self.obj.history.last("foo", ["skipped"])
+        self.assertEqual(skipped["revid"], revid)
+        self.assertIsNone(self.obj.history.last_failure("foo"))
+        # The skipped revision is known, even before fetching
+        self.assertEqual(build_one()[0], "not needed")
+
+        for path in ("shared/lib", "docker/foo", "foo/run.sh"):
+            revid = self.commit_file(repo, path, "Change")
+            outcome, output = build_one()
+            self.assertEqual(outcome, "success")
+            self.assertIn("1 watched files changed", output)
+            self.assertEqual(self.obj.history.last_success("foo")["revid"], revid)
+
+    def test_base_image_rebuild(self):
+        repo, _ = self.make_git_repo()
+        self.commit_file(repo, "kaboxer.yaml", yaml.dump({"build": {}}))
+        dockerfile = "ARG BASE=kali\nFROM $BASE AS build\nFROM build\n"
+        revid = self.commit_file(repo, "Dockerfile", dockerfile)
+        self.obj.apps["foo"].update(
+            git_url=repo.working_dir, branch=repo.active_branch.name
+        )
+        digests = {"kali": "sha256:1"}
+
+        def build_one():
+            # Each build is a new run, where mirrors are fetched again
+            self.obj.fetched_mirrors.clear()
+            self.obj.registry_digests.clear()
+            with mock.patch("docker.from_env") as from_env:
+                from_env.return_value.images.get_registry_data.side_effect = (
+                    lambda image: mock.Mock(id=digests[image])
+                )
+                with mock.patch.object(
+                    self.obj, "run_kaboxer", return_value=([], None)
+                ):
+                    with self.assertLogs("kbxbuilder", level="INFO") as logs:
+                        outcome = self.obj.build_one("foo", force=False)
+            return outcome, "\n".join(logs.output)
+
+        self.assertEqual(build_one()[0], "success")
+        last_success = self.obj.history.last_success("foo")
+        self.assertEqual(last_success["base_images"], {"kali": "sha256:1"})
+        self.assertEqual(build_one()[0], "not needed")
+        digests["kali"] = "sha256:2"
+        outcome, output = build_one()
+        self.assertEqual(outcome, "success")
+        self.assertIn("base image kali was updated", output)
+        last_success = self.obj.history.last_success("foo")
+        self.assertEqual(last_success["revid"], revid)
+        self.assertEqual(last_success["base_images"], {"kali": "sha256:2"})
+
+    def test_registry_digest_cleared(self):
+        class ClearedDict(dict):
+            # As if another build thread cleared the cache right away
+            def __setitem__(self, key, value):
+                pass
+
+        self.obj.registry_digests = ClearedDict()
+        log = logging.getLogger("kbxbuilder")
+        with mock.patch("docker.from_env") as from_env:
+            from_env.return_value.images.get_registry_data.return_value.id = "sha256:1"
+            self.assertEqual(self.obj.get_registry_digest("kali", log), "sha256:1")
+
+    def test_plan(self):
+        repo, revid = self.make_git_repo()
+        self.obj.apps["baz"] = dict(self.obj.apps["foo"], depends_on="foo")
+        for app in self.obj.apps:
+            self.obj.apps[app].update(
+                git_url=repo.working_dir, branch=repo.active_branch.name
+            )
+        self.obj.history.add("foo", "master", "0" * 40, "success", duration=100)
+        self.obj.history.add("foo", "master", "1" * 40, "success", duration=200)
+        self.obj.history.add("foo", "master", "2" * 40, "failure", duration=10)
+        self.obj.history.add("bar", "master", revid, "success", duration=30)
+        self.obj.history.add("baz", "master", revid, "success", duration=50)
+
+        def plan(args):
+            self.obj.args = self.obj.parser.parse_args(args=["plan"] + args)
+            with mock.patch.object(
+                self.obj, "get_base_image_change", return_value=None
+            ):
+                with mock.patch("sys.stdout", new_callable=io.StringIO) as stdout:
+                    self.obj.cmd_plan()
+            return stdout.getvalue()
+
+        output = plan([])
+        self.assertRegex(output, r"foo\s+new revision %s\s+0:02:30" % revid[:12])
+        self.assertRegex(output, r"baz\s+dependency foo rebuilt\s+0:00:50")
+        self.assertNotIn("bar", output)
+        self.assertIn("2 of 3 apps to build, 0:03:20 of builds, 0:03:20", output)
+        # bar doesn't wait for foo and baz
+        output = plan(["--all", "-j", "2"])
+        self.assertRegex(output, r"bar\s+forced\s+0:00:30")
+        self.assertIn("3 of 3 apps to build, 0:03:50 of builds, 0:03:20", output)
+
+    def test_resume(self):
+        history = self.obj.history
+        run = history.start_run("build-all", True, ["foo", "bar"])
+        history.set_run_app_state(run, "foo", "done", outcome="success")
+        history.set_run_app_state(run, "bar", "checked out", "0123abcd")
+        self.obj.args = self.obj.parser.parse_args(args=["resume"])
+        with mock.patch.object(self.obj, "build_one", return_value="success") as bo:
+            with self.assertLogs("kbxbuilder", level="INFO") as logs:
+                self.obj.cmd_resume()
+        bo.assert_called_once_with("bar", True, run, "0123abcd")
+        self.assertIn("Resuming run %d" % (run,), "\n".join(logs.output))
+        self.assertIsNone(history.get_unfinished_run())
+        self.assertEqual(history.get_run_apps(run)["bar"]["outcome"], "success")
+        with self.assertLogs("kbxbuilder", level="INFO") as logs:
+            self.obj.cmd_resume()
+        self.assertIn("No unfinished run", "\n".join(logs.output))
+
+    def test_resume_checked_out(self):
+        repo, revid = self.make_git_repo()
+        self.obj.apps["foo"]["git_url"] = repo.working_dir
+        self.obj.apps["foo"]["branch"] = repo.active_branch.name
+        run = self.obj.history.start_run("build-all", True, ["foo"])
+        with mock.patch.object(self.obj, "run_kaboxer", return_value=(None, None)):
+            with self.assertLogs("kbxbuilder", level="INFO"):
+                self.obj.build_one("foo", True, run)
+                self.assertEqual(
+                    self.obj.history.get_run_apps(run)["foo"]["revid"], revid
+                )
+                with mock.patch.object(self.obj, "checkout_app") as checkout_app:
+                    self.obj.build_one("foo", True, run, revid)
+        checkout_app.assert_not_called()
+
+    def test_build_options(self):
+        self.obj.config["builder"]["memory"] = "2g"
+        self.obj.apps["foo"]["cpuset_cpus"] = "0-3"
+        self.assertEqual(
+            self.obj.get_build_options("foo"),
+            ["--memory", "2g", "--cpuset-cpus", "0-3"],
+        )
+
+    def make_kaboxer(self, duration):
+        """A fake Kaboxer whose builds take duration seconds, unless stopped"""
+        kbx = Kaboxer(docker_conn=mock.Mock())
+
+        def build_app(app, path, options=()):
+            if kbx.stopping.wait(duration):
+                kbx.check_stopped()
+            return [{"app": app, "version": "1.0", "image_id": "sha256:1"}]
+
+        kbx.build_app = build_app
+        return kbx
+
+    def test_run_kaboxer(self):
+        log = logging.LoggerAdapter(logging.getLogger("kbxbuilder"), {"app": "foo"})
+        self.obj.docker_client = mock.Mock()
+        with mock.patch("kaboxer.Kaboxer", return_value=self.make_kaboxer(0)):
+            built, stopped = self.obj.run_kaboxer("foo", "build", self.tdname, log)
+        self.assertEqual((built[0]["version"], stopped), ("1.0", None))
+        self.obj.apps["foo"]["timeout"] = 0.1
+        with mock.patch("kaboxer.Kaboxer", return_value=self.make_kaboxer(60)):
+            with mock.patch.object(self.obj, "remove_build_containers") as remove:
+                with self.assertLogs("kbxbuilder", level="ERROR") as logs:
+                    with self.assertLogs("kaboxer", level="ERROR"):
+                        built, stopped = self.obj.run_kaboxer(
+                            "foo", "build", self.tdname, log
+                        )
+        self.assertEqual((built, stopped), (None, "timeout"))
+        self.assertIn("timed out after 0.1 seconds", "\n".join(logs.output))
+        remove.assert_called_once()
+        self.assertEqual(self.obj.builds, {})
+
+    def test_build_result(self):
+        repo, revid = self.make_git_repo()
+        self.obj.apps["foo"]["git_url"] = repo.working_dir
+        self.obj.apps["foo"]["branch"] = repo.active_branch.name
+        built = [
+            {
+                "app": "foo",
+                "version": "1.0",
+                "image_id": "sha256:1",
+                "profile": {
+                    "steps": [{"name": "RUN make", "duration": 2.0, "cached": False}],
+                    "total": 2.0,
+                },
+            }
+        ]
+        with mock.patch.object(self.obj, "run_kaboxer", return_value=(built, None)):
+            with self.assertLogs("kbxbuilder", level="INFO") as logs:
+                self.assertEqual(self.obj.build_one("foo"), "success")
+        self.assertIn("Built image sha256:1 of foo 1.0", "\n".join(logs.output))
+        self.assertEqual(
+            self.obj.history.last_success("foo")["images"],
+            [{"version": "1.0", "image_id": "sha256:1"}],
+        )
+
+    def test_smoke_test(self):
+        repo, revid = self.make_git_repo()
+        self.obj.apps["foo"].update(
+            git_url=repo.working_dir,
+            branch=repo.active_branch.name,
+            push=True,
+            smoke_test={"command": "foo --version", "exit_code": 0},
+        )
+        self.obj.config["on_success"] = [{"action": "push_to_registry"}]
+        built = [{"app": "foo", "version": "1.0", "image_id": "sha256:1"}]
+        built[0]["profile"] = {"steps": [], "total": 0.0}
+        client = self.obj.docker_client = mock.Mock()
+        container = client.containers.run.return_value
+        container.logs.return_value = b"foo 1.0\n"
+
+        def build_one(exit_code):
+            container.wait.return_value = {"StatusCode": exit_code}
+            with mock.patch.object(
+                self.obj, "run_kaboxer", side_effect=[(built, None), (["1.0"], None)]
+            ) as run_kaboxer:
+                with self.assertLogs("kbxbuilder", level="INFO") as logs:
+                    outcome = self.obj.build_one("foo")
+            return outcome, run_kaboxer.call_count, "\n".join(logs.output)
+
+        self.assertEqual(build_one(0)[:2], ("success", 2))
+        client.containers.run.assert_called_with(
+            "sha256:1", "foo --version", detach=True
+        )
+        container.remove.assert_called_with(force=True)
+        smoke_tests = self.obj.history.last_success("foo")["smoke_tests"]
+        self.assertEqual(smoke_tests[0]["exit_code"], 0)
+        self.assertEqual(smoke_tests[0]["outcome"], "success")
+        self.assertIn("duration", smoke_tests[0])
+        self.obj.log_router.flush()
+        with open(self.obj.log_router.get_path("foo")) as f:
+            self.assertIn("foo 1.0\n", f.read())
+
+        # The image isn't pushed if the smoke test fails
+        outcome, calls, output = build_one(2)
+        self.assertEqual((outcome, calls), ("failure", 1))
+        self.assertIn("exit code 2 instead of 0", output)
+        last = self.obj.history.last("foo", ["failure"])
+        self.assertEqual(last["smoke_tests"][0]["outcome"], "failure")
+
+    def test_smoke_test_timeout(self):
+        self.obj.apps["foo"]["smoke_test"] = {"command": "sleep 60", "timeout": 0.2}
+        self.obj.smoke_test_slots = threading.BoundedSemaphore(1)
+        log = logging.LoggerAdapter(logging.getLogger("kbxbuilder"), {"app": "foo"})
+        client = self.obj.docker_client = mock.Mock()
+        lock = threading.Lock()
+        running = []
+        concurrency = []
+
+        def run(image_id, command, detach):
+            container = mock.Mock()
+            killed = threading.Event()
+            container.kill.side_effect = killed.set
+
+            def wait():
+                with lock:
+                    running.append(image_id)
+                    concurrency.append(len(running))
+                killed.wait(5)
+                with lock:
+                    running.remove(image_id)
+                return {"StatusCode": 137}
+
+            container.wait.side_effect = wait
+            container.logs.return_value = b""
+            return container
+
+        client.containers.run.side_effect = run
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda i=i: results.append(
+                    self.obj.run_smoke_test(
+                        "foo", {"version": str(i), "image_id": str(i)}, log
+                    )
+                )
+            )
+            for i in range(2)
+        ]
+        with self.assertLogs("kbxbuilder", level="INFO") as logs:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        # smoke_test_jobs is 1 here
+        self.assertEqual(concurrency, [1, 1])
+        self.assertEqual([r["outcome"] for r in results], ["timeout", "timeout"])
+        self.assertEqual([r["exit_code"] for r in results], [137, 137])
+        self.assertIn("timed out after 0.2 seconds", "\n".join(logs.output))
+
+    def test_run_command_timeout(self):
+        self.obj.apps["foo"]["timeout"] = 0.5
+        log = logging.LoggerAdapter(logging.getLogger("kbxbuilder"), {"app": "foo"})
+        with mock.patch.object(self.obj, "remove_build_containers") as remove:
+            with self.assertLogs("kbxbuilder", level="ERROR") as logs:
+                returncode, stopped = self.obj.run_command(
+                    "foo", "sleep 60 & sleep 60; echo done", self.tdname, log
+                )
+        self.assertEqual(stopped, "timeout")
+        self.assertNotEqual(returncode, 0)
+        self.assertIn("timed out after 0.5 seconds", "\n".join(logs.output))
+        remove.assert_called_once()
+        self.assertEqual(self.obj.processes, {})
+        returncode, stopped = self.obj.run_command("foo", "true", self.tdname, log)
+        self.assertEqual((returncode, stopped), (0, None))
+
+    def test_cancel(self):
+        log = logging.LoggerAdapter(logging.getLogger("kbxbuilder"), {"app": "foo"})
+        self.assertFalse(self.obj.cancel("foo"))
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(
+                self.obj.run_command("foo", "sleep 60", self.tdname, log)
+            )
+        )
+        with mock.patch.object(self.obj, "remove_build_containers"):
+            thread.start()
+            while "foo" not in self.obj.processes:
+                time.sleep(0.01)
+            with self.assertLogs("kbxbuilder", level="INFO"):
+                self.assertTrue(self.obj.cancel("foo"))
+            thread.join()
+        self.assertEqual(results[0][1], "cancelled")
+
+        self.obj.docker_client = mock.Mock()
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(
+                self.obj.run_kaboxer("foo", "build", self.tdname, log)
+            )
+        )
+        with mock.patch("kaboxer.Kaboxer", return_value=self.make_kaboxer(60)):
+            with mock.patch.object(self.obj, "remove_build_containers"):
+                with self.assertLogs("kaboxer", level="ERROR"):
+                    thread.start()
+                    while "foo" not in self.obj.builds:
+                        time.sleep(0.01)
+                    with self.assertLogs("kbxbuilder", level="INFO"):
+                        self.assertTrue(self.obj.cancel("foo"))
+                    thread.join()
+        self.assertEqual(results[0], (None, "cancelled"))
+
+    def test_versions_build_log(self):
+        kbx = Kaboxer(docker_conn=mock.Mock())
+
+        def build_image(parsed_config, version=None, tag_latest=True):
+            logging.getLogger("kaboxer").error("Failed to build version %s", version)
+            raise SystemExit(1)
+
+        kbx.build_image = build_image
+        parsed_config = mock.Mock(app_id="foo")
+        token = current_app.set("foo")
+        try:
+            with self.assertRaises(SystemExit):
+                kbx.build_image_versions(parsed_config, ["1.0", "2.0"])
+        finally:
+            current_app.reset(token)
+        self.obj.log_router.flush()
+        with open(self.obj.log_router.get_path("foo")) as f:
+            log = f.read()
+        self.assertIn("Failed to build version 1.0", log)
+        self.assertIn("Failed to build foo version(s) 1.0, 2.0", log)
+
+    def test_run_command_output(self):
+        log = logging.LoggerAdapter(logging.getLogger("kbxbuilder"), {"app": "foo"})
+        returncode, stopped = self.obj.run_command(
+            "foo", "echo out; echo err >&2; exit 3", self.tdname, log
+        )
+        self.assertEqual((returncode, stopped), (3, None))
+        self.obj.log_router.flush()
+        with open(self.obj.log_router.get_path("foo")) as f:
+            self.assertEqual(f.read(), "out\nerr\n")
+
+    def test_app_log_router(self):
+        router = AppLogRouter(os.path.join(self.tdname, "logs"), maxsize=2)
+        router.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+        log = logging.getLogger("kbxbuilder.test")
+        log.propagate = False
+        log.addHandler(router)
+        try:
+            log.warning("no app")
+            log.warning("explicit app", extra={"app": "bar"})
+            token = current_app.set("foo")
+            try:
+                for i in range(10):
+                    log.warning("line %d", i)
+            finally:
+                current_app.reset(token)
+            router.write("bar", b"raw output\n")
+            router.close_app("bar")
+            router.flush()
+        finally:
+            log.removeHandler(router)
+            router.close()
+        self.assertEqual(sorted(os.listdir(router.logdir)), ["bar.log", "foo.log"])
+        with open(router.get_path("foo")) as f:
+            self.assertEqual(f.read().splitlines()[-1], "WARNING line 9")
+        with open(router.get_path("bar")) as f:
+            self.assertEqual(f.read(), "WARNING explicit app\nraw output\n")
+
+    def test_retention_policy(self):
+        self.assertIsNone(self.obj.retention)
+        self.obj.config["builder"]["retention"] = {
+            "max_age": 30,
+            "max_log_size": "1m",
+            "disk_budget": "10g",
+        }
+        policy = self.obj.get_retention_policy()
+        self.assertEqual(policy["max_age"], 30 * 86400)
+        self.assertEqual(policy["max_log_size"], 1024 * 1024)
+        self.assertEqual(policy["max_app_bytes"], 0)
+        self.assertTrue(policy["prune_images"])
+        self.obj.config["builder"]["retention"] = {"disk_budget": "lots"}
+        with self.assertLogs("kbxbuilder", level="ERROR"):
+            with self.assertRaises(SystemExit):
+                self.obj.get_retention_policy()
+
+    def test_retention_logs(self):
+        self.obj.config["builder"]["retention"] = {
+            "max_age": 30,
+            "max_log_size": 10,
+            "max_app_bytes": "1k",
+            "prune_images": False,
+        }
+        self.obj.retention = self.obj.get_retention_policy()
+        self.obj.log_router.write("foo", b"x" * 100)
+        self.obj.log_router.flush()
+        now = time.time()
+        old_logs = {
+            "foo.log.20200102T000000.gz": now - 86400,
+            "foo.log.20200101T000000.gz": now - 2 * 86400,
+            "bar.log.20191101T000000.gz": now - 60 * 86400,
+        }
+        for name, mtime in old_logs.items():
+            path = os.path.join("build-logs", name)
+            with open(path, "wb") as f:
+                f.write(os.urandom(600))
+            os.utime(path, (mtime, mtime))
+        with self.assertLogs("kbxbuilder", level="INFO"):
+            self.obj.apply_retention()
+        # The new foo log and the newest old one fit in max_app_bytes
+        logs = sorted(os.listdir("build-logs"))
+        self.assertEqual(len(logs), 2)
+        self.assertEqual(logs[0], "foo.log.20200102T000000.gz")
+        with gzip.open(os.path.join("build-logs", logs[1])) as f:
+            self.assertEqual(f.read(), b"x" * 100)
+        # The global log file is rotated as well, and reopened
+        rotated = [name for name in os.listdir("data") if name.endswith(".gz")]
+        self.assertEqual(len(rotated), 1)
+        record = logging.makeLogRecord({"msg": "after rotation"})
+        self.obj.logfile_handler.handle(record)
+        with open("data/kbx-builder.log") as f:
+            self.assertIn("after rotation", f.read())
+
+    def test_retention_checkouts(self):
+        self.obj.config["builder"]["retention"] = {"disk_budget": 1}
+        self.obj.retention = self.obj.get_retention_policy()
+        for app in ("foo", "bar", "removed"):
+            os.makedirs(os.path.join("work", app, ".git"))
+        os.makedirs(self.obj.get_mirror_dir("/dev/null"))
+        os.makedirs("work/mirrors/0123456789abcdef.git")
+        self.obj.history.add("foo", "main", "1", "success")
+        self.obj.running.add("foo")
+        client = mock.Mock()
+        with mock.patch.object(self.obj, "get_docker_client", return_value=client):
+            with self.assertLogs("kbxbuilder", level="INFO") as logs:
+                self.obj.apply_retention()
+        # Checkouts of running apps are kept, even over the budget
+        self.assertEqual(sorted(os.listdir("work")), ["foo", "mirrors"])
+        self.assertEqual(
+            os.listdir("work/mirrors"),
+            [os.path.basename(self.obj.get_mirror_dir("/dev/null"))],
+        )
+        self.assertIn("over the budget", "\n".join(logs.output))
+        client.images.prune.assert_not_called()
+
+        self.obj.running.clear()
+        self.obj.retention["disk_budget"] = 0
+        client.images.prune.return_value = {
+            "ImagesDeleted": [{"Deleted": "sha256:1234"}],
+            "SpaceReclaimed": 2000000,
+        }
+        with mock.patch.object(self.obj, "get_docker_client", return_value=client):
+            with self.assertLogs("kbxbuilder", level="INFO") as logs:
+                self.obj.apply_retention()
+        client.images.prune.assert_called_once_with(
+            filters={"dangling": True, "until": "10m"}
+        )
+        self.assertIn("Pruned 1 dangling images, 2.0 MB", "\n".join(logs.output))
+
+    def test_disk_budget_incremental(self):
+        for app in ("foo", "bar"):
+            os.makedirs(os.path.join("work", app, ".git"))
+            with open(os.path.join("work", app, "data"), "wb") as f:
+                f.write(b"x" * 65536)
+        self.obj.history.add("foo", "main", "1", "success")
+        usage = self.obj.get_disk_usage()
+        self.obj.config["builder"]["retention"] = {"disk_budget": usage - 1}
+        self.obj.retention = self.obj.get_retention_policy()
+        with mock.patch.object(
+            self.obj, "get_disk_usage", wraps=self.obj.get_disk_usage
+        ) as get_disk_usage:
+            with self.assertLogs("kbxbuilder", level="INFO") as logs:
+                self.obj.enforce_disk_budget()
+        # The least recently built checkout is enough, usage isn't walked again
+        self.assertEqual(os.listdir("work"), ["foo"])
+        self.assertEqual(get_disk_usage.call_count, 1)
+        self.assertNotIn("over the budget", "\n".join(logs.output))
+
+    def test_distributed_build(self):
+        config = dict(self.config)
+        config["builder"] = dict(
+            config["builder"],
+            queue_db="{{ config['builder']['basedir'] }}/queue.db",
+            poll_interval=0.01,
+        )
+        self.write_yaml("kbxbuilder.config.yaml", config)
+        coordinator = self.get_builder(["build-all", "--distributed", "-j", "2"])
+        coordinator.history.add("foo", "master", "aaa", "success", t=1)
+        config["builder"].update(datadir="worker-data", buildlogsdir="worker-logs")
+        self.write_yaml("kbxbuilder.config.yaml", config)
+        worker = self.get_builder(["worker"])
+        worker.open_shared_queue()
+        sent_history = {}
+
+        def build_one(app, force, run=None, checked_out=None):
+            sent_history[app] = worker.history.last_success(app)
+            worker.add_status(app, "master", "bbb", "success", 2.0, "forced")
+            worker.log_router.write(app, b"Output of the build\n")
+            return "success"
+
+        thread = threading.Thread(
+            target=coordinator.build_apps, args=(["foo", "bar"], True)
+        )
+        with self.assertLogs("kbxbuilder", level="INFO") as logs:
+            thread.start()
+            with mock.patch.object(worker, "build_one", side_effect=build_one):
+                while thread.is_alive():
+                    job = worker.shared_queue.claim("w1", 60, 3)
+                    if job:
+                        worker.run_job(job, "w1")
+                    thread.join(0.01)
+        self.assertEqual(sent_history["foo"]["revid"], "aaa")
+        self.assertIsNone(sent_history["bar"])
+        self.assertIn("Build of bar on w1: success", "\n".join(logs.output))
+        for app in ("foo", "bar"):
+            self.assertEqual(coordinator.history.last_success(app)["revid"], "bbb")
+        self.assertEqual(len(coordinator.history.get_builds("foo")), 2)
+        coordinator.log_router.flush()
+        with open(coordinator.log_router.get_path("foo")) as f:
+            self.assertEqual(f.read(), "Output of the build\n")
+
+    def test_worker_loop_errors(self):
+        job = {"id": 1, "app": "foo"}
+        self.obj.shared_queue = mock.Mock()
+        self.obj.shared_queue.claim.side_effect = [
+            sqlite3.OperationalError("database is locked"),
+            job,
+            job,
+            KeyboardInterrupt,
+        ]
+        self.obj.run_job = mock.Mock(side_effect=[RuntimeError("boom"), None])
+        with mock.patch("time.sleep") as sleep:
+            with self.assertLogs("kbxbuilder", "ERROR") as logs:
+                with self.assertRaises(KeyboardInterrupt):
+                    self.obj.worker_loop("w1")
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn("database is locked", logs.output[0])
+        self.assertEqual(self.obj.run_job.call_count, 2)
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_import_status_file(self):
+        status = {
+            "foo": {
+                1000.0: {"tag": "master", "revid": "aaa", "status": "success"},
+                2000.0: {"tag": "master", "revid": "bbb", "status": "failure"},
+                "last_success": {"tag": "master", "revid": "bbb", "status": "failure"},
+            },
+        }
+        self.obj.history.db.close()
+        shutil.rmtree("data")
+        os.makedirs("data")
+        self.write_yaml("data/status.yaml", status)
+        obj = self.get_builder()
+        self.assertEqual(obj.history.last_success("foo")["revid"], "aaa")
+        self.assertEqual(obj.history.last_failure("foo")["revid"], "bbb")
+        self.assertFalse(os.path.exists("data/status.yaml"))
+
+
+class TestKbxbuilderServer(TestKbxbuilderCommon):
+    def setUp(self):
+        super().setUp()
+        self.obj.args = self.obj.parser.parse_args(
+            args=["serve", "--listen", "127.0.0.1:0", "--token", "secret"]
+        )
+        self.obj.apps["foo"]["git_url"] = "https://gitlab.com/kalilinux/foo.git"
+        self.obj.queue = JobQueue()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), KbxbuilderRequestHandler)
+        self.server.builder = self.obj
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def request(self, path, data=None, token="secret"):
+        url = "http://127.0.0.1:%d%s" % (self.server.server_address[1], path)
+        req = urllib.request.Request(url, data=data, headers={"X-Gitlab-Token": token})
+        try:
+            with urllib.request.urlopen(req) as response:
+                return response.status, json.load(response)
+        except urllib.error.HTTPError as e:
+            return e.code, json.load(e)
+
+    def test_trigger(self):
+        self.assertEqual(
+            self.request("/build/foo", b""), (202, {"app": "foo", "queued": True})
+        )
+        self.assertEqual(
+            self.request("/build/foo?force=1", b""),
+            (202, {"app": "foo", "queued": False}),
+        )
+        self.assertEqual(self.obj.queue.snapshot()["queued"], ["foo"])
+        self.assertEqual(self.request("/build/baz", b"")[0], 404)
+        self.assertEqual(self.request("/build/bar", b"", token="wrong")[0], 403)
+        code, status = self.request("/status")
+        self.assertEqual(code, 200)
+        self.assertEqual(status["queued"], ["foo"])
+        self.assertIsNone(status["apps"]["bar"]["last_success"])
+
+    def test_webhook(self):
+        payload = {
+            "ref": "refs/heads/master",
+            "project": {"git_http_url": "https://gitlab.com/kalilinux/foo.git"},
+        }
+        code, data = self.request("/webhook", json.dumps(payload).encode())
+        self.assertEqual((code, data), (202, {"apps": ["foo"]}))
+        self.assertEqual(self.obj.queue.get()[:2], ("foo", False))
+        self.assertEqual(self.request("/webhook", b"not json")[0], 400)
+
+    def test_worker_survives_errors(self):
+        built = threading.Event()
+        self.obj.timed_build_one = mock.Mock(
+            side_effect=[RuntimeError("boom"), ("success", 1.0)]
+        )
+        self.obj.write_metrics = mock.Mock(side_effect=built.set)
+        self.obj.apply_retention = mock.Mock()
+        with self.assertLogs("kbxbuilder", "ERROR") as logs:
+            threading.Thread(target=self.obj.serve_worker, daemon=True).start()
+            self.obj.queue.put("foo")
+            self.obj.queue.put("bar")
+            self.assertTrue(built.wait(10))
+        self.assertIn("boom", logs.output[0])
+        self.assertEqual(self.obj.timed_build_one.call_count, 2)
+        # The failed build doesn't stay in the running list
+        self.assertNotIn("foo", self.obj.queue.snapshot()["running"])
+
+
+class TestJobQueue(unittest.TestCase):
+    def test_deduplication(self):
+        queue = JobQueue()
+        self.assertTrue(queue.put("foo"))
+        self.assertTrue(queue.put("bar"))
+        self.assertFalse(queue.put("foo", force=True))
+        self.assertEqual(queue.get()[:2], ("foo", True))
+        # foo can be queued again while it's being built
+        self.assertTrue(queue.put("foo"))
+        self.assertEqual(queue.get()[:2], ("bar", False))
+        queue.done("foo")
+        self.assertEqual(queue.get()[:2], ("foo", False))
+
+    def test_dependencies(self):
+        queue = JobQueue({"foo": ["bar"], "bar": []})
+        queue.put("foo")
+        queue.put("bar")
+        self.assertEqual(queue.get()[:2], ("bar", False))
+        self.assertEqual(queue.snapshot(), {"queued": ["foo"], "running": ["bar"]})
+        self.assertEqual(queue.get_dependents("bar"), ["foo"])
+        queue.done("bar")
+        self.assertEqual(queue.get()[:2], ("foo", False))
+
+    def test_parse_push_event(self):
+        github = {
+            "ref": "refs/tags/v1.0",
+            "repository": {
+                "clone_url": "https://github.com/kali/foo.git",
+                "ssh_url": "git@github.com:kali/foo.git",
+            },
+        }
+        self.assertEqual(
+            parse_push_event(github),
+            ({"https://github.com/kali/foo", "git@github.com:kali/foo"}, "v1.0"),
+        )
+
+
+class TestBuildHistory(unittest.TestCase):
+    def setUp(self):
+        tdname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tdname)
+        self.history = BuildHistory(os.path.join(tdname, "status.db"))
+
+    def test_last_builds(self):
+        self.assertIsNone(self.history.last_success("foo"))
+        self.history.add("foo", "master", "aaa", "success", t=1, duration=12.5)
+        self.history.add("foo", "master", "bbb", "failure", t=2)
+        self.history.add("foo", "master", "ccc", "failure", t=3)
+        self.history.add("bar", "master", "ddd", "success", t=4)
+        last_success = self.history.last_success("foo")
+        self.assertEqual(last_success["revid"], "aaa")
+        self.assertEqual(last_success["duration"], 12.5)
+        self.assertEqual(self.history.last_failure("foo")["revid"], "ccc")
+        self.assertIsNone(self.history.last_failure("bar"))
+        builds = self.history.get_builds("foo", limit=2)
+        self.assertEqual([b["revid"] for b in builds], ["ccc", "bbb"])
+        self.assertEqual(self.history.get_failure_streak("foo"), 2)
+        self.assertEqual(self.history.get_failure_streak("bar"), 0)
+
+    def test_merge(self):
+        self.history.add("foo", "master", "aaa", "success", t=1)
+        builds = [
+            {"time": 1, "tag": "master", "revid": "aaa", "status": "success"},
+            {"time": 2, "tag": "master", "revid": "bbb", "status": "failure"},
+            {"time": 3, "revid": "ccc", "status": "success", "duration": 5},
+        ]
+        self.assertEqual(self.history.merge("foo", builds), 2)
+        self.assertEqual(self.history.merge("foo", builds), 0)
+        self.assertEqual(self.history.last_success("foo")["duration"], 5)
+        builds = self.history.get_builds("foo", since=2)
+        self.assertEqual([b["revid"] for b in builds], ["ccc", "bbb"])
+
+    def test_unfinished_run(self):
+        crashed = self.history.start_run("build-all", True, ["foo"])
+        self.assertEqual(self.history.get_unfinished_run()["id"], crashed)
+        # A later run supersedes it, even if that one is interrupted too
+        run = self.history.start_run("build-as-needed", False, ["foo"])
+        self.assertEqual(self.history.get_unfinished_run()["id"], run)
+        self.history.finish_run(run)
+        self.assertIsNone(self.history.get_unfinished_run())
+
+
+class TestSharedJobQueue(unittest.TestCase):
+    def setUp(self):
+        tdname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tdname)
+        self.now = 1000.0
+        self.queue = SharedJobQueue(
+            os.path.join(tdname, "queue.db"), clock=lambda: self.now
+        )
+
+    def test_claim(self):
+        history = [{"time": 1, "revid": "aaa", "status": "success"}]
+        job_id = self.queue.put("foo", True, history)
+        self.queue.put("bar", False)
+        job = self.queue.claim("w1", 60, 3)
+        self.assertEqual((job["id"], job["app"], job["force"]), (job_id, "foo", 1))
+        self.assertEqual(job["history"], history)
+        self.assertEqual(self.queue.claim("w2", 60, 3)["app"], "bar")
+        self.assertIsNone(self.queue.claim("w3", 60, 3))
+        self.assertEqual(self.queue.renew(job_id, "w1", 60), "claimed")
+        self.assertEqual(self.queue.renew(job_id, "w2", 60), "lost")
+        self.assertTrue(self.queue.finish(job_id, "w1", "success", 1.5, history))
+        job = self.queue.get(job_id)
+        self.assertEqual((job["state"], job["outcome"]), ("done", "success"))
+        self.assertEqual(job["builds"], history)
+
+    def test_expired_lease(self):
+        job_id = self.queue.put("foo", False)
+        self.queue.claim("w1", 60, 2)
+        self.now += 30
+        self.assertEqual(self.queue.renew(job_id, "w1", 60), "claimed")
+        self.now += 61
+        # w1 is deemed dead, its job is handed out again
+        self.assertEqual(self.queue.claim("w2", 60, 2)["id"], job_id)
+        self.assertEqual(self.queue.renew(job_id, "w1", 60), "lost")
+        self.assertFalse(self.queue.finish(job_id, "w1", "success", 1.0))
+        self.now += 61
+        self.queue.expire_leases(2)
+        job = self.queue.get(job_id)
+        self.assertEqual((job["state"], job["outcome"]), ("done", "error"))
+        self.assertIn("lease of worker w2 expired", job["log"])
+
+    def test_cancel(self):
+        pending = self.queue.put("foo", False)
+        running = self.queue.put("bar", False)
+        self.queue.cancel(pending)
+        self.assertEqual(self.queue.claim("w1", 60, 3)["id"], running)
+        self.assertEqual(self.queue.get(pending)["outcome"], "cancelled")
+        self.queue.cancel(running)
+        self.assertEqual(self.queue.renew(running, "w1", 60), "cancelled")
+        # Unless the worker releases it
+        self.queue.release(running, "w1")
+        self.assertEqual(self.queue.claim("w2", 60, 3)["attempts"], 1)
+
+
+class TestNotifier(unittest.TestCase):
+    def test_read_log_excerpt(self):
+        with tempfile.NamedTemporaryFile("w") as f:
+            f.write("old build\nnew build\n" + "x" * 100)
+            f.flush()
+            self.assertEqual(read_log_excerpt(f.name, 10)[:10], "new build\n")
+            self.assertEqual(
+                read_log_excerpt(f.name, 10, max_size=10),
+                "[... 100 bytes skipped ...]\n" + "x" * 10,
+            )
+        self.assertEqual(read_log_excerpt("/nonexistent"), "")
+
+    def test_flush(self):
+        notifier = Notifier()
+        action = {"action": "send_mail", "from": "kbx@example.com", "to": "a@b"}
+        digest = dict(action, digest=True)
+        notifier.add("foo", "failure", action, "foo failed", "foo log")
+        notifier.add("bar", "success", digest, "bar built", "bar log")
+        notifier.add("baz", "failure", digest, "baz failed", "baz log")
+        with mock.patch("smtplib.SMTP") as smtp:
+            notifier.flush()
+            notifier.flush()
+        smtp.assert_called_once_with("localhost")
+        send_message = smtp.return_value.__enter__.return_value.send_message
+        sent = [c.args[0] for c in send_message.mock_calls]
+        self.assertEqual(
+            [m["Subject"] for m in sent],
+            ["foo failed", "kbxbuilder: 2 builds, 1 failed"],
+        )
+        attachments = [a.get_filename() for a in sent[1].iter_attachments()]
+        self.assertEqual(attachments, ["bar.log", "baz.log"])
+        self.assertIn("Build of baz: failure", sent[1].get_body().get_content())
+
+
+class TestBuildMetrics(unittest.TestCase):
+    def test_metrics(self):
+        clock = mock.Mock(side_effect=[0, 5, 5, 25, 30, 31])
+        metrics = BuildMetrics(clock=clock)
+        metrics.start("foo", queue_wait=2.5)
+        with metrics.stage("foo", "fetch"):
+            pass
+        with metrics.stage("foo", "build"):
+            pass
+        with metrics.stage("foo", "fetch"):
+            pass
+        metrics.finish("foo", "failure", 30, failure_streak=3)
+        metrics.start("bar")
+        metrics.skip("bar", "remote unchanged")
+        metrics.finish("bar", "not needed", 1)
+        data = json.loads(metrics.to_json())
+        self.assertEqual(data["apps"]["foo"]["stages"], {"fetch": 6, "build": 20})
+        self.assertEqual(data["skips"], {"remote unchanged": 1})
+        text = metrics.to_prometheus()
+        self.assertIn('kbxbuilder_queue_wait_seconds{app="foo"} 2.5\n', text)
+        self.assertIn(
+            'kbxbuilder_stage_duration_seconds{app="foo",stage="build"} 20\n', text
+        )
+        self.assertIn('kbxbuilder_failure_streak{app="foo"} 3\n', text)
+        self.assertIn('kbxbuilder_builds{outcome="not needed"} 1\n', text)
+        self.assertIn('kbxbuilder_skips{reason="remote unchanged"} 1\n', text)
+
+
+class TestBuildScheduler(unittest.TestCase):
+    def test_find_cycle(self):
+        self.assertIsNone(find_cycle({"a": ["b"], "b": ["c"], "c": []}))
+        self.assertEqual(
+            find_cycle({"a": ["b"], "b": ["c"], "c": ["b"]}), ["b", "c", "b"]
+        )
+        # Unknown nodes are ignored
+        self.assertIsNone(find_cycle({"a": ["x"]}))
+
+    def test_is_watched(self):
+        self.assertTrue(is_watched("foo/bar", ["foo"]))
+        self.assertTrue(is_watched("foo/bar", ["foo/"]))
+        self.assertTrue(is_watched("foo", ["foo"]))
+        self.assertFalse(is_watched("foobar", ["foo"]))
+        self.assertTrue(is_watched("foobar", ["."]))
+
+    def test_get_base_images(self):
+        dockerfile = """
+            # FROM commented
+            ARG REGISTRY=docker.io
+            ARG TAG
+            FROM --platform=linux/amd64 ${REGISTRY}/kalilinux/kali-rolling AS base
+            FROM golang:$TAG AS build
+            FROM base
+            ARG LATE=x
+            FROM scratch
+            COPY --from=build \\
+                /go/bin/app /app
+            FROM \\
+                debian
+        """
+        self.assertEqual(
+            get_base_images(dockerfile),
+            ["docker.io/kalilinux/kali-rolling", "debian"],
+        )
+        self.assertEqual(
+            get_base_images(dockerfile, {"TAG": 1, "REGISTRY": "example.com"}),
+            ["example.com/kalilinux/kali-rolling", "golang:1", "debian"],
+        )
+
+    def test_toposort(self):
+        order = toposort({"a": ["b", "c"], "b": ["c"], "c": [], "d": []})
+        self.assertEqual(order, ["c", "b", "a", "d"])
+
+    def test_estimate_wall_time(self):
+        deps = {"a": [], "b": [], "c": ["a"], "d": []}
+        durations = {"a": 10, "b": 30, "c": 15}
+        self.assertEqual(estimate_wall_time(deps, durations, 1), 55)
+        self.assertEqual(estimate_wall_time(deps, durations, 2), 30)
+        # Giving priority to the longest build is what matters here
+        durations = {"a": 10, "b": 10, "d": 20}
+        self.assertEqual(estimate_wall_time(deps, durations, 2, {"d": (1,)}), 20)
+        self.assertEqual(estimate_wall_time(deps, {}, 4), 0)
+
+    def test_template_references(self):
+        env = jinja2.Environment()
+        source = (
+            "{{ config['builder']['basedir'] }}/{{ config.builder.name | lower }}"
+            "{{ config['apps'][app] }}{{ other.x }}"
+        )
+        self.assertEqual(
+            get_template_references(env.parse(source), "config"),
+            {("builder", "basedir"), ("builder", "name"), ("apps",)},
+        )
+        self.assertEqual(
+            get_template_references(env.parse("{{ config }}"), "config"), {()}
+        )
+
+    def test_priorities(self):
+        scheduler = BuildScheduler(
+            {"a": [], "b": [], "c": ["a"]}, {"a": 10, "b": 20, "c": 30}
+        )
+        self.assertEqual(scheduler.get_ready(), ["b", "a"])
+        scheduler.start("b")
+        self.assertEqual(scheduler.get_ready(), ["a"])
+        scheduler.start("a")
+        self.assertEqual(scheduler.get_ready(), [])
+        scheduler.finish("a", "not needed")
+        self.assertEqual(scheduler.get_ready(), ["c"])
+        self.assertFalse(scheduler.has_rebuilt_dependency("c"))
+        scheduler.start("c")
+        scheduler.finish("c", "success")
+        self.assertFalse(scheduler.is_finished())
+        scheduler.finish("b", "success")
+        self.assertTrue(scheduler.is_finished())
+
+    def test_failed_dependency(self):
+        scheduler = BuildScheduler({"a": [], "b": ["a"], "c": ["b"]})
+        scheduler.start("a")
+        scheduler.finish("a", "failure")
+        self.assertEqual(scheduler.get_ready(), [])
+        self.assertTrue(scheduler.is_finished())
+        self.assertEqual(scheduler.outcomes["c"], "blocked")
+
 
 class TestFilenameHelpers(unittest.TestCase):
     def assert_cli_helpers(self, app_id, components, expected):
@@ -126,6 +1511,155 @@ class TestFilenameHelpers(unittest.TestCase):
         self.assertEqual(icon_name, "kaboxer-foo")
 
 
+class TestImageHelpers(unittest.TestCase):
+    def test_format_size(self):
+        self.assertEqual(format_size(12), "12 B")
+        self.assertEqual(format_size(1234), "1.2 kB")
+        self.assertEqual(format_size(345600000), "345.6 MB")
+        self.assertEqual(format_size(2 * 10**12), "2.0 TB")
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size("1024"), 1024)
+        self.assertEqual(parse_size("512m"), 512 * 1024**2)
+        self.assertEqual(parse_size("2GB"), 2 * 1024**3)
+        self.assertRaises(ValueError, parse_size, "lots")
+
+    def test_image_config_changes(self):
+        config = {
+            "Env": ["PATH=/usr/bin:/bin", "GREETING=hello world"],
+            "Cmd": ["/run.sh"],
+            "Entrypoint": None,
+            "WorkingDir": "/kaboxer",
+            "User": "",
+            "ExposedPorts": {"8000/tcp": {}},
+            "Labels": None,
+        }
+        changes = get_image_config_changes(config)
+        self.assertEqual(
+            changes,
+            [
+                'ENV PATH="/usr/bin:/bin"',
+                'ENV GREETING="hello world"',
+                "EXPOSE 8000/tcp",
+                "WORKDIR /kaboxer",
+                'CMD ["/run.sh"]',
+            ],
+        )
+
+    def test_image_id_from_manifest(self):
+        manifest = [{"Config": "0123abcd.json", "RepoTags": ["foo:latest"]}]
+        self.assertEqual(get_image_id_from_manifest(manifest), "sha256:0123abcd")
+        manifest = [{"Config": "blobs/sha256/0123abcd", "RepoTags": ["foo:latest"]}]
+        self.assertEqual(get_image_id_from_manifest(manifest), "sha256:0123abcd")
+
+
+class TestReproducibleInjection(unittest.TestCase):
+    def setUp(self):
+        self.tdname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tdname)
+
+    def mk_file(self, name, content, mtime):
+        path = os.path.join(self.tdname, name)
+        with open(path, "w") as f:
+            f.write(content)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def get_tarball(self, files, mtime=None):
+        buf = io.BytesIO()
+        write_injection_tarball(buf, files, mtime=mtime)
+        return buf.getvalue()
+
+    def test_source_date_epoch(self):
+        with mock.patch.dict(os.environ, {"SOURCE_DATE_EPOCH": "1684454400"}):
+            self.assertEqual(get_source_date_epoch(), 1684454400)
+        with mock.patch.dict(os.environ, clear=True):
+            self.assertEqual(get_source_date_epoch(), 0)
+
+    def test_identical_inputs_give_identical_tarballs(self):
+        version = self.mk_file("version", "1.0\n", 1000)
+        revision = self.mk_file("revision", "3\n", 2000)
+        files1 = [
+            (version, "/kaboxer/version"),
+            (revision, "/kaboxer/packaging-revision"),
+        ]
+        tarball1 = self.get_tarball(files1, mtime=42)
+        version = self.mk_file("version", "1.0\n", 3000)
+        revision = self.mk_file("revision", "3\n", 4000)
+        files2 = [
+            (revision, "/kaboxer/packaging-revision"),
+            (version, "/kaboxer/version"),
+        ]
+        tarball2 = self.get_tarball(files2, mtime=42)
+        self.assertEqual(tarball1, tarball2)
+
+    def test_normalized_members(self):
+        version = self.mk_file("version", "1.0\n", 1000)
+        tarball = self.get_tarball([(version, "/kaboxer/version")], mtime=42)
+        tf = tarfile.open(fileobj=io.BytesIO(tarball))
+        members = tf.getmembers()
+        self.assertEqual([m.name for m in members], ["/kaboxer", "/kaboxer/version"])
+        for m in members:
+            self.assertEqual(m.mtime, 42)
+            self.assertEqual((m.uid, m.gid), (0, 0))
+        self.assertEqual(members[0].mode, 0o755)
+        self.assertEqual(members[1].mode, 0o644)
+
+
+class TestBuildProfiler(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.obj = BuildProfiler(clock=lambda: self.now)
+
+    def feed(self, event, at):
+        self.now = at
+        self.obj.feed(event)
+
+    def test_profile(self):
+        self.feed({"stream": "Step 1/3 : FROM debian:stable-slim"}, 0)
+        self.feed({"status": "Pulling from library/debian"}, 1)
+        self.feed({"status": "Pull complete"}, 5)
+        self.feed({"stream": "\n"}, 6)
+        self.feed({"stream": "Step 2/3 : RUN apt-get update"}, 7)
+        self.feed({"stream": "Step 3/3 : COPY run.sh /run.sh"}, 27)
+        self.feed({"stream": " ---> Using cache\n"}, 27)
+        self.feed({"stream": "Successfully built 0123456789ab"}, 28)
+        self.obj.stop()
+        self.obj.start("metadata injection")
+        self.now = 30
+        self.obj.stop()
+        profile = self.obj.get_profile()
+        self.assertEqual(
+            profile["steps"],
+            [
+                {
+                    "name": "Step 1/3 : FROM debian:stable-slim",
+                    "duration": 7,
+                    "cached": False,
+                },
+                {
+                    "name": "Step 2/3 : RUN apt-get update",
+                    "duration": 20,
+                    "cached": False,
+                },
+                {
+                    "name": "Step 3/3 : COPY run.sh /run.sh",
+                    "duration": 1,
+                    "cached": True,
+                },
+                {"name": "metadata injection", "duration": 2, "cached": False},
+            ],
+        )
+        self.assertEqual(profile["pull"], 4)
+        self.assertEqual(profile["total"], 30)
+
+        lines = format_build_profile(profile).splitlines()
+        self.assertTrue(lines[2].startswith("Step 2/3 : RUN apt-get update"))
+        self.assertTrue(lines[3].startswith("Step 1/3 : FROM debian:stable-slim"))
+        self.assertTrue(lines[-2].startswith("Step 3/3 : COPY run.sh /run.sh (cached)"))
+        self.assertTrue(lines[-1].startswith("Total"))
+
+
 class TestKaboxerParseVersion(unittest.TestCase):
     # XXX: parse_version() is used quite a lot,  however at the moment it's
     # unclear to me what's the exact scope:  parse upstream versions, parse